@@ -11,7 +11,6 @@ import streamlit as st
 import os
 import re
 import base64
-import json  # Needed for Jupyter notebook parsing
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -60,6 +59,18 @@ def smart_display_content(content: str, max_preview: int = 500, is_user: bool =
     if not content:
         return
     
+    # Stored attachments: show the message text, load each attachment only on request
+    refs = council.attachment_refs(content)
+    if refs:
+        query_part = council.ATTACHMENT_REF_PATTERN.sub("", content).strip()
+        if query_part:
+            st.markdown(query_part[:max_preview] + ("..." if len(query_part) > max_preview else ""))
+        st.caption(f"📎 {len(refs)} file(s) attached")
+        for name, sha, chars in refs:
+            if st.checkbox(f"📂 {name} ({chars:,} chars)", key=f"att_{sha[:16]}_{abs(hash(content)) % 10**8}"):
+                st.markdown(council.get_attachment(sha, user_id) or "⚠️ Attachment unavailable")
+        return
+    
     # Detect if content has embedded files/code
     has_file = "[FILE:" in content or "[EXCEL:" in content or "[CSV:" in content or "[WORD:" in content
     has_code = "```" in content and len(content) > 2000
@@ -866,6 +877,22 @@ with st.sidebar:
     
     st.divider()
     
+    st.markdown("### 🔎 Search")
+    search_query = st.text_input("Search history", key="history_search", placeholder="Search past chats & files...", label_visibility="collapsed")
+    if search_query:
+        hits = council.search(search_query, user_id=user_id, limit=6)
+        if not hits:
+            st.caption("No matches")
+        for i, hit in enumerate(hits):
+            icon = "📄" if hit['kind'] == "file" else "💬"
+            if st.button(f"{icon} {hit['title'][:24]}", key=f"hit_{i}_{hit['ref']}", use_container_width=True):
+                st.session_state.session_id = hit['session_id']
+                st.query_params["session"] = hit['session_id']
+                st.rerun()
+            st.caption(hit['snippet'][:160])
+    
+    st.divider()
+    
     st.markdown("### 📂 Recent")
     try:
         for sess in council.get_sessions(user_id)[:8]:
@@ -887,6 +914,8 @@ with st.sidebar:
     
     st.divider()
     st.caption(f"⚡ {council.get_tokens_used():,} tokens")
+    write_stats = council.get_write_queue_stats()
+    st.caption(f"💾 {write_stats['depth']} pending writes | {write_stats['local_backlog']} unsynced | last flush {write_stats['last_flush_ms']:.0f}ms")
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # MAIN CONTENT
@@ -931,7 +960,7 @@ with col1:
             # Audio (for transcription)
             'mp3', 'wav', 'm4a', 'ogg', 'flac', 'aac', 'wma', 'aiff',
             # Archives
-            'zip', 'tar', 'gz', 'rar', '7z', 'bz2', 'xz',
+            'zip', 'tar', 'gz', 'tgz', 'rar', '7z', 'bz2', 'xz',
             # Misc
             'log', 'gitignore', 'dockerfile', 'makefile', 'license', 'readme',
             # Jupyter
@@ -940,7 +969,14 @@ with col1:
     )
     
     try:
-        history = council.get_history(st.session_state.session_id)
+        # LAZY PAGINATION: only the newest page is fetched; older pages load on demand
+        limit_key = f"history_limit_{st.session_state.session_id}"
+        history_limit = st.session_state.get(limit_key, council.HISTORY_PAGE_SIZE)
+        history = council.get_history_tail(st.session_state.session_id, history_limit)
+        if history and council.has_older_history(st.session_state.session_id, history_limit):
+            if st.button("⬆️ Load older messages", key="load_older_btn"):
+                st.session_state[limit_key] = history_limit + council.HISTORY_PAGE_SIZE
+                st.rerun()
         if history:
             # Group messages by conversation turns
             i = 0
@@ -991,6 +1027,13 @@ with col1:
                                 st.markdown(f'<span class="agent-badge agent-{cls}">{a}</span>', unsafe_allow_html=True)
                                 st.markdown(m["content"])  # FULL content, no truncation
                                 st.divider()
+            
+            # REGENERATE: re-run the last question, bypassing the semantic cache
+            if history[-1]["role"] == "assistant":
+                last_question = next((m["content"] for m in reversed(history) if m["role"] == "user"), None)
+                if last_question and st.button("🔄 Regenerate", key="regenerate_btn"):
+                    st.session_state.regenerate_query = last_question
+                    st.rerun()
         else:
             st.info("✨ Start a conversation...")
     except Exception as e:
@@ -999,173 +1042,30 @@ with col1:
     # Input
     user_input = st.chat_input("Ask anything... (image: prompt, video: prompt, search: query)")
     
+    # Regenerate replays the stored question (files already inlined) with a fresh council run
+    regenerating = False
+    if not user_input and st.session_state.get("regenerate_query"):
+        user_input = st.session_state.pop("regenerate_query")
+        regenerating = True
+    
     if user_input:
         # Handle MULTIPLE uploaded files
         uploaded_images_b64 = []
+        streamed_files = []
         
-        if uploaded_files:
-            for uploaded in uploaded_files:
-                try:
-                    file_ext = uploaded.name.split('.')[-1].lower() if '.' in uploaded.name else ''
-                    
-                    if uploaded.type == "application/pdf":
-                        from PyPDF2 import PdfReader
-                        uploaded.seek(0)
-                        file_text = "\n".join([p.extract_text() or "" for p in PdfReader(uploaded).pages])
-                        user_input += f"\n\n[FILE: {uploaded.name}]\n```\n{file_text}\n```"
-                    
-                    elif uploaded.type and uploaded.type.startswith("image/"):
-                        # Encode image as base64 so AI can SEE it
-                        import base64
-                        uploaded.seek(0)
-                        image_bytes = uploaded.read()
-                        img_b64 = f"data:{uploaded.type};base64,{base64.b64encode(image_bytes).decode()}"
-                        uploaded_images_b64.append(img_b64)
-                        user_input += f"\n\n[IMAGE ATTACHED: {uploaded.name}]"
-                    
-                    elif file_ext in ['mp4', 'webm', 'mov', 'avi', 'mkv']:
-                        # VIDEO: Extract key frames for AI analysis
-                        import tempfile
-                        import subprocess
-                        
-                        user_input += f"\n\n[VIDEO: {uploaded.name} - {uploaded.size:,} bytes]"
-                        
-                        try:
-                            # Save video temporarily
-                            with tempfile.NamedTemporaryFile(suffix=f'.{file_ext}', delete=False) as tmp:
-                                uploaded.seek(0)
-                                tmp.write(uploaded.read())
-                                tmp_path = tmp.name
-                            
-                            # Extract frames using ffmpeg (if available)
-                            import shutil
-                            if shutil.which('ffmpeg'):
-                                # Extract first frame
-                                frame_path = tmp_path + '_frame.jpg'
-                                subprocess.run([
-                                    'ffmpeg', '-i', tmp_path, '-vframes', '1', '-q:v', '2', frame_path
-                                ], capture_output=True, timeout=30)
-                                
-                                # If frame extracted, add to images
-                                import os
-                                if os.path.exists(frame_path):
-                                    with open(frame_path, 'rb') as f:
-                                        frame_bytes = f.read()
-                                    frame_b64 = f"data:image/jpeg;base64,{base64.b64encode(frame_bytes).decode()}"
-                                    uploaded_images_b64.append(frame_b64)
-                                    user_input += " [Frame extracted for analysis]"
-                                    os.remove(frame_path)
-                                
-                                os.remove(tmp_path)
-                            else:
-                                user_input += " [Note: ffmpeg not installed - cannot extract frames]"
-                        except Exception as ve:
-                            user_input += f" [Frame extraction failed: {str(ve)[:50]}]"
-                    
-                    elif file_ext in ['mp3', 'wav', 'm4a', 'ogg', 'flac', 'aac', 'wma', 'aiff']:
-                        # AUDIO: Note for transcription
-                        user_input += f"\n\n[AUDIO: {uploaded.name} - {uploaded.size:,} bytes]"
-                        user_input += "\n(Audio transcription: Use 'transcribe this audio' command if you want me to process it)"
-                    
-                    elif file_ext in ['xlsx', 'xls']:
-                        # EXCEL: Parse spreadsheet
-                        try:
-                            import pandas as pd
-                            uploaded.seek(0)
-                            df = pd.read_excel(uploaded, engine='openpyxl' if file_ext == 'xlsx' else 'xlrd')
-                            user_input += f"\n\n[EXCEL: {uploaded.name}]\n"
-                            user_input += f"Columns: {list(df.columns)}\n"
-                            user_input += f"Rows: {len(df)}\n"
-                            user_input += f"```\n{df.to_string()}\n```"
-                        except Exception as ee:
-                            user_input += f"\n\n[EXCEL: {uploaded.name} - Could not parse: {str(ee)[:50]}]"
-                    
-                    elif file_ext == 'csv':
-                        # CSV: Parse and show
-                        try:
-                            import pandas as pd
-                            uploaded.seek(0)
-                            df = pd.read_csv(uploaded)
-                            user_input += f"\n\n[CSV: {uploaded.name}]\n"
-                            user_input += f"Columns: {list(df.columns)}\n"
-                            user_input += f"Rows: {len(df)}\n"
-                            user_input += f"```\n{df.to_string()}\n```"
-                        except Exception as ce:
-                            user_input += f"\n\n[CSV: {uploaded.name} - Could not parse: {str(ce)[:50]}]"
-                    
-                    elif file_ext in ['docx']:
-                        # WORD: Extract text
-                        try:
-                            from docx import Document
-                            uploaded.seek(0)
-                            doc = Document(uploaded)
-                            doc_text = "\n".join([p.text for p in doc.paragraphs])
-                            user_input += f"\n\n[WORD: {uploaded.name}]\n```\n{doc_text}\n```"
-                        except Exception as we:
-                            user_input += f"\n\n[WORD: {uploaded.name} - Could not parse: {str(we)[:50]}]"
-                    
-                    elif file_ext in ['pptx']:
-                        # POWERPOINT: Extract text from slides
-                        try:
-                            from pptx import Presentation
-                            uploaded.seek(0)
-                            ppt = Presentation(uploaded)
-                            slides_text = []
-                            for i, slide in enumerate(ppt.slides[:20]):
-                                slide_text = f"--- Slide {i+1} ---\n"
-                                for shape in slide.shapes:
-                                    if hasattr(shape, "text"):
-                                        slide_text += shape.text + "\n"
-                                slides_text.append(slide_text)
-                            user_input += f"\n\n[POWERPOINT: {uploaded.name}]\n```\n{chr(10).join(slides_text)}\n```"
-                        except Exception as pe:
-                            user_input += f"\n\n[POWERPOINT: {uploaded.name} - Could not parse: {str(pe)[:50]}]"
-                    
-                    elif file_ext == 'ipynb':
-                        # JUPYTER: Extract code cells
-                        try:
-                            uploaded.seek(0)
-                            nb = json.loads(uploaded.read().decode('utf-8'))
-                            cells = []
-                            for cell in nb.get('cells', [])[:30]:
-                                if cell.get('cell_type') == 'code':
-                                    cells.append("```python\n" + "".join(cell.get('source', [])) + "\n```")
-                                elif cell.get('cell_type') == 'markdown':
-                                    cells.append("".join(cell.get('source', [])))
-                            user_input += f"\n\n[JUPYTER: {uploaded.name}]\n" + "\n\n".join(cells)
-                        except Exception as je:
-                            user_input += f"\n\n[JUPYTER: {uploaded.name} - Could not parse: {str(je)[:50]}]"
-                    
-                    elif file_ext in ['zip', 'tar', 'gz', 'rar', '7z']:
-                        # For archives, just note them
-                        user_input += f"\n\n[ARCHIVE: {uploaded.name} - {uploaded.size:,} bytes]"
-                    
-                    else:
-                        # Read as text - larger limit for code files
-                        uploaded.seek(0)
-                        try:
-                            file_text = uploaded.read().decode('utf-8', errors='ignore')
-                        except:
-                            file_text = str(uploaded.read())
-                        
-                        # Detect language for syntax highlighting
-                        lang_map = {
-                            'py': 'python', 'js': 'javascript', 'ts': 'typescript', 'jsx': 'jsx', 'tsx': 'tsx',
-                            'java': 'java', 'c': 'c', 'cpp': 'cpp', 'h': 'c', 'cs': 'csharp', 'go': 'go',
-                            'rs': 'rust', 'rb': 'ruby', 'php': 'php', 'swift': 'swift', 'kt': 'kotlin',
-                            'html': 'html', 'css': 'css', 'scss': 'scss', 'json': 'json', 'xml': 'xml',
-                            'yaml': 'yaml', 'yml': 'yaml', 'sql': 'sql', 'md': 'markdown', 'sh': 'bash'
-                        }
-                        lang = lang_map.get(file_ext, '')
-                        
-                        # NO LIMIT - AI sees complete files!
-                        user_input += f"\n\n[FILE: {uploaded.name}]\n```{lang}\n{file_text}\n```"
-                            
-                except Exception as e:
-                    user_input += f"\n\n[FILE ERROR: {uploaded.name} - {str(e)}]"
+        if uploaded_files and not regenerating:
+            # Parsed in parallel worker processes; re-attached files come from the parse cache.
+            # File objects (not getvalue() copies) so large text uploads stream straight to the file store.
+            parsed = council.parse_uploads([(u.name, u.type, u) for u in uploaded_files], user_id)
+            for result in parsed:
+                user_input += result["text"]
+                uploaded_images_b64.extend(result["images"])
+                streamed_files.extend(result.get("files", []))
         
         # CACHE FILES: Store files for efficient follow-up messages
-        # Extract file info and cache it
+        # Streamed files are already in the store - register them directly; inlined ones are extracted
+        if streamed_files:
+            council.cache_files(st.session_state.session_id, streamed_files)
         import re
         file_matches = re.findall(r'\[FILE: ([^\]]+)\]\n```[^\n]*\n([\s\S]*?)```', user_input)
         if file_matches:
@@ -1178,14 +1078,11 @@ with col1:
             if uploaded_images_b64:
                 st.caption(f"📷 {len(uploaded_images_b64)} image(s) attached")
         
-        # Use ALL uploaded images OR screenshot (combine into single for now, vision API takes first)
-        # Note: Claude's vision API can handle multiple images - we join them
+        # Use ALL uploaded images (incl. video keyframes) OR screenshot - one multi-image vision request
         if uploaded_images_b64:
-            # For multiple images, we'll use the first one for now (API limitation)
-            # but add note about others
-            screenshot = uploaded_images_b64[0]
-            if len(uploaded_images_b64) > 1:
-                user_input += f"\n\n[Note: {len(uploaded_images_b64)} images attached, analyzing first image]"
+            screenshot = uploaded_images_b64[:council.VISION_MAX_IMAGES]
+            if len(uploaded_images_b64) > council.VISION_MAX_IMAGES:
+                user_input += f"\n\n[Note: {len(uploaded_images_b64)} images attached, analyzing the first {council.VISION_MAX_IMAGES}]"
         else:
             screenshot = st.session_state.get("screenshot")
         st.session_state.screenshot = None
@@ -1196,7 +1093,7 @@ with col1:
                 final_agent = None
                 intermediate_responses = []
                 
-                for agent, content, msg_type in council.run_council("Neon", user_input, st.session_state.session_id, user_id, screenshot):
+                for agent, content, msg_type in council.run_council("Neon", user_input, st.session_state.session_id, user_id, screenshot, use_cache=not regenerating):
                     if msg_type == "system":
                         st.markdown(f"🔔 {content}")
                     elif msg_type == "image":
@@ -0,0 +1,232 @@
+"""
+╔══════════════════════════════════════════════════════════════════════════════╗
+║                    NEURAL COUNCIL - OFFLINE BENCHMARKS                       ║
+╚══════════════════════════════════════════════════════════════════════════════╝
+
+Offline accuracy / latency checks for council subsystems.
+
+Usage:
+    python benchmarks.py router
+    python benchmarks.py quantization
+    python benchmarks.py local_embedder
+"""
+
+import os
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+import council
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# HELPERS
+# ═══════════════════════════════════════════════════════════════════════════════
+
+def _percentiles(samples_ms: List[float]) -> str:
+    if not samples_ms:
+        return "n/a"
+    arr = np.asarray(samples_ms)
+    return f"p50={np.percentile(arr, 50):.3f}ms p95={np.percentile(arr, 95):.3f}ms max={arr.max():.3f}ms"
+
+
+def _timed(fn: Callable, *args) -> Tuple[object, float]:
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# ROUTER - embedding router vs keyword classify_query
+# ═══════════════════════════════════════════════════════════════════════════════
+
+# Held-out set (NOT in council.ROUTER_EXAMPLES). Includes known keyword misroutes.
+ROUTER_EVAL_SET: List[Tuple[str, str]] = [
+    ("hey!", "simple"),
+    ("thank you so much", "simple"),
+    ("what day is it today", "simple"),
+    ("good night council", "simple"),
+    ("what's the margin of error in a poll of 1000 people?", "research"),
+    ("what is the object of the game of chess?", "simple"),
+    ("is there an error in my reasoning that all swans are white?", "reasoning"),
+    ("write a bash script that backs up my home folder nightly", "code"),
+    ("my flask app returns 500 on POST requests", "code"),
+    ("add pagination to this SQLAlchemy query", "code"),
+    ("what's the difference between a list and a tuple in python", "code"),
+    ("write a haiku about autumn leaves", "creative"),
+    ("create a villain backstory for my D&D campaign", "creative"),
+    ("give me a funny toast for my brother's wedding", "creative"),
+    ("what are the latest trends in renewable energy investment", "research"),
+    ("compare PostgreSQL and MongoDB adoption in startups", "research"),
+    ("summarize the evidence on screen time and teen mental health", "research"),
+    ("why do cats purr", "reasoning"),
+    ("explain why correlation does not imply causation", "reasoning"),
+    ("can a machine ever be conscious?", "reasoning"),
+    ("how should I budget a $3000 monthly salary", "general"),
+    ("suggest a weekend itinerary for Lisbon", "general"),
+    ("how do I get better sleep", "general"),
+    ("help me write a cover letter for a barista job", "general"),
+]
+
+
+def bench_router() -> Dict[str, float]:
+    """Accuracy + latency of route_query vs the keyword baseline on ROUTER_EVAL_SET."""
+    def keyword(text: str) -> str:
+        return 'simple' if council.is_simple_query(text) else council.classify_query(text)
+
+    keyword_hits = sum(1 for text, label in ROUTER_EVAL_SET if keyword(text) == label)
+    print(f"Keyword baseline accuracy: {keyword_hits}/{len(ROUTER_EVAL_SET)} "
+          f"({keyword_hits / len(ROUTER_EVAL_SET):.0%})")
+
+    if not council._load_router_centroids():
+        print("Embedding router unavailable (set AZURE_API_KEY) - keyword baseline only.")
+        return {"keyword_accuracy": keyword_hits / len(ROUTER_EVAL_SET)}
+
+    cold_ms, warm_ms, hits = [], [], 0
+    for text, label in ROUTER_EVAL_SET:
+        (route, confidence), elapsed = _timed(council.route_query, text)
+        cold_ms.append(elapsed)
+        _, elapsed = _timed(council.route_query, text)
+        warm_ms.append(elapsed)
+        hits += route == label
+        marker = "✓" if route == label else "✗"
+        print(f"  {marker} {route:<10} ({confidence:.2f}) expected {label:<10} | {text[:60]}")
+
+    print(f"Embedding router accuracy: {hits}/{len(ROUTER_EVAL_SET)} ({hits / len(ROUTER_EVAL_SET):.0%})")
+    print(f"Latency cold (embedding call): {_percentiles(cold_ms)}")
+    print(f"Latency warm (cached embedding): {_percentiles(warm_ms)}")
+    return {
+        "keyword_accuracy": keyword_hits / len(ROUTER_EVAL_SET),
+        "router_accuracy": hits / len(ROUTER_EVAL_SET),
+        "warm_p50_ms": float(np.percentile(warm_ms, 50)),
+    }
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# QUANTIZATION - recall@k vs memory/latency for the local memory index
+# ═══════════════════════════════════════════════════════════════════════════════
+
+def _synthetic_memories(n: int, dim: int, clusters: int = 200, seed: int = 7) -> np.ndarray:
+    """Clustered unit vectors - closer to real embedding geometry than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    return council._normalize(vectors)
+
+
+def _index_bytes(index: Dict) -> int:
+    """Resident bytes (the memory-mapped full-precision copy is paged in on demand, not counted)."""
+    if index["quantization"] == "none":
+        return index["full"].nbytes
+    if index["quantization"] == "binary":
+        return index["bits"].nbytes
+    return index["codes"].nbytes + index["scales"].nbytes
+
+
+def bench_quantization(n: int = 20000, queries: int = 200, k: int = 10) -> Dict[str, float]:
+    """recall@k (vs exact float32 brute force), resident memory and query latency per quantization mode."""
+    dim = council.EMBEDDING_DIMENSIONS
+    vectors = _synthetic_memories(n, dim)
+    rng = np.random.default_rng(11)
+    targets = rng.integers(0, n, queries)
+    qs = council._normalize(vectors[targets] + 0.5 * rng.standard_normal((queries, dim)).astype(np.float32) / np.sqrt(dim) * 8)
+    truth = [set(np.argsort(-(vectors @ q))[:k]) for q in qs]
+    contents = [str(i) for i in range(n)]
+
+    results = {}
+    print(f"{n:,} memories x {dim} dims, {queries} queries, recall@{k}")
+    for mode in ["none", "int8", "binary"]:
+        index = council._build_memory_index(f"bench-{mode}", vectors, contents, quantization=mode)
+        latencies, recall = [], 0.0
+        for q, expected in zip(qs, truth):
+            hits, elapsed = _timed(council._memory_search, index, q, k)
+            latencies.append(elapsed)
+            recall += len({row for row, _ in hits} & expected) / k
+        recall /= queries
+        mb = _index_bytes(index) / 1e6
+        print(f"  {mode:<7} recall@{k}={recall:.3f}  resident={mb:7.1f}MB ({_index_bytes(index) / n:,.0f} B/memory)  {_percentiles(latencies)}")
+        results[f"{mode}_recall"] = recall
+        results[f"{mode}_mb"] = mb
+        if index.get("path"):
+            os.remove(index["path"])
+    return results
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+# LOCAL EMBEDDER - offline n-gram embedder vs API embeddings on memory recall
+# ═══════════════════════════════════════════════════════════════════════════════
+
+# Memories in the format save_memory writes, each with a paraphrased recall query
+MEMORY_EVAL_SET: List[Tuple[str, str]] = [
+    ("Q: how do I reverse a list in python\nA: Use reversed() or slicing with [::-1].", "reversing python lists"),
+    ("Q: best pizza dough recipe\nA: Flour, water, yeast, salt - cold ferment for 48 hours.", "how to make dough for pizza"),
+    ("Q: explain quantum entanglement\nA: Entangled particles share one quantum state.", "what is entanglement in quantum physics"),
+    ("Q: when is the US tax filing deadline\nA: Usually April 15.", "when are taxes due"),
+    ("Q: fix CORS error in my express server\nA: Add the cors middleware and allow your origin.", "express cors errors"),
+    ("Q: write a haiku about the ocean\nA: Waves fold into foam...", "ocean haiku"),
+    ("Q: how many calories in an avocado\nA: About 240 calories for a medium avocado.", "avocado calorie count"),
+    ("Q: difference between TCP and UDP\nA: TCP is reliable and ordered; UDP is connectionless.", "tcp vs udp"),
+    ("Q: my dog keeps barking at night\nA: Check for boredom, anxiety or noises; add evening exercise.", "dog barks all night"),
+    ("Q: how to center a div in CSS\nA: display:flex; justify-content:center; align-items:center.", "centering a div with css"),
+    ("Q: what causes inflation\nA: Demand outpacing supply, cost pushes and money supply growth.", "why does inflation happen"),
+    ("Q: plan a trip to Kyoto\nA: Day 1 Fushimi Inari, day 2 Arashiyama bamboo grove...", "kyoto itinerary"),
+    ("Q: how do I learn Rust\nA: Start with The Rust Book, then Rustlings exercises.", "learning rust programming"),
+    ("Q: resume tips for software engineers\nA: Lead with impact, quantify results, keep it to one page.", "software engineer resume advice"),
+    ("Q: how to cook rice on the stove\nA: 1:1.5 rice to water, simmer covered 18 minutes.", "stovetop rice"),
+    ("Q: git undo last commit\nA: git reset --soft HEAD~1 keeps your changes staged.", "undo my last git commit"),
+]
+UNRELATED_QUERIES = ["best hiking boots for winter", "how does photosynthesis work", "translate hello into french",
+                     "who won the 1998 world cup"]
+
+
+def _recall_at(scores: np.ndarray, k: int) -> float:
+    """scores[q, m]: query q's target memory is m == q."""
+    ranks = np.argsort(-scores, axis=1)[:, :k]
+    return float(np.mean([q in ranks[q] for q in range(len(scores))]))
+
+
+def bench_local_embedder() -> Dict[str, float]:
+    """recall@1/@3, best-unrelated similarity and embed latency: local n-gram embedder vs API embeddings."""
+    memories = [m for m, _ in MEMORY_EVAL_SET]
+    queries = [q for _, q in MEMORY_EVAL_SET]
+    embedder = council.LocalEmbedder(council.EMBEDDING_DIMENSIONS)
+    embedder.fit(memories)
+
+    latencies = [_timed(embedder.embed, [m])[1] for m in memories]
+    local_scores = embedder.embed(queries) @ embedder.embed(memories).T
+    unrelated = float((embedder.embed(UNRELATED_QUERIES) @ embedder.embed(memories).T).max())
+    matched = np.diag(local_scores)
+    results = {"local_recall@1": _recall_at(local_scores, 1), "local_recall@3": _recall_at(local_scores, 3)}
+    print(f"Local n-gram: recall@1={results['local_recall@1']:.2f} recall@3={results['local_recall@3']:.2f} "
+          f"matched sim mean={matched.mean():.2f} min={matched.min():.2f} | max unrelated sim={unrelated:.2f} "
+          f"(recall threshold {council.MEMORY_LOCAL_THRESHOLD})")
+    print(f"Local embed latency: {_percentiles(latencies)}")
+
+    api = council.get_embeddings(memories + queries)
+    if not api:
+        print("API embeddings unavailable (set AZURE_API_KEY) - local results only.")
+        return results
+    api = council._normalize(np.asarray(api, dtype=np.float32))
+    api_scores = api[len(memories):] @ api[:len(memories)].T
+    results.update({"api_recall@1": _recall_at(api_scores, 1), "api_recall@3": _recall_at(api_scores, 3)})
+    print(f"API embeddings: recall@1={results['api_recall@1']:.2f} recall@3={results['api_recall@3']:.2f}")
+    return results
+
+
+BENCHMARKS = {
+    "router": bench_router,
+    "quantization": bench_quantization,
+    "local_embedder": bench_local_embedder,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name} (available: {', '.join(BENCHMARKS)})")
+            continue
+        print(f"\n═══ {name.upper()} ═══")
+        BENCHMARKS[name]()
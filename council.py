@@ -20,11 +20,18 @@ import hashlib
 import time
 import re
 import json
+import uuid
+import zlib
 import base64
+import atexit
+import threading
 import concurrent.futures
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 from datetime import datetime, timezone
-from typing import Generator, List, Dict, Optional, Tuple
+from typing import BinaryIO, Generator, List, Dict, Optional, Tuple, Union
 from dotenv import load_dotenv
+import numpy as np
 import requests
 from bs4 import BeautifulSoup
 
@@ -38,14 +45,28 @@ AZURE_API_KEY = os.getenv("AZURE_API_KEY", "")
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN", "")
 ANTHROPIC_ENDPOINT = "https://polyprophet-resource.openai.azure.com/anthropic/v1/messages"
 OPENAI_ENDPOINT = "https://polyprophet-resource.cognitiveservices.azure.com/openai/deployments"
+CACHE_DIR = os.getenv("COUNCIL_CACHE_DIR", ".council_cache")  # Local on-disk caches (router centroids, ...)
 
 _total_tokens_used = 0
 
 # FILE CACHE - Stores uploaded files separately to avoid resending every message
-# Structure: {session_id: [{name: str, content: str, timestamp: float}, ...]}
-_file_cache: Dict[str, List[Dict]] = {}
+# Content-addressed: identical uploads (any session, any user) share one blob.
+# Blobs are written to disk on arrival; RAM holds an LRU of decoded text under a global byte budget.
+# Structure: {session_id: {"files": [{name, sha256, size, chars, timestamp}], "touched": float}}
+_file_cache: Dict[str, Dict] = {}
+# {sha256: {"text": str or None, "size": int, "refs": int, "on_disk": bool}} - LRU order = RAM recency
+_file_blobs: "OrderedDict[str, Dict]" = OrderedDict()
+_file_ram_bytes = 0
+_file_lock = threading.RLock()
+_file_last_prune = 0.0
+_file_last_sweep = 0.0  # 0 = sweep on the first prune after startup
 MAX_CACHED_FILES = 10  # Max files to keep per session
 FILES_TO_SEND_FULL = 3  # Always send last N files in full context
+FILE_CACHE_MAX_BYTES = int(os.getenv("COUNCIL_FILE_CACHE_MB", "256")) * 1024 * 1024  # RAM budget (all sessions)
+FILE_SESSION_TTL = 6 * 3600  # Seconds before an idle session's files are released
+FILE_PRUNE_INTERVAL = 60  # Seconds between idle-session sweeps
+FILE_SPILL_DIR = os.path.join(CACHE_DIR, "files")
+FILE_ORPHAN_SWEEP_INTERVAL = 3600  # Seconds between sweeps of unreferenced blobs on disk (refcounts are in-process only)
 
 def get_tokens_used() -> int:
     return _total_tokens_used
@@ -54,68 +75,2171 @@ def reset_tokens():
     global _total_tokens_used
     _total_tokens_used = 0
 
+def _file_blob_path(sha: str) -> str:
+    return os.path.join(FILE_SPILL_DIR, sha[:2], sha)
+
+
+def _file_ram_admit(sha: str, text: str):
+    """Put decoded text in the RAM LRU, evicting least-recently-used blobs that are safe on disk."""
+    global _file_ram_bytes
+    blob = _file_blobs[sha]
+    if blob["text"] is None and (blob["size"] <= FILE_CACHE_MAX_BYTES or not blob["on_disk"]):
+        blob["text"] = text
+        _file_ram_bytes += blob["size"]
+    _file_blobs.move_to_end(sha)
+    for other in list(_file_blobs):
+        if _file_ram_bytes <= FILE_CACHE_MAX_BYTES:
+            break
+        victim = _file_blobs[other]
+        if other != sha and victim["text"] is not None and victim["on_disk"]:
+            victim["text"] = None
+            _file_ram_bytes -= victim["size"]
+
+
+def _file_put(content: str) -> Tuple[str, int]:
+    """Store content once by sha256 (disk first, then RAM). Returns (sha256, size in bytes)."""
+    data = content.encode("utf-8", errors="replace")
+    sha = hashlib.sha256(data).hexdigest()
+    with _file_lock:
+        if sha not in _file_blobs:
+            on_disk = False
+            try:
+                path = _file_blob_path(sha)
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path + ".tmp", "wb") as f:
+                        f.write(data)
+                    os.replace(path + ".tmp", path)
+                on_disk = True
+            except Exception as e:
+                print(f"[file store ERROR] Spill failed, keeping in RAM: {str(e)}")
+            _file_blobs[sha] = {"text": None, "size": len(data), "refs": 0, "on_disk": on_disk}
+        _file_ram_admit(sha, content)
+    return sha, len(data)
+
+
+def _file_adopt(path: str, sha: str, size: int) -> bool:
+    """
+    Register an already-written UTF-8 file as the blob for sha (moved into the store, never read
+    into RAM - it is paged in on first use). Returns False if the file could not be stored.
+    """
+    import shutil
+    with _file_lock:
+        target = _file_blob_path(sha)
+        try:
+            if os.path.abspath(path) == os.path.abspath(target):
+                pass  # Blob left on disk by an earlier run
+            elif os.path.exists(target):
+                os.remove(path)  # Identical content already stored
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.move(path, target)
+        except Exception as e:
+            print(f"[file store ERROR] Adopt {sha[:12]} failed: {str(e)}")
+            return False
+        if sha not in _file_blobs:
+            _file_blobs[sha] = {"text": None, "size": size, "refs": 0, "on_disk": True}
+    return True
+
+
+def _file_read(sha: str) -> str:
+    """Full text of a blob: RAM hit, or a memory-mapped read from disk (re-admitted to the LRU)."""
+    with _file_lock:
+        blob = _file_blobs.get(sha)
+        if blob and blob["text"] is not None:
+            _file_blobs.move_to_end(sha)
+            return blob["text"]
+    text = file_read_bytes(sha).decode("utf-8", errors="replace")
+    with _file_lock:
+        if sha in _file_blobs:
+            _file_ram_admit(sha, text)
+    return text
+
+
+def file_read_bytes(sha: str, start: int = 0, end: int = None) -> bytes:
+    """Byte range of a stored blob via mmap - large files are never fully loaded for partial reads."""
+    import mmap
+    try:
+        with open(_file_blob_path(sha), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return mm[start:end]
+    except Exception as e:
+        print(f"[file store ERROR] Read {sha[:12]} failed: {str(e)}")
+        return b""
+
+
+def _file_release(sha: str):
+    """Drop one reference; unreferenced blobs leave RAM and disk."""
+    global _file_ram_bytes
+    blob = _file_blobs.get(sha)
+    if not blob:
+        return
+    blob["refs"] -= 1
+    if blob["refs"] > 0:
+        return
+    if blob["text"] is not None:
+        _file_ram_bytes -= blob["size"]
+    del _file_blobs[sha]
+    try:
+        os.remove(_file_blob_path(sha))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"[file cache ERROR] Could not remove blob {sha[:12]}: {str(e)}")
+
+
+def _drop_session_files(session_id: str):
+    with _file_lock:
+        entry = _file_cache.pop(session_id, None)
+        for f in (entry or {}).get("files", []):
+            _file_release(f["sha256"])
+            if f.get("base"):
+                _file_release(f["base"])
+
+
+def _sweep_orphan_blobs(now: float):
+    """
+    Delete blobs on disk that no session references and that were last written over FILE_SESSION_TTL ago
+    (left by earlier runs, whose refcounts died with the process), plus stale partial writes.
+    """
+    global _file_ram_bytes
+    removed = 0
+    for root, _, names in os.walk(FILE_SPILL_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                if now - os.path.getmtime(path) <= FILE_SESSION_TTL:
+                    continue
+                sha = name[:-len(".tmp")] if name.endswith(".tmp") else name
+                blob = _file_blobs.get(sha)
+                if blob and blob["refs"] > 0 and not name.endswith(".tmp"):
+                    continue
+                os.remove(path)
+                removed += 1
+            except OSError:
+                continue
+            if blob and not name.endswith(".tmp"):
+                if blob["text"] is not None:
+                    _file_ram_bytes -= blob["size"]
+                del _file_blobs[sha]
+    if removed:
+        print(f"[file store] Swept {removed} unreferenced blob(s)")
+
+
+def _prune_idle_sessions():
+    """
+    Release files of sessions idle for FILE_SESSION_TTL (throttled to once per FILE_PRUNE_INTERVAL),
+    and sweep unreferenced blobs on disk once per FILE_ORPHAN_SWEEP_INTERVAL.
+    """
+    global _file_last_prune, _file_last_sweep
+    now = time.time()
+    if now - _file_last_prune < FILE_PRUNE_INTERVAL:
+        return
+    _file_last_prune = now
+    idle = [sid for sid, entry in list(_file_cache.items()) if now - entry["touched"] > FILE_SESSION_TTL]
+    for session_id in idle:
+        _drop_session_files(session_id)
+    if now - _file_last_sweep >= FILE_ORPHAN_SWEEP_INTERVAL:
+        _file_last_sweep = now
+        _sweep_orphan_blobs(now)
+
+
+def _session_files(session_id: str) -> List[Dict]:
+    """File metadata for a session (marks the session as active)."""
+    with _file_lock:
+        _prune_idle_sessions()
+        entry = _file_cache.get(session_id)
+        if not entry:
+            return []
+        entry["touched"] = time.time()
+        return list(entry["files"])
+
+
+def get_file_store_stats() -> Dict:
+    with _file_lock:
+        return {"sessions": len(_file_cache), "blobs": len(_file_blobs),
+                "ram_bytes": _file_ram_bytes, "ram_budget": FILE_CACHE_MAX_BYTES,
+                "disk_bytes": sum(b["size"] for b in _file_blobs.values() if b["on_disk"])}
+
+
 def cache_files(session_id: str, files: List[Dict[str, str]]):
-    """Cache uploaded files for a session. Called when user uploads files."""
-    if session_id not in _file_cache:
-        _file_cache[session_id] = []
-    
-    for f in files:
-        file_name = f.get("name", "unnamed")
-        file_content = f.get("content", "")
-        file_timestamp = datetime.now(timezone.utc).timestamp()
-        
-        # CRITICAL: Replace existing file with same name (don't create duplicate)
-        existing_idx = None
-        for idx, cached in enumerate(_file_cache[session_id]):
-            if cached["name"].lower() == file_name.lower():
-                existing_idx = idx
-                break
+    """
+    Cache uploaded files for a session. Called when user uploads files.
+    Each entry is {"name", "content"}, or {"name", "sha256", "size", "chars"} for a file that
+    streaming ingestion already wrote to the store.
+    """
+    with _file_lock:
+        _prune_idle_sessions()
+        entry = _file_cache.setdefault(session_id, {"files": [], "touched": time.time()})
+        entry["touched"] = time.time()
+        cached_files = entry["files"]
+        sources = []
         
-        if existing_idx is not None:
-            # Update existing file
-            _file_cache[session_id][existing_idx] = {
+        for f in files:
+            file_name = f.get("name", "unnamed")
+            if f.get("sha256"):
+                sha, size, file_content = f["sha256"], f["size"], None
+                if sha not in _file_blobs and not (os.path.exists(_file_blob_path(sha))
+                                                   and _file_adopt(_file_blob_path(sha), sha, size)):
+                    print(f"[cache_files] {file_name}: blob {sha[:12]} no longer in the store")
+                    continue
+            else:
+                file_content = f.get("content", "")
+                sha, size = _file_put(file_content)
+            _file_blobs[sha]["refs"] += 1
+            record = {
                 "name": file_name,
-                "content": file_content,
-                "timestamp": file_timestamp
+                "sha256": sha,
+                "size": size,
+                "chars": len(file_content) if file_content is not None else f["chars"],
+                "timestamp": datetime.now(timezone.utc).timestamp(),
+                "version": 1,
+                "base": None,      # sha256 of the previous version (kept for diffs)
+                "uploads": 1       # Consecutive uploads of this exact content
             }
-        else:
-            # Add new file
-            _file_cache[session_id].append({
-                "name": file_name,
-                "content": file_content,
-                "timestamp": file_timestamp
-            })
+            
+            # CRITICAL: Replace existing file with same name (don't create duplicate)
+            existing_idx = None
+            for idx, cached in enumerate(cached_files):
+                if cached["name"].lower() == file_name.lower():
+                    existing_idx = idx
+                    break
+            
+            if existing_idx is not None:
+                previous = cached_files[existing_idx]
+                if previous["sha256"] == sha:
+                    # Unchanged re-upload: same version, drop the duplicate reference
+                    _file_release(sha)
+                    record.update(version=previous.get("version", 1), base=previous.get("base"),
+                                  uploads=previous.get("uploads", 1) + 1)
+                else:
+                    # New version: the previous one stays referenced as the diff base, the one before it goes
+                    if previous.get("base"):
+                        _file_release(previous["base"])
+                    record.update(version=previous.get("version", 1) + 1, base=previous["sha256"])
+                cached_files[existing_idx] = record
+            else:
+                cached_files.append(record)
+            if file_content is None:
+                # Streamed file: index a prefix straight from disk (the index keeps SEARCH_MAX_BODY_CHARS anyway)
+                file_content = file_read_bytes(sha, 0, SEARCH_MAX_BODY_CHARS).decode("utf-8", errors="ignore")
+            index_document("file", f"{session_id}:{file_name.lower()}", file_name, file_content, session_id=session_id)
+            if "." in file_name and file_name.rsplit(".", 1)[-1].lower() in SYMBOL_LANGUAGES:
+                sources.append((sha, file_name))
+        
+        # Keep only last MAX_CACHED_FILES
+        for dropped in cached_files[:-MAX_CACHED_FILES]:
+            _file_release(dropped["sha256"])
+            if dropped.get("base"):
+                _file_release(dropped["base"])
+        entry["files"] = cached_files[-MAX_CACHED_FILES:]
     
-    # Keep only last MAX_CACHED_FILES
-    if len(_file_cache[session_id]) > MAX_CACHED_FILES:
-        _file_cache[session_id] = _file_cache[session_id][-MAX_CACHED_FILES:]
+    # Symbol indexes are built at upload time (outside the store lock) - queries only look them up
+    for sha, file_name in sources:
+        symbol_index(sha, file_name)
 
 def get_cached_files(session_id: str) -> List[Dict]:
     """Get all cached files for a session."""
-    return _file_cache.get(session_id, [])
+    return [{"name": f["name"], "content": _file_read(f["sha256"]), "timestamp": f["timestamp"]}
+            for f in _session_files(session_id)]
 
 def get_file_references(session_id: str) -> str:
     """Get a summary of cached files (for context without full content)."""
-    files = _file_cache.get(session_id, [])
+    files = _session_files(session_id)
     if not files:
         return ""
     
     refs = ["[AVAILABLE FILES IN THIS SESSION:]"]
     for i, f in enumerate(files):
-        size = len(f["content"])
-        refs.append(f"  {i+1}. {f['name']} ({size:,} chars)")
+        version = f", v{f['version']}" if f.get("version", 1) > 1 else ""
+        refs.append(f"  {i+1}. {f['name']} ({f['chars']:,} chars{version})")
     refs.append("[Use 'show file X' or reference by name to see contents]")
     return "\n".join(refs)
 
 def get_file_by_name(session_id: str, filename: str) -> Optional[str]:
-    """Retrieve a specific cached file by name."""
-    files = _file_cache.get(session_id, [])
+    """Retrieve a specific cached file by name, falling back to a full-text match on contents."""
+    files = _session_files(session_id)
     for f in files:
         if filename.lower() in f["name"].lower():
-            return f"[FILE: {f['name']}]\n```\n{f['content']}\n```"
+            return f"[FILE: {f['name']}]\n```\n{_file_read(f['sha256'])}\n```"
+    for hit in search(filename, session_id=session_id, kinds=["file"], limit=1):
+        for f in files:
+            if f["name"] == hit["title"]:
+                return f"[FILE: {f['name']}]\n```\n{_file_read(f['sha256'])}\n```"
     return None
 
 
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# FILE CHUNK RETRIEVAL - BM25 over line-aligned chunks of cached files (+ local-embedding rerank)
+# Only the chunks relevant to the query are sent, within a character budget
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+FILE_CHUNK_CHARS = 1500          # Target chunk size (chunks end on line boundaries)
+FILE_CHUNK_TOP_K = 8             # Chunks injected per query
+FILE_CONTEXT_BUDGET = 24000      # Max chars of excerpts injected per query (~6K tokens)
+FILE_INLINE_MAX_CHARS = 60000    # Messages larger than this get their inlined files replaced by excerpts
+FILE_CHUNK_RERANK = 30           # BM25 candidates reranked with local embeddings (0 = BM25 only)
+FILE_CHUNK_INDEX_CACHE = 64      # Chunk indexes kept in memory (keyed by content hash, shared across sessions)
+BM25_K1 = 1.2
+BM25_B = 0.75
+FILE_BLOCK_PATTERN = re.compile(r'\[FILE: ([^\]]+)\]\n```[^\n]*\n([\s\S]*?)```')
+PAGE_MARKER_PATTERN = re.compile(r'^\[Page (\d+)\]\s*$')   # Page separators written by the PDF parser
+PAGE_REF_PATTERN = re.compile(r'\bp(?:ages?|p?\.)\s*(\d+)(?:\s*(?:-|–|to|through)\s*(\d+))?', re.I)
+PAGE_RANGE_MAX_CHARS = 40000     # Max chars of explicitly requested pages injected per query
+
+# {sha256: {"postings": {term: (chunk ids, tfs)}, "lengths": tokens per chunk, "offsets": byte offsets,
+#           "lines": start lines, "pages": (first, last) page per chunk, "page_offsets": {page: byte offset}}}
+_chunk_indexes: "OrderedDict[str, Dict]" = OrderedDict()
+_chunk_lock = threading.Lock()
+
+
+def _chunk_tokens(text: str) -> List[str]:
+    """Lowercase word tokens; camelCase and snake_case identifiers split into parts."""
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text)
+    return [t for t in re.findall(r"[a-z0-9]+", text.lower()) if t not in SEARCH_STOPWORDS]
+
+
+def _build_chunk_index(sha: str) -> Dict:
+    """Split a stored file into line-aligned chunks and build its BM25 postings."""
+    text = _file_read(sha)
+    offsets, lines, lengths, pages = [0], [1], [], []
+    postings: Dict[str, Tuple[list, list]] = {}
+    current, current_chars, byte_pos, line_no = [], 0, 0, 1
+    page_offsets: Dict[int, int] = {}
+    page, first_page = 0, 0
+    
+    def flush():
+        counts: Dict[str, int] = {}
+        for token in _chunk_tokens("".join(current)):
+            counts[token] = counts.get(token, 0) + 1
+        for term, tf in counts.items():
+            ids, tfs = postings.setdefault(term, ([], []))
+            ids.append(len(lengths))
+            tfs.append(tf)
+        lengths.append(sum(counts.values()))
+        offsets.append(byte_pos)
+        lines.append(line_no)
+        pages.append((first_page, page))
+    
+    for line in text.splitlines(keepends=True):
+        marker = PAGE_MARKER_PATTERN.match(line) if line.startswith("[Page ") else None
+        if marker:
+            # Prefer page-aligned chunks once a chunk is reasonably full
+            if current_chars >= FILE_CHUNK_CHARS // 2:
+                flush()
+                current, current_chars = [], 0
+            page = int(marker.group(1))
+            page_offsets.setdefault(page, byte_pos)
+        # Minified / single-line files: hard-split long lines
+        pieces = [line[i:i + FILE_CHUNK_CHARS] for i in range(0, len(line), FILE_CHUNK_CHARS)] or [line]
+        for piece in pieces:
+            if not current:
+                first_page = page
+            current.append(piece)
+            current_chars += len(piece)
+            byte_pos += len(piece.encode("utf-8", errors="replace"))
+            line_no += piece.endswith("\n")
+            if current_chars >= FILE_CHUNK_CHARS:
+                flush()
+                current, current_chars = [], 0
+    if current:
+        flush()
+    
+    return {
+        "postings": {t: (np.asarray(ids, dtype=np.int32), np.asarray(tfs, dtype=np.float32)) for t, (ids, tfs) in postings.items()},
+        "lengths": np.asarray(lengths, dtype=np.float32),
+        "offsets": np.asarray(offsets, dtype=np.int64),
+        "lines": np.asarray(lines, dtype=np.int32),
+        "pages": pages,
+        "page_offsets": page_offsets,
+    }
+
+
+def _chunk_index(sha: str) -> Dict:
+    with _chunk_lock:
+        if sha in _chunk_indexes:
+            _chunk_indexes.move_to_end(sha)
+            return _chunk_indexes[sha]
+    index = _build_chunk_index(sha)
+    with _chunk_lock:
+        _chunk_indexes[sha] = index
+        while len(_chunk_indexes) > FILE_CHUNK_INDEX_CACHE:
+            _chunk_indexes.popitem(last=False)
+    return index
+
+
+def _chunk_text(sha: str, index: Dict, chunk: int) -> str:
+    return file_read_bytes(sha, int(index["offsets"][chunk]), int(index["offsets"][chunk + 1])).decode("utf-8", errors="replace")
+
+
+def retrieve_file_chunks(session_id: str, query: str, names: set = None, exclude: set = None,
+                         top_k: int = FILE_CHUNK_TOP_K, budget: int = FILE_CONTEXT_BUDGET) -> List[Dict]:
+    """
+    FILE CHUNK RETRIEVAL: Top chunks across the session's cached files for a query.
+    BM25 candidates are reranked with local embeddings (reciprocal rank fusion); files with no
+    matching chunk contribute their first chunk while budget remains.
+    Returns [{name, start_line, end_line, text, score}] in file/line order.
+    """
+    files = [f for f in _session_files(session_id)
+             if (names is None or f["name"] in names) and not (exclude and f["name"] in exclude)]
+    if not files:
+        return []
+    indexes = [_chunk_index(f["sha256"]) for f in files]
+    terms = list(dict.fromkeys(_chunk_tokens(query)))
+    total = sum(len(ix["lengths"]) for ix in indexes)
+    avgdl = max(float(np.mean(np.concatenate([ix["lengths"] for ix in indexes]))), 1.0) if total else 1.0
+    
+    # BM25 with corpus statistics over every chunk of every selected file
+    df = {t: sum(len(ix["postings"][t][0]) for ix in indexes if t in ix["postings"]) for t in terms}
+    pool = max(top_k, FILE_CHUNK_RERANK)
+    candidates = []
+    for fi, ix in enumerate(indexes):
+        scores = np.zeros(len(ix["lengths"]), dtype=np.float32)
+        for t in terms:
+            if t not in ix["postings"]:
+                continue
+            ids, tfs = ix["postings"][t]
+            idf = np.log(1 + (total - df[t] + 0.5) / (df[t] + 0.5))
+            scores[ids] += idf * tfs * (BM25_K1 + 1) / (tfs + BM25_K1 * (1 - BM25_B + BM25_B * ix["lengths"][ids] / avgdl))
+        hits = np.nonzero(scores)[0]
+        candidates.extend((float(scores[i]), fi, int(i)) for i in hits[np.argsort(-scores[hits])[:pool]])
+    candidates.sort(reverse=True)
+    candidates = [{"score": s, "file": fi, "chunk": c, "text": _chunk_text(files[fi]["sha256"], indexes[fi], c)}
+                  for s, fi, c in candidates[:pool]]
+    
+    if FILE_CHUNK_RERANK and len(candidates) > top_k:
+        # Chunk vectors are computed once per chunk and kept on the (shared) chunk index
+        for c in candidates:
+            vectors = indexes[c["file"]].setdefault("vectors", {})
+            if c["chunk"] not in vectors:
+                vectors[c["chunk"]] = local_embedding(c["text"])
+        sims = np.stack([indexes[c["file"]]["vectors"][c["chunk"]] for c in candidates]) @ local_embedding(query)
+        sim_rank = {i: r for r, i in enumerate(np.argsort(-sims))}
+        for bm25_rank, c in enumerate(candidates):
+            c["score"] = 1 / (60 + bm25_rank) + 1 / (60 + sim_rank[bm25_rank])
+        candidates.sort(key=lambda c: -c["score"])
+    
+    selected, used = [], 0
+    for c in candidates[:top_k]:
+        if used + len(c["text"]) <= budget:
+            selected.append(c)
+            used += len(c["text"])
+    covered = {c["file"] for c in selected}
+    for fi, ix in enumerate(indexes):
+        if fi not in covered and len(ix["lengths"]):
+            head = {"score": 0.0, "file": fi, "chunk": 0, "text": _chunk_text(files[fi]["sha256"], ix, 0)}
+            if used + len(head["text"]) <= budget:
+                selected.append(head)
+                used += len(head["text"])
+    
+    selected.sort(key=lambda c: (c["file"], c["chunk"]))
+    return [{"name": files[c["file"]]["name"], "start_line": int(indexes[c["file"]]["lines"][c["chunk"]]),
+             "end_line": max(int(indexes[c["file"]]["lines"][c["chunk"]]), int(indexes[c["file"]]["lines"][c["chunk"] + 1]) - 1),
+             "pages": indexes[c["file"]]["pages"][c["chunk"]], "text": c["text"], "score": c["score"]}
+            for c in selected]
+
+
+def format_file_chunks(chunks: List[Dict]) -> str:
+    parts = ["[RELEVANT FILE EXCERPTS]:"]
+    for c in chunks:
+        first, last = c.get("pages") or (0, 0)
+        where = f"pages {first}-{last}" if first and last > first else f"page {last}" if last else f"lines {c['start_line']}-{c['end_line']}"
+        parts.append(f"[FILE: {c['name']} | {where}]\n```\n{c['text'].rstrip()}\n```")
+    return "\n".join(parts)
+
+
+def page_ranges(text: str) -> List[Tuple[int, int]]:
+    """Page references in free text ("page 12", "pages 40-45", "pp. 3 to 7") -> [(first, last)]."""
+    ranges = []
+    for match in PAGE_REF_PATTERN.finditer(text):
+        first = int(match.group(1))
+        last = int(match.group(2)) if match.group(2) else first
+        if first > 0:
+            ranges.append((min(first, last), max(first, last)))
+    return ranges
+
+
+def get_file_pages(session_id: str, name: str, first: int, last: int) -> Optional[str]:
+    """
+    PAGE RANGE: Text of pages first..last of a cached paged document (PDF), read straight
+    from the file store by byte offset. None if the file is unknown or has no page index.
+    """
+    target = next((f for f in _session_files(session_id) if f["name"].lower() == name.strip().lower()), None)
+    if target is None:
+        return None
+    page_offsets = _chunk_index(target["sha256"])["page_offsets"]
+    if not page_offsets:
+        return None
+    first, last = max(first, min(page_offsets)), min(last, max(page_offsets))
+    if first > last:
+        return ""
+    starts = [page_offsets[p] for p in sorted(page_offsets) if p >= first]
+    after = [page_offsets[p] for p in sorted(page_offsets) if p > last]
+    text = file_read_bytes(target["sha256"], starts[0], after[0] if after else None).decode("utf-8", errors="replace")
+    if len(text) > PAGE_RANGE_MAX_CHARS:
+        text = text[:PAGE_RANGE_MAX_CHARS] + "\n... (truncated - request a narrower page range)"
+    return text
+
+
+def page_range_context(session_id: str, query: str) -> Tuple[str, set]:
+    """
+    Pages the query names explicitly, from the session's paged documents (only the documents the
+    query mentions by name, when it mentions any). Returns (context block, names served).
+    """
+    ranges = page_ranges(query)
+    if not ranges:
+        return "", set()
+    paged = [f for f in _session_files(session_id) if _chunk_index(f["sha256"])["page_offsets"]]
+    named = [f for f in paged if f["name"].lower() in query.lower()]
+    parts, served, used = [], set(), 0
+    for f in named or paged:
+        for first, last in ranges:
+            text = get_file_pages(session_id, f["name"], first, last)
+            if not text or used + len(text) > PAGE_RANGE_MAX_CHARS:
+                continue
+            label = f"pages {first}-{last}" if last > first else f"page {first}"
+            parts.append(f"[FILE: {f['name']} | {label}]\n```\n{text.rstrip()}\n```")
+            served.add(f["name"])
+            used += len(text)
+    if not parts:
+        return "", set()
+    return "[REQUESTED PAGES]:\n" + "\n".join(parts), served
+
+
+def read_file_pages(session_id: str, request: str) -> str:
+    """[PDF_PAGES: name | 12-15] command -> context block (request is "name|first-last")."""
+    name, _, span = request.rpartition("|")
+    ranges = page_ranges(f"pages {span}")
+    if not ranges:
+        return f"[PDF_PAGES ERROR] can't parse page range '{span}'"
+    first, last = ranges[0]
+    text = get_file_pages(session_id, name, first, last)
+    if text is None:
+        return f"[PDF_PAGES ERROR] {name.strip()} is not a cached paged document"
+    return f"[FILE: {name.strip()} | pages {first}-{last}]\n```\n{text.rstrip()}\n```"
+
+
+def compact_inline_files(session_id: str, text: str) -> Tuple[str, int]:
+    """
+    Oversized message: replace inlined cached files with their query-relevant excerpts.
+    Returns (text, number of files compacted).
+    """
+    if len(text) <= FILE_INLINE_MAX_CHARS:
+        return text, 0
+    cached = {f["name"] for f in _session_files(session_id)}
+    names = {name for name, _ in FILE_BLOCK_PATTERN.findall(text) if name in cached}
+    if not names:
+        return text, 0
+    
+    query = FILE_BLOCK_PATTERN.sub("", text).strip()
+    compacted = FILE_BLOCK_PATTERN.sub(
+        lambda m: f"[FILE: {m.group(1)} - {len(m.group(2)):,} chars, relevant excerpts below]" if m.group(1) in names else m.group(0),
+        text)
+    compacted += "\n\n" + format_file_chunks(retrieve_file_chunks(session_id, query, names=names))
+    if len(compacted) >= len(text):
+        return text, 0
+    return compacted, len(names)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# FILE VERSIONS - Re-uploaded files are sent as a line diff against the cached previous version
+# The full new version stays in the file store (excerpts, symbols and pages still come from it)
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+FILE_DELTA_MIN_CHARS = 4000      # Smaller re-uploads are always inlined whole
+FILE_DELTA_MAX_RATIO = 0.5       # The diff replaces the file only if it is at most this fraction of its size
+FILE_DELTA_CONTEXT_LINES = 3     # Unchanged lines around each hunk
+FILE_DIFF_CACHE = 32             # Diffs kept in memory (keyed by base + new content hash)
+
+_file_diffs: "OrderedDict[Tuple[str, str], List[str]]" = OrderedDict()
+_file_diff_lock = threading.Lock()
+
+
+def file_diff_hunks(base_sha: str, sha: str) -> List[str]:
+    """Unified-diff hunk lines (no ---/+++ header) from blob base_sha to blob sha."""
+    import difflib
+    key = (base_sha, sha)
+    with _file_diff_lock:
+        if key in _file_diffs:
+            _file_diffs.move_to_end(key)
+            return _file_diffs[key]
+    old, new = _file_read(base_sha).splitlines(), _file_read(sha).splitlines()
+    hunks = list(difflib.unified_diff(old, new, n=FILE_DELTA_CONTEXT_LINES, lineterm=""))[2:]
+    with _file_diff_lock:
+        _file_diffs[key] = hunks
+        while len(_file_diffs) > FILE_DIFF_CACHE:
+            _file_diffs.popitem(last=False)
+    return hunks
+
+
+def delta_inline_files(session_id: str, text: str) -> Tuple[str, List[str]]:
+    """
+    Re-uploaded files inlined in a message: an unchanged file becomes a reference to the cached copy,
+    a new version becomes its diff against the previous one (when that is much smaller).
+    Returns (text, names no longer inlined in full).
+    """
+    versions = {f["name"]: f for f in _session_files(session_id) if f.get("base") or f.get("uploads", 1) > 1}
+    if not versions:
+        return text, []
+    delta_names = []
+    
+    def replace(m) -> str:
+        name, body = m.group(1), m.group(2)
+        f = versions.get(name)
+        if not f or len(body) < FILE_DELTA_MIN_CHARS:
+            return m.group(0)
+        if hashlib.sha256(body.encode("utf-8", errors="replace")).hexdigest() != f["sha256"]:
+            return m.group(0)   # Edited after upload - not the cached version
+        ref = f"v{f['version']}, sha256={f['sha256'][:12]}, {f['chars']:,} chars cached"
+        if f.get("uploads", 1) > 1:
+            delta_names.append(name)
+            return f"[FILE: {name} - unchanged since last upload | {ref}; relevant excerpts are retrieved from the cached copy]"
+        try:
+            hunks = file_diff_hunks(f["base"], f["sha256"])
+        except Exception as e:
+            print(f"[delta_inline_files ERROR] {name}: {str(e)}")
+            return m.group(0)
+        diff = "\n".join(hunks)
+        if not hunks or len(diff) > len(body) * FILE_DELTA_MAX_RATIO:
+            return m.group(0)
+        added = sum(1 for line in hunks if line.startswith("+"))
+        removed = sum(1 for line in hunks if line.startswith("-"))
+        delta_names.append(name)
+        return (f"[FILE: {name} | {ref} - diff vs v{f['version'] - 1} (sha256={f['base'][:12]}): "
+                f"+{added} -{removed} lines]\n```diff\n{diff}\n```")
+    
+    return FILE_BLOCK_PATTERN.sub(replace, text), delta_names
+
+
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# SYMBOL INDEX - Functions / classes / methods with line spans, call names and imports per source file
+# Python via ast, JS/TS via regex + brace matching; queries get the named symbols, their callers and callees
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+SYMBOL_LANGUAGES = {"py": "python", "pyi": "python", "js": "js", "jsx": "js", "mjs": "js", "cjs": "js", "ts": "js", "tsx": "js"}
+SYMBOL_MAX_FILE_BYTES = 2 * 1024 * 1024   # Larger sources are left to chunk retrieval
+SYMBOL_MAX_TARGETS = 4           # Symbols named by the query that are injected in full
+SYMBOL_MAX_RELATED = 6           # Callers + callees injected per query
+SYMBOL_CONTEXT_BUDGET = 16000    # Max chars of symbol source per query (taken out of the excerpt budget)
+SYMBOL_INDEX_CACHE = 128         # Symbol indexes kept in memory (keyed by content hash)
+
+JS_KEYWORDS = {"if", "for", "while", "switch", "catch", "return", "function", "typeof", "new", "await", "import",
+               "require", "super", "constructor", "else", "do", "try", "with", "delete", "void", "yield", "async"}
+_JS_DEFINITION_PATTERNS = [
+    ("function", re.compile(r'^[ \t]*(?:export\s+)?(?:default\s+)?(?:async\s+)?function\s*\*?\s*([A-Za-z_$][\w$]*)\s*[<(]', re.M)),
+    ("class", re.compile(r'^[ \t]*(?:export\s+)?(?:default\s+)?(?:abstract\s+)?class\s+([A-Za-z_$][\w$]*)', re.M)),
+    ("function", re.compile(r'^[ \t]*(?:export\s+)?(?:const|let|var)\s+([A-Za-z_$][\w$]*)\s*(?::[^=]+)?=\s*(?:async\s+)?(?:function\b|(?:\([^)]*\)|[A-Za-z_$][\w$]*)\s*(?::[^=]+)?=>)', re.M)),
+    ("method", re.compile(r'^[ \t]+(?:(?:public|private|protected|static|async|readonly|override|get|set)\s+)*([A-Za-z_$][\w$]*)\s*(?:<[^>]*>)?\([^)]*\)\s*(?::[^{]+)?\{', re.M)),
+]
+_JS_IMPORT_PATTERN = re.compile(r'''(?:import\s[^'"]*?from\s*|import\s*\(?\s*|require\s*\(\s*)['"]([^'"]+)['"]''')
+
+_symbol_indexes: "OrderedDict[str, Dict]" = OrderedDict()
+_symbol_lock = threading.Lock()
+
+
+def _python_symbols(text: str) -> Tuple[List[Dict], List[str]]:
+    import ast
+    tree = ast.parse(text)
+    symbols, imports = [], []
+    
+    def calls_in(node) -> List[str]:
+        names = set()
+        for sub in ast.walk(node):
+            if isinstance(sub, ast.Call):
+                if isinstance(sub.func, ast.Name):
+                    names.add(sub.func.id)
+                elif isinstance(sub.func, ast.Attribute):
+                    names.add(sub.func.attr)
+        return sorted(names)
+    
+    def visit(node, parent: str = None):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                kind = "class" if isinstance(child, ast.ClassDef) else ("method" if parent else "function")
+                start = min([child.lineno] + [d.lineno for d in child.decorator_list])
+                qualname = f"{parent}.{child.name}" if parent else child.name
+                symbols.append({"name": child.name, "qualname": qualname, "kind": kind, "start": start,
+                                "end": child.end_lineno or child.lineno, "calls": calls_in(child)})
+                visit(child, qualname)
+            elif isinstance(child, ast.Import):
+                imports.extend(alias.name for alias in child.names)
+            elif isinstance(child, ast.ImportFrom):
+                imports.append("." * child.level + (child.module or ""))
+            else:
+                visit(child, parent)
+    
+    visit(tree)
+    return symbols, imports
+
+
+def _js_block_end(text: str, start: int) -> int:
+    """
+    Offset just past the brace block opening at or after start (strings and comments skipped roughly);
+    expression-bodied arrow functions end at their statement's ';'.
+    """
+    depth, i, quote = 0, text.find("{", start), None
+    semicolon = text.find(";", start)
+    if i < 0 or 0 <= semicolon < i:
+        return semicolon + 1 if semicolon >= 0 else len(text)
+    while i < len(text):
+        c = text[i]
+        if quote:
+            if c == "\\":
+                i += 1
+            elif c == quote:
+                quote = None
+        elif c in "'\"`":
+            quote = c
+        elif text.startswith("//", i):
+            i = text.find("\n", i)
+            if i < 0:
+                return len(text)
+        elif text.startswith("/*", i):
+            i = text.find("*/", i + 2)
+            if i < 0:
+                return len(text)
+            i += 1
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return len(text)
+
+
+def _js_symbols(text: str) -> Tuple[List[Dict], List[str]]:
+    """Regex heuristics (no parser): top-level functions/arrow functions, classes and class methods."""
+    line_starts = [0] + [m.end() for m in re.finditer(r"\n", text)]
+    
+    def line_of(offset: int) -> int:
+        return int(np.searchsorted(line_starts, offset, side="right"))
+    
+    found = {}
+    for kind, pattern in _JS_DEFINITION_PATTERNS:
+        for match in pattern.finditer(text):
+            name = match.group(1)
+            if name in JS_KEYWORDS or match.start(1) in found:
+                continue
+            found[match.start(1)] = (kind, name, match.start(), _js_block_end(text, match.end() - 1))
+    
+    symbols = []
+    classes = [(s, e, n) for k, n, s, e in found.values() if k == "class"]
+    for offset, (kind, name, start, end) in sorted(found.items()):
+        owner = next((cname for cs, ce, cname in classes if cs < start < ce and cname != name), None)
+        if kind == "method" and not owner:
+            continue  # Indented call-like line outside a class - not a definition
+        body = text[offset + len(name):end]  # Starts after the name, so "name(" in the definition is not read as a call
+        calls = sorted({c for c in re.findall(r'\b([A-Za-z_$][\w$]*)\s*\(', body) if c not in JS_KEYWORDS} - {name})
+        symbols.append({"name": name, "qualname": f"{owner}.{name}" if owner else name, "kind": kind,
+                        "start": line_of(start), "end": line_of(max(start, end - 1)), "calls": calls})
+    return symbols, _JS_IMPORT_PATTERN.findall(text)
+
+
+def _build_symbol_index(sha: str, name: str) -> Optional[Dict]:
+    language = SYMBOL_LANGUAGES.get(name.rsplit(".", 1)[-1].lower() if "." in name else "")
+    if not language:
+        return None
+    with _file_lock:
+        blob = _file_blobs.get(sha)
+        size = blob["size"] if blob else None
+    try:
+        size = size if size is not None else os.path.getsize(_file_blob_path(sha))
+    except OSError:
+        return None
+    if size > SYMBOL_MAX_FILE_BYTES:
+        return None  # Checked in bytes before the blob is read
+    text = _file_read(sha)
+    try:
+        symbols, imports = _python_symbols(text) if language == "python" else _js_symbols(text)
+    except SyntaxError:
+        return None  # Partial / broken upload - chunk retrieval still covers it
+    except Exception as e:
+        print(f"[symbol index ERROR] {name}: {str(e)}")
+        return None
+    by_name: Dict[str, List[int]] = {}
+    for i, symbol in enumerate(symbols):
+        by_name.setdefault(symbol["name"], []).append(i)
+    return {"language": language, "symbols": symbols, "imports": imports, "by_name": by_name}
+
+
+def symbol_index(sha: str, name: str) -> Optional[Dict]:
+    """Symbol index of a cached source file (None for non-source or unparsable files)."""
+    with _symbol_lock:
+        if sha in _symbol_indexes:
+            _symbol_indexes.move_to_end(sha)
+            return _symbol_indexes[sha]
+    index = _build_symbol_index(sha, name)
+    with _symbol_lock:
+        _symbol_indexes[sha] = index
+        while len(_symbol_indexes) > SYMBOL_INDEX_CACHE:
+            _symbol_indexes.popitem(last=False)
+    return index
+
+
+def _module_names(path: str) -> set:
+    """Dotted suffixes other files may import this one by: src/app/models.py -> src.app.models, app.models, models."""
+    stem = re.sub(r"/(__init__|index)$", "", re.sub(r"\.(pyi?|[cm]?jsx?|tsx?)$", "", path))
+    parts = stem.replace("/", ".").split(".")
+    return {".".join(parts[i:]) for i in range(len(parts))}
+
+
+def _import_matches(spec: str, modules: set) -> bool:
+    """'.models', 'app.models', './utils/helpers', '../lib/api.js' against a file's module names."""
+    norm = re.sub(r"\.(pyi?|[cm]?jsx?|tsx?)$", "", re.sub(r"^[./]+", "", spec)).replace("/", ".")
+    return bool(norm) and norm in modules
+
+
+def symbol_context(session_id: str, query: str, budget: int = SYMBOL_CONTEXT_BUDGET) -> Tuple[str, int]:
+    """
+    SYMBOL CONTEXT: Source of the symbols the query names (functions, classes, Class.method), then
+    their callers and callees across the session's source files, plus the import graph of the files
+    involved. Returns (context block, chars of source included).
+    """
+    files = [f for f in _session_files(session_id) if f["name"].rsplit(".", 1)[-1].lower() in SYMBOL_LANGUAGES]
+    indexes = [(f, symbol_index(f["sha256"], f["name"])) for f in files]
+    indexes = [(f, ix) for f, ix in indexes if ix and ix["symbols"]]
+    if not indexes:
+        return "", 0
+    
+    tokens = [t for t in dict.fromkeys(re.findall(r"[A-Za-z_$][\w$]*(?:\.[A-Za-z_$][\w$]*)?", query))
+              if len(t) >= 3 and t.lower() not in SEARCH_STOPWORDS]
+    targets = []
+    for token in tokens:
+        owner, _, short = token.rpartition(".")
+        for f, ix in indexes:
+            for i in ix["by_name"].get(short or token, []):
+                symbol = ix["symbols"][i]
+                if owner and not symbol["qualname"].endswith(token):
+                    continue
+                if (f["name"], i) not in targets:
+                    targets.append((f["name"], i))
+    if not targets:
+        return "", 0
+    targets = targets[:SYMBOL_MAX_TARGETS]
+    
+    lookup = {f["name"]: (f, ix) for f, ix in indexes}
+    target_names = {lookup[fname][1]["symbols"][i]["name"] for fname, i in targets}
+    related = []
+    for fname, i in targets:
+        symbol = lookup[fname][1]["symbols"][i]
+        for f, ix in indexes:
+            for j, other in enumerate(ix["symbols"]):
+                key = (f["name"], j)
+                if key in targets or key in related or other["kind"] == "class":
+                    continue
+                if symbol["name"] in other["calls"]:
+                    related.append(key)                          # Caller
+                elif other["name"] in symbol["calls"] and other["name"] not in target_names:
+                    related.append(key)                          # Callee
+    
+    texts: Dict[str, List[str]] = {}
+    
+    def source(fname: str, i: int) -> str:
+        f, ix = lookup[fname]
+        if fname not in texts:
+            texts[fname] = _file_read(f["sha256"]).splitlines()
+        symbol = ix["symbols"][i]
+        return "\n".join(texts[fname][symbol["start"] - 1:symbol["end"]])
+    
+    parts, used, summaries = ["[RELEVANT SYMBOLS]:"], 0, []
+    for role, keys in (("", targets), ("related", related[:SYMBOL_MAX_RELATED])):
+        for fname, i in keys:
+            f, ix = lookup[fname]
+            symbol = ix["symbols"][i]
+            header = f"{symbol['kind']} {symbol['qualname']} (lines {symbol['start']}-{symbol['end']})"
+            if role:
+                relation = "calls " + ", ".join(sorted(target_names & set(symbol["calls"]))) if target_names & set(symbol["calls"]) else "called by the symbols above"
+                header += f" - {relation}"
+            body = source(fname, i)
+            if used + len(body) > budget:
+                summaries.append(f"{fname}:{symbol['start']} {header}")
+                continue
+            used += len(body)
+            fence = "python" if ix["language"] == "python" else "javascript"
+            parts.append(f"[FILE: {fname} | {header}]\n```{fence}\n{body}\n```")
+    if summaries:
+        parts.append("[MORE RELATED SYMBOLS (not shown)]:\n" + "\n".join(f"- {s}" for s in summaries))
+    
+    # Import graph of the files involved
+    involved = list(dict.fromkeys(fname for fname, _ in targets))
+    graph = []
+    for fname in involved:
+        modules = _module_names(fname)
+        imported_by = [f["name"] for f, ix in indexes if f["name"] != fname and any(_import_matches(spec, modules) for spec in ix["imports"])]
+        imports = lookup[fname][1]["imports"]
+        graph.append(f"- {fname}: imports {', '.join(imports[:15]) or 'nothing'}; imported by {', '.join(imported_by[:15]) or 'no cached file'}")
+    parts.append("[IMPORT GRAPH]:\n" + "\n".join(graph))
+    return "\n".join(parts), used
+
+
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# UPLOAD PARSING - Process pool with per-format timeouts, results cached by (sha256, parser version)
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+PARSER_VERSION = 4               # Bump when parser output changes - old cache entries stop matching
+PARSE_WORKERS = max(2, min(4, os.cpu_count() or 2))
+PARSE_TIMEOUTS = {"pdf": 120, "excel": 60, "csv": 30, "docx": 30, "pptx": 30, "video": 45}  # Seconds per file
+PARSE_CACHE_PATH = os.path.join(CACHE_DIR, "parse_cache.db")
+PARSE_INLINE_KINDS = {"image", "audio", "ipynb", "text"}  # Cheap - parsed on the calling thread
+PARSE_QUEUE_TIMEOUT = 300        # Seconds a task may wait for a free worker before it is abandoned
+PARSE_POLL_INTERVAL = 0.25       # Seconds between checks for tasks a worker picked up
+PARSE_CACHE_MAX_AGE = 30 * 86400             # Seconds a parse result is kept
+PARSE_CACHE_MAX_BYTES = 512 * 1024 * 1024    # Parse results (incl. video keyframe base64) kept on disk
+PARSE_CACHE_PRUNE_INTERVAL = 600             # Seconds between eviction passes
+PDF_PAGES_PER_TASK = 16          # Page batch per pool task - large PDFs fan out across all workers
+PDF_SPOOL_DIR = os.path.join(CACHE_DIR, "pdf_spool")  # Workers read the PDF from disk, not a pickled copy each
+TEXT_STREAM_MIN_BYTES = FILE_INLINE_MAX_CHARS  # Larger text uploads are streamed into the file store, not inlined
+TEXT_STREAM_BLOCK = 1024 * 1024  # Spool / decode block size
+UPLOAD_SPOOL_DIR = os.path.join(CACHE_DIR, "spool")  # Same filesystem as FILE_SPILL_DIR - blobs are moved, not copied
+STREAMED_FILE_PATTERN = re.compile(r'\[FILE: ([^\]|]+?) - ([\d,]+) chars \| sha256=([0-9a-f]{64}) \| streamed to file cache\]')
+
+LANG_MAP = {
+    'py': 'python', 'js': 'javascript', 'ts': 'typescript', 'jsx': 'jsx', 'tsx': 'tsx',
+    'java': 'java', 'c': 'c', 'cpp': 'cpp', 'h': 'c', 'cs': 'csharp', 'go': 'go',
+    'rs': 'rust', 'rb': 'ruby', 'php': 'php', 'swift': 'swift', 'kt': 'kotlin',
+    'html': 'html', 'css': 'css', 'scss': 'scss', 'json': 'json', 'xml': 'xml',
+    'yaml': 'yaml', 'yml': 'yaml', 'sql': 'sql', 'md': 'markdown', 'sh': 'bash'
+}
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+_parse_cache_conn = None
+_parse_cache_lock = threading.Lock()
+_parse_stats = {"parsed": 0, "cache_hits": 0, "timeouts": 0, "pdf_pages": 0, "pdf_pages_cached": 0, "streamed": 0}
+_parse_active = 0                # parse_uploads calls currently waiting on the pool
+_parse_recycle_pending = False   # A worker is stuck - recycle once no other call has tasks in flight
+_parse_cache_last_prune = 0.0
+
+
+def _parse_kind(name: str, mime: str = None) -> str:
+    ext = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+    if mime == "application/pdf" or ext == "pdf":
+        return "pdf"
+    if mime and mime.startswith("image/"):
+        return "image"
+    if ext in ['mp4', 'webm', 'mov', 'avi', 'mkv']:
+        return "video"
+    if ext in ['mp3', 'wav', 'm4a', 'ogg', 'flac', 'aac', 'wma', 'aiff']:
+        return "audio"
+    if ext in ['xlsx', 'xls']:
+        return "excel"
+    if ext == 'csv':
+        return "csv"
+    if ext == 'docx':
+        return "docx"
+    if ext == 'pptx':
+        return "pptx"
+    if ext == 'ipynb':
+        return "ipynb"
+    if ext in ['zip', 'tar', 'gz', 'tgz', 'bz2', 'xz', 'rar', '7z']:
+        return "archive"
+    return "text"
+
+
+def _parse_file(kind: str, name: str, mime: str, data: bytes) -> Dict:
+    """
+    Parse one upload into {"text": <appended to the message>, "images": [data URIs]}.
+    Top-level and self-contained so it can run in a spawned worker process.
+    PDFs (page batches) and archives (streamed index) never reach it - parse_uploads routes them.
+    """
+    import io
+    ext = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+    images: List[str] = []
+    
+    if kind == "image":
+        img_b64 = f"data:{mime};base64,{base64.b64encode(data).decode()}"
+        return {"text": f"\n\n[IMAGE ATTACHED: {name}]", "images": [img_b64]}
+    
+    if kind == "video":
+        # VIDEO: Representative keyframes (scene cuts + even coverage) for AI analysis
+        import tempfile
+        import shutil
+        text = f"\n\n[VIDEO: {name} - {len(data):,} bytes]"
+        if not shutil.which('ffmpeg'):
+            return {"text": text + " [Note: ffmpeg not installed - cannot extract frames]", "images": images}
+        try:
+            with tempfile.TemporaryDirectory() as workdir:
+                video_path = os.path.join(workdir, f"input.{ext or 'mp4'}")
+                with open(video_path, 'wb') as f:
+                    f.write(data)
+                frames, note = extract_video_keyframes(video_path, workdir)
+            if frames:
+                stamps = ", ".join(f"{int(t // 60)}:{int(t % 60):02d}" for t, _ in frames)
+                text += f" [{len(frames)} keyframes extracted for analysis at {stamps}]"
+                images.extend(uri for _, uri in frames)
+            text += note
+        except Exception as ve:
+            text += f" [Frame extraction failed: {str(ve)[:50]}]"
+        return {"text": text, "images": images}
+    
+    if kind == "audio":
+        return {"text": f"\n\n[AUDIO: {name} - {len(data):,} bytes]"
+                        "\n(Audio transcription: Use 'transcribe this audio' command if you want me to process it)",
+                "images": images}
+    
+    if kind in ("excel", "csv"):
+        label = "EXCEL" if kind == "excel" else "CSV"
+        try:
+            import pandas as pd
+            if kind == "excel":
+                df = pd.read_excel(io.BytesIO(data), engine='openpyxl' if ext == 'xlsx' else 'xlrd')
+            else:
+                df = pd.read_csv(io.BytesIO(data))
+            if len(df) > TABLE_INLINE_MAX_ROWS:
+                table_id = hashlib.sha256(data).hexdigest()[:16]
+                _table_save(df, table_id)
+                return {"text": summarize_table(df, name, label, table_id), "images": images}
+            return {"text": f"\n\n[{label}: {name}]\nColumns: {list(df.columns)}\nRows: {len(df)}\n```\n{df.to_string()}\n```",
+                    "images": images}
+        except Exception as e:
+            return {"text": f"\n\n[{label}: {name} - Could not parse: {str(e)[:50]}]", "images": images}
+    
+    if kind == "docx":
+        try:
+            from docx import Document
+            doc_text = "\n".join([p.text for p in Document(io.BytesIO(data)).paragraphs])
+            return {"text": f"\n\n[WORD: {name}]\n```\n{doc_text}\n```", "images": images}
+        except Exception as e:
+            return {"text": f"\n\n[WORD: {name} - Could not parse: {str(e)[:50]}]", "images": images}
+    
+    if kind == "pptx":
+        try:
+            from pptx import Presentation
+            slides_text = []
+            for i, slide in enumerate(Presentation(io.BytesIO(data)).slides[:20]):
+                slide_text = f"--- Slide {i+1} ---\n"
+                for shape in slide.shapes:
+                    if hasattr(shape, "text"):
+                        slide_text += shape.text + "\n"
+                slides_text.append(slide_text)
+            return {"text": f"\n\n[POWERPOINT: {name}]\n```\n{chr(10).join(slides_text)}\n```", "images": images}
+        except Exception as e:
+            return {"text": f"\n\n[POWERPOINT: {name} - Could not parse: {str(e)[:50]}]", "images": images}
+    
+    if kind == "ipynb":
+        try:
+            nb = json.loads(data.decode('utf-8'))
+            cells = []
+            for cell in nb.get('cells', [])[:30]:
+                if cell.get('cell_type') == 'code':
+                    cells.append("```python\n" + "".join(cell.get('source', [])) + "\n```")
+                elif cell.get('cell_type') == 'markdown':
+                    cells.append("".join(cell.get('source', [])))
+            return {"text": f"\n\n[JUPYTER: {name}]\n" + "\n\n".join(cells), "images": images}
+        except Exception as e:
+            return {"text": f"\n\n[JUPYTER: {name} - Could not parse: {str(e)[:50]}]", "images": images}
+    
+    # Read as text - NO LIMIT, AI sees complete files!
+    file_text = data.decode('utf-8', errors='ignore')
+    return {"text": f"\n\n[FILE: {name}]\n```{LANG_MAP.get(ext, '')}\n{file_text}\n```", "images": images}
+
+
+def _parse_pdf_pages(source, pages: List[int]) -> Dict[int, str]:
+    """
+    Text of the given 1-based pages of a PDF (path or bytes). Pages that fail to extract are
+    left out. Top-level so it can run in a worker process.
+    """
+    import io
+    from PyPDF2 import PdfReader
+    reader = PdfReader(io.BytesIO(source) if isinstance(source, bytes) else source)
+    texts = {}
+    for page in pages:
+        try:
+            texts[page] = reader.pages[page - 1].extract_text() or ""
+        except Exception as e:
+            print(f"[pdf] Page {page} extraction failed: {str(e)[:100]}")
+    return texts
+
+
+def _format_pdf(name: str, texts: Dict[int, str], count: int) -> str:
+    """Page-indexed file block: a [Page N] line before each page (the chunk index keys on these)."""
+    body = "\n".join(f"[Page {p}]\n{texts[p].strip() if p in texts else '(text not extracted)'}"
+                     for p in range(1, count + 1))
+    return f"\n\n[FILE: {name}]\n```\n{body}\n```"
+
+
+def _get_parse_pool():
+    """Lazily start the worker pool (spawn: no forked copies of threads or sockets)."""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            import multiprocessing
+            _parse_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _parse_pool
+
+
+def _recycle_parse_pool():
+    """Tear down a pool with a stuck worker (a timed-out parse keeps running otherwise)."""
+    global _parse_pool
+    with _parse_pool_lock:
+        pool, _parse_pool = _parse_pool, None
+    if pool is None:
+        return
+    try:
+        for process in list(getattr(pool, "_processes", {}).values()):
+            process.terminate()
+    except Exception:
+        pass
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _gather_tasks(tasks: List[Tuple[concurrent.futures.Future, float]]) -> set:
+    """
+    Wait for pool tasks [(future, timeout)]. Each timeout counts from when a worker picks the task up,
+    so time queued behind busy workers is free (up to PARSE_QUEUE_TIMEOUT). Returns the futures that expired.
+    """
+    timeouts = dict(tasks)
+    waiting, expired, started = set(timeouts), set(), {}
+    queued_since = time.time()
+    while waiting:
+        now = time.time()
+        for future in list(waiting):
+            if future not in started and future.running():
+                started[future] = now
+            if future in started:
+                late = now - started[future] > timeouts[future]
+            else:
+                late = now - queued_since > PARSE_QUEUE_TIMEOUT
+            if late:
+                future.cancel()  # Only succeeds while still queued
+                expired.add(future)
+                waiting.discard(future)
+        if waiting:
+            done, _ = concurrent.futures.wait(waiting, timeout=PARSE_POLL_INTERVAL,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            waiting -= done
+    return expired
+
+
+def _parse_cache():
+    global _parse_cache_conn
+    if _parse_cache_conn is None:
+        import sqlite3
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(PARSE_CACHE_PATH, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS parse_cache (key TEXT PRIMARY KEY, result TEXT NOT NULL, created_at REAL NOT NULL)")
+        conn.execute("""CREATE TABLE IF NOT EXISTS pdf_pages (
+            sha256 TEXT NOT NULL, version INTEGER NOT NULL, page INTEGER NOT NULL, text TEXT NOT NULL,
+            PRIMARY KEY (sha256, version, page))""")
+        conn.execute("CREATE TABLE IF NOT EXISTS map_results (key TEXT PRIMARY KEY, result TEXT NOT NULL, created_at REAL NOT NULL)")
+        _parse_cache_conn = conn
+    return _parse_cache_conn
+
+
+def _parse_cache_get(key: str) -> Optional[Dict]:
+    try:
+        with _parse_cache_lock:
+            row = _parse_cache().execute("SELECT result FROM parse_cache WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+    except Exception as e:
+        print(f"[parse cache ERROR] {str(e)}")
+        return None
+
+
+def _parse_cache_put(key: str, result: Dict):
+    if " - Could not parse: " in result["text"][:300]:
+        return  # Failures may be environmental (missing library) - retry next time
+    try:
+        with _parse_cache_lock:
+            _parse_cache().execute("INSERT OR REPLACE INTO parse_cache (key, result, created_at) VALUES (?, ?, ?)",
+                                   (key, json.dumps(result), time.time()))
+    except Exception as e:
+        print(f"[parse cache ERROR] {str(e)}")
+    _parse_cache_prune()
+
+
+def _parse_cache_prune():
+    """
+    Drop expired parse / map-reduce results and pages of old parser versions, then the oldest parse
+    results beyond PARSE_CACHE_MAX_BYTES (throttled).
+    """
+    global _parse_cache_last_prune
+    now = time.time()
+    if now - _parse_cache_last_prune < PARSE_CACHE_PRUNE_INTERVAL:
+        return
+    _parse_cache_last_prune = now
+    try:
+        with _parse_cache_lock:
+            conn = _parse_cache()
+            conn.execute("DELETE FROM parse_cache WHERE created_at < ?", (now - PARSE_CACHE_MAX_AGE,))
+            conn.execute("DELETE FROM pdf_pages WHERE version != ?", (PARSER_VERSION,))
+            conn.execute("DELETE FROM map_results WHERE created_at < ?", (now - MAP_CACHE_MAX_AGE,))
+            total = conn.execute("SELECT COALESCE(SUM(length(result)), 0) FROM parse_cache").fetchone()[0]
+            if total > PARSE_CACHE_MAX_BYTES:
+                doomed, freed = [], 0
+                for key, size in conn.execute("SELECT key, length(result) FROM parse_cache ORDER BY created_at"):
+                    if total - freed <= PARSE_CACHE_MAX_BYTES * 0.8:
+                        break
+                    doomed.append((key,))
+                    freed += size
+                conn.executemany("DELETE FROM parse_cache WHERE key = ?", doomed)
+    except Exception as e:
+        print(f"[parse cache ERROR] Prune failed: {str(e)}")
+
+
+def _pdf_pages_get(sha: str) -> Dict[int, str]:
+    try:
+        with _parse_cache_lock:
+            rows = _parse_cache().execute("SELECT page, text FROM pdf_pages WHERE sha256 = ? AND version = ?",
+                                          (sha, PARSER_VERSION)).fetchall()
+        return {page: text for page, text in rows}
+    except Exception as e:
+        print(f"[parse cache ERROR] {str(e)}")
+        return {}
+
+
+def _pdf_pages_put(sha: str, texts: Dict[int, str]):
+    if not texts:
+        return
+    try:
+        with _parse_cache_lock:
+            _parse_cache().executemany("INSERT OR REPLACE INTO pdf_pages (sha256, version, page, text) VALUES (?, ?, ?, ?)",
+                                       [(sha, PARSER_VERSION, page, text) for page, text in texts.items()])
+    except Exception as e:
+        print(f"[parse cache ERROR] {str(e)}")
+
+
+def _submit_pdf(name: str, data: bytes, sha: str) -> Dict:
+    """
+    Count pages here and fan extraction of the pages not in the per-page cache out to the
+    pool in PDF_PAGES_PER_TASK batches.
+    """
+    import io
+    import tempfile
+    job = {"name": name, "sha": sha, "count": 0, "texts": {}, "fresh": {}, "futures": [], "path": None, "error": None}
+    try:
+        from PyPDF2 import PdfReader
+        job["count"] = len(PdfReader(io.BytesIO(data)).pages)
+    except Exception as e:
+        job["error"] = str(e)[:50]
+        return job
+    job["texts"] = _pdf_pages_get(sha)
+    missing = [p for p in range(1, job["count"] + 1) if p not in job["texts"]]
+    if not missing:
+        return job
+    
+    os.makedirs(PDF_SPOOL_DIR, exist_ok=True)
+    fd, job["path"] = tempfile.mkstemp(suffix=".pdf", dir=PDF_SPOOL_DIR)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    for start in range(0, len(missing), PDF_PAGES_PER_TASK):
+        batch = missing[start:start + PDF_PAGES_PER_TASK]
+        try:
+            job["futures"].append(_get_parse_pool().submit(_parse_pdf_pages, job["path"], batch))
+        except Exception as e:
+            print(f"[parse_uploads] Pool unavailable, extracting PDF pages inline: {str(e)}")
+            _recycle_parse_pool()
+            job["fresh"].update(_parse_pdf_pages(job["path"], batch))
+    return job
+
+
+def _collect_pdf(job: Dict, expired: set) -> Tuple[Dict, bool, bool]:
+    """
+    Gather a PDF's finished page batches (_gather_tasks already waited; `expired` batches timed out).
+    Pages that did not finish are marked in the text. Returns (result, every page extracted, pool needs recycling).
+    """
+    name = job["name"]
+    if job["error"]:
+        return {"text": f"\n\n[FILE: {name} - Could not parse: {job['error']}]", "images": []}, False, False
+    stuck = False
+    for future in job["futures"]:
+        if future in expired:
+            stuck = stuck or not future.cancelled()
+            continue
+        try:
+            job["fresh"].update(future.result())
+        except Exception as e:
+            print(f"[parse_uploads] PDF page batch failed for {name}: {str(e)}")
+            stuck = stuck or isinstance(e, concurrent.futures.BrokenExecutor)
+    if job["path"]:
+        try:
+            os.remove(job["path"])
+        except OSError:
+            pass
+    if stuck:
+        _parse_stats["timeouts"] += 1
+    
+    # Finished batches are kept even when others timed out - a retry only extracts the rest
+    _pdf_pages_put(job["sha"], job["fresh"])
+    texts = {**job["texts"], **job["fresh"]}
+    _parse_stats["pdf_pages"] += len(job["fresh"])
+    _parse_stats["pdf_pages_cached"] += len(job["texts"])
+    return {"text": _format_pdf(name, texts, job["count"]), "images": []}, len(texts) == job["count"], stuck
+
+
+def _upload_size(source) -> int:
+    if isinstance(source, (bytes, bytearray)):
+        return len(source)
+    source.seek(0, os.SEEK_END)
+    size = source.tell()
+    source.seek(0)
+    return size
+
+
+def _upload_bytes(source) -> bytes:
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    source.seek(0)
+    return source.read()
+
+
+def ingest_text_upload(name: str, source, user_id: str = None) -> Dict:
+    """
+    STREAMING TEXT INGESTION: Upload (bytes or binary file object) -> spooled to disk in blocks ->
+    memory-mapped -> decoded incrementally (invalid UTF-8 dropped, as the inline path does) straight
+    into the file store's on-disk format. The file is never held as one Python string; the message
+    carries a reference (readable by user_id) and the context builder serves excerpts.
+    Returns {"text", "images", "files": [cache_files entry]}.
+    """
+    import codecs
+    import mmap
+    import tempfile
+    os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+    raw_fd, raw_path = tempfile.mkstemp(suffix=".raw", dir=UPLOAD_SPOOL_DIR)
+    text_fd, text_path = tempfile.mkstemp(suffix=".txt", dir=UPLOAD_SPOOL_DIR)
+    try:
+        with os.fdopen(raw_fd, "wb") as out:
+            if isinstance(source, (bytes, bytearray)):
+                out.write(source)
+            else:
+                source.seek(0)
+                for block in iter(lambda: source.read(TEXT_STREAM_BLOCK), b""):
+                    out.write(block)
+        
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        digest, size, chars = hashlib.sha256(), 0, 0
+        with open(raw_path, "rb") as f, os.fdopen(text_fd, "wb") as out:
+            length = os.fstat(f.fileno()).st_size
+            if length:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for start in range(0, length, TEXT_STREAM_BLOCK):
+                        text = decoder.decode(mm[start:start + TEXT_STREAM_BLOCK], final=start + TEXT_STREAM_BLOCK >= length)
+                        encoded = text.encode("utf-8")
+                        digest.update(encoded)
+                        out.write(encoded)
+                        size += len(encoded)
+                        chars += len(text)
+                        if hasattr(mm, "madvise"):
+                            # Decoded block is on its way to disk - drop its mapped pages from RSS
+                            mm.madvise(mmap.MADV_DONTNEED, start, min(TEXT_STREAM_BLOCK, length - start))
+        sha = digest.hexdigest()
+        if not _file_adopt(text_path, sha, size):
+            raise RuntimeError("file store unavailable")
+    except Exception:
+        try:
+            os.remove(text_path)
+        except OSError:
+            pass
+        raise
+    finally:
+        try:
+            os.remove(raw_path)
+        except OSError:
+            pass
+    
+    _parse_stats["streamed"] += 1
+    _attachment_add_owner(sha, user_id)
+    _attachment_pool.submit(store_streamed_attachment, name, sha)
+    return {"text": f"\n\n[FILE: {name} - {chars:,} chars | sha256={sha} | streamed to file cache]",
+            "images": [], "files": [{"name": name, "sha256": sha, "size": size, "chars": chars}]}
+
+
+def parse_uploads(files: List[Tuple[str, str, Union[bytes, BinaryIO]]], user_id: str = None) -> List[Dict]:
+    """
+    PARALLEL UPLOAD PARSING: [(name, mime type, bytes or seekable binary file object, e.g. a Streamlit
+    UploadedFile)] -> [{"text", "images", "cached"}] in input order. Archives and large text files are
+    streamed from file objects without being read whole. Heavy formats fan out to the process pool with
+    per-format timeouts; results are cached by (sha256, format, PARSER_VERSION), so a re-attached file
+    costs one hash.
+    PDFs are split into page batches across workers and cached per page as well.
+    Large text files are streamed into the file store (readable by user_id); their results carry
+    "files" for cache_files.
+    """
+    global _parse_active, _parse_recycle_pending
+    results: List[Optional[Dict]] = [None] * len(files)
+    pending, pdf_jobs = [], []
+    with _parse_pool_lock:
+        _parse_active += 1
+    try:
+        _parse_uploads_into(files, results, pending, pdf_jobs, user_id)
+    finally:
+        with _parse_pool_lock:
+            _parse_active -= 1
+            recycle = _parse_recycle_pending and _parse_active == 0
+            if recycle:
+                _parse_recycle_pending = False
+        if recycle:
+            _recycle_parse_pool()
+    
+    _parse_stats["parsed"] += len(files)
+    return [dict(r, cached=r.get("cached", False)) for r in results]
+
+
+def _parse_uploads_into(files: List[Tuple[str, str, Union[bytes, BinaryIO]]], results: List[Optional[Dict]], pending: List, pdf_jobs: List,
+                        user_id: str = None):
+    """parse_uploads body: fills results in place; a stuck worker only marks the pool for recycling."""
+    global _parse_recycle_pending
+    for i, (name, mime, source) in enumerate(files):
+        kind = _parse_kind(name, mime)
+        if kind == "archive" or (kind == "text" and _upload_size(source) > TEXT_STREAM_MIN_BYTES):
+            # Streamed from the file object: archives are indexed lazily, large text goes to the file store
+            try:
+                results[i] = ingest_archive_upload(name, source) if kind == "archive" else ingest_text_upload(name, source, user_id)
+            except Exception as e:
+                results[i] = {"text": f"\n\n[FILE ERROR: {name} - {str(e)}]", "images": []}
+            continue
+        data = _upload_bytes(source)
+        sha = hashlib.sha256(data).hexdigest()
+        # The name is part of the output text, so it is part of the key
+        key = f"{sha}:{kind}:{PARSER_VERSION}:{name}"
+        cached = _parse_cache_get(key)
+        if cached:
+            _parse_stats["cache_hits"] += 1
+            results[i] = dict(cached, cached=True)
+            continue
+        if kind == "pdf":
+            pdf_jobs.append((i, key, _submit_pdf(name, data, sha)))
+            continue
+        
+        future = None
+        if kind not in PARSE_INLINE_KINDS:
+            try:
+                future = _get_parse_pool().submit(_parse_file, kind, name, mime, data)
+            except Exception as e:
+                # Pool unavailable (e.g. broken by a crashed worker) - parse here
+                print(f"[parse_uploads] Pool unavailable, parsing inline: {str(e)}")
+                _recycle_parse_pool()
+        if future is not None:
+            pending.append((i, key, kind, name, future))
+            continue
+        try:
+            results[i] = _parse_file(kind, name, mime, data)
+            if kind != "image":  # Re-encoding is cheaper than caching the base64
+                _parse_cache_put(key, results[i])
+        except Exception as e:
+            results[i] = {"text": f"\n\n[FILE ERROR: {name} - {str(e)}]", "images": []}
+    
+    tasks = [(future, PARSE_TIMEOUTS.get(kind, 30)) for _, _, kind, _, future in pending]
+    tasks += [(future, PARSE_TIMEOUTS.get("pdf", 120)) for _, _, job in pdf_jobs for future in job["futures"]]
+    expired = _gather_tasks(tasks)
+    
+    stuck = False
+    for i, key, kind, name, future in pending:
+        timeout = PARSE_TIMEOUTS.get(kind, 30)
+        if future in expired:
+            _parse_stats["timeouts"] += 1
+            waited = "waiting for a free parser" if future.cancelled() else f"after {timeout}s"
+            results[i] = {"text": f"\n\n[FILE ERROR: {name} - parsing timed out {waited}]", "images": []}
+            stuck = stuck or not future.cancelled()
+            continue
+        try:
+            results[i] = future.result()
+            _parse_cache_put(key, results[i])
+        except Exception as e:
+            results[i] = {"text": f"\n\n[FILE ERROR: {name} - {str(e)}]", "images": []}
+            if isinstance(e, concurrent.futures.BrokenExecutor):
+                stuck = True
+    for i, key, job in pdf_jobs:
+        results[i], complete, job_stuck = _collect_pdf(job, expired)
+        if complete:
+            _parse_cache_put(key, results[i])
+        stuck = stuck or job_stuck
+    if stuck:
+        with _parse_pool_lock:
+            _parse_recycle_pending = True
+
+
+def get_parse_stats() -> Dict:
+    return dict(_parse_stats)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# VIDEO KEYFRAMES - One ffmpeg pass: scene changes + even coverage, downscaled, dHash-deduplicated
+# All keyframes go to the Strategist in a single multi-image vision request
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+VIDEO_KEYFRAMES = 8              # Frames sent to vision per video
+VIDEO_MAX_CANDIDATES = 32        # Frames ffmpeg may emit before dedupe/selection (spread over the whole video)
+VIDEO_SCENE_THRESHOLD = 0.4      # ffmpeg scene score (0-1) that counts as a cut
+VIDEO_FRAME_WIDTH = 512          # Downscale width (px) - plenty for vision, ~30KB per JPEG
+VIDEO_DHASH_THRESHOLD = 6        # Hamming distance (of 64 bits) under which two frames are duplicates
+VIDEO_KEYFRAME_ONLY_SECONDS = 600  # Longer videos decode only I-frames so the scan stays fast
+VIDEO_EXTRACT_TIMEOUT = 35       # Wall-time cap for the ffmpeg pass (inside PARSE_TIMEOUTS["video"])
+
+
+def _video_duration(path: str) -> float:
+    """Container duration in seconds via ffprobe (header read only); 0.0 if unknown."""
+    import shutil
+    import subprocess
+    if not shutil.which("ffprobe"):
+        return 0.0
+    try:
+        out = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+                             capture_output=True, text=True, timeout=5)
+        return float(out.stdout.strip() or 0)
+    except Exception:
+        return 0.0
+
+
+def _dhash(path: str) -> Optional[int]:
+    """64-bit difference hash: sign of horizontal gradients on a 9x8 grayscale thumbnail."""
+    try:
+        from PIL import Image
+        with Image.open(path) as img:
+            pixels = np.asarray(img.convert("L").resize((9, 8)), dtype=np.int16)
+        bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+        return int("".join("1" if b else "0" for b in bits), 2)
+    except Exception:
+        return None
+
+
+def _select_keyframes(frames: List[Tuple[float, str]], n: int) -> List[Tuple[float, str]]:
+    """Drop near-duplicates (vs every frame kept so far), then spread the survivors over the timeline."""
+    kept, hashes = [], []
+    for t, path in frames:
+        h = _dhash(path)
+        if h is not None and any(bin(h ^ other).count("1") <= VIDEO_DHASH_THRESHOLD for other in hashes):
+            continue
+        kept.append((t, path))
+        if h is not None:
+            hashes.append(h)
+    if len(kept) > n:
+        kept = [kept[i] for i in sorted(set(np.linspace(0, len(kept) - 1, n).round().astype(int).tolist()))]
+    return kept
+
+
+def extract_video_keyframes(path: str, workdir: str, n: int = VIDEO_KEYFRAMES) -> Tuple[List[Tuple[float, str]], str]:
+    """
+    VIDEO KEYFRAMES: [(timestamp seconds, JPEG data URI)] for up to n representative frames, plus a note.
+    A single ffmpeg pass selects the first frame, scene cuts at most one per duration/VIDEO_MAX_CANDIDATES
+    bucket and at least one frame per duration/n interval, downscaled on the way out - so the candidate
+    cap is reached only at the end of the video, not by a burst of cuts in its opening seconds.
+    Frames written before the time cap are kept.
+    """
+    import subprocess
+    duration = _video_duration(path)
+    interval = duration / n if duration else 10.0
+    gap = interval * n / VIDEO_MAX_CANDIDATES
+    select = (f"isnan(prev_selected_t)+gt(scene,{VIDEO_SCENE_THRESHOLD})*gte(t-prev_selected_t,{gap:.3f})"
+              f"+gte(t-prev_selected_t,{interval:.3f})")
+    cmd = ["ffmpeg", "-hide_banner", "-nostdin"]
+    if duration > VIDEO_KEYFRAME_ONLY_SECONDS:
+        cmd += ["-skip_frame", "nokey"]
+    cmd += ["-i", path, "-an", "-vf", f"select='{select}',scale='min({VIDEO_FRAME_WIDTH},iw)':-2,showinfo",
+            "-vsync", "vfr", "-frames:v", str(VIDEO_MAX_CANDIDATES), "-q:v", "4",
+            os.path.join(workdir, "frame_%03d.jpg")]
+    
+    note = ""
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        _, stderr = process.communicate(timeout=VIDEO_EXTRACT_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        _, stderr = process.communicate()
+        note = f" [frame scan stopped after {VIDEO_EXTRACT_TIMEOUT}s - later scenes may be missing]"
+    
+    times = [float(t) for t in re.findall(r"pts_time:\s*([\d.]+)", stderr.decode("utf-8", errors="ignore"))]
+    paths = sorted(f for f in os.listdir(workdir) if f.startswith("frame_") and f.endswith(".jpg"))
+    frames = [(times[i] if i < len(times) else 0.0, os.path.join(workdir, f)) for i, f in enumerate(paths)]
+    
+    selected = []
+    for t, frame_path in _select_keyframes(frames, n):
+        with open(frame_path, "rb") as f:
+            selected.append((t, f"data:image/jpeg;base64,{base64.b64encode(f.read()).decode()}"))
+    return selected, note
+
+
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# ARCHIVE UPLOADS - Member index from the zip central directory / tar headers, no full extraction
+# Members are extracted on demand (size + ratio limits) into the file cache when referenced
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+ARCHIVE_DIR = os.path.join(CACHE_DIR, "archives")   # Uploaded archives, by content hash
+ARCHIVE_LISTING_MAX_ENTRIES = 200                   # Paths listed in the upload message (the rest stay requestable)
+ARCHIVE_MEMBER_MAX_BYTES = 20 * 1024 * 1024         # Largest member extracted (uncompressed)
+ARCHIVE_MAX_RATIO = 100                             # Compression ratio above which a large member is refused (zip bomb)
+ARCHIVE_SESSION_MAX_BYTES = 200 * 1024 * 1024       # Total bytes extracted per session
+ARCHIVE_REQUEST_MAX_FILES = 10                      # Members extracted per request
+ARCHIVE_TAR_SCAN_MAX_BYTES = 256 * 1024 * 1024      # Compressed tars: uncompressed bytes walked while listing
+ARCHIVE_MAX_AGE = 7 * 86400                         # Seconds since last use before a stored archive is removed
+ARCHIVE_SWEEP_INTERVAL = 3600                       # Seconds between sweeps of ARCHIVE_DIR
+ARCHIVE_REF_PATTERN = re.compile(r'\[ARCHIVE: ([^\]|]+?) - [\d,]+ bytes \| id=([0-9a-f]{16})')
+ARCHIVE_FILE_PATTERN = re.compile(r'\[ARCHIVE[_\s]FILES?[:\s]+([^\]]+)\]', re.I)
+ARCHIVE_LISTING_PATTERN = re.compile(r'(\[ARCHIVE: [^\]]*\]\n[^\n]*\n)```[\s\S]*?```')
+
+# {archive id: {"path", "name", "format", "members": {member path: (size, compressed size)}, "truncated"}}
+_archive_indexes: Dict[str, Dict] = {}
+_archive_extracted: Dict[str, int] = {}   # session_id -> bytes extracted so far
+_archive_lock = threading.Lock()
+_archive_last_sweep = 0.0
+
+
+def _archive_format(name: str) -> Optional[str]:
+    lower = name.lower()
+    if lower.endswith(".zip"):
+        return "zip"
+    if lower.endswith((".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")):
+        return "tar"
+    if lower.endswith(".gz"):
+        return "gz"
+    return None  # rar / 7z / bare bz2 / xz: no stdlib reader
+
+
+def _tar_compressed(path: str) -> bool:
+    """gzip / bzip2 / xz magic - headers of these can only be reached by decompressing everything before them."""
+    with open(path, "rb") as f:
+        magic = f.read(6)
+    return magic[:2] == b"\x1f\x8b" or magic[:3] == b"BZh" or magic == b"\xfd7zXZ\x00"
+
+
+def _list_archive(path: str, fmt: str, name: str) -> Tuple[Dict[str, Tuple[int, int]], bool]:
+    """
+    Member paths -> (size, compressed size), and whether the listing was cut short.
+    Zip reads only the central directory; tar walks headers - compressed tars stop after
+    ARCHIVE_TAR_SCAN_MAX_BYTES of stream and share the archive's on-disk size as the compressed size.
+    """
+    import zipfile
+    import tarfile
+    members, truncated = {}, False
+    if fmt == "zip":
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    members[info.filename] = (info.file_size, info.compress_size)
+    elif fmt == "tar":
+        compressed = _tar_compressed(path)
+        on_disk = os.path.getsize(path)
+        with tarfile.open(path, "r:*") as tf:
+            for member in tf:
+                if compressed and member.offset_data + member.size > ARCHIVE_TAR_SCAN_MAX_BYTES:
+                    truncated = True  # Reaching the next header means decompressing past the cap
+                    break
+                if member.isfile():
+                    members[member.name] = (member.size, on_disk if compressed else member.size)
+    else:
+        # Single gzip stream: the trailer holds the uncompressed size (mod 2^32)
+        with open(path, "rb") as f:
+            f.seek(-4, os.SEEK_END)
+            size = int.from_bytes(f.read(4), "little")
+            compressed = f.tell()
+        members[re.sub(r"\.gz$", "", os.path.basename(name), flags=re.I)] = (size, compressed)
+    return members, truncated
+
+
+def _sweep_archives():
+    """Remove stored archives unused for ARCHIVE_MAX_AGE (and stale spool files); throttled."""
+    global _archive_last_sweep
+    now = time.time()
+    if now - _archive_last_sweep < ARCHIVE_SWEEP_INTERVAL:
+        return
+    _archive_last_sweep = now
+    try:
+        entries = os.listdir(ARCHIVE_DIR)
+    except OSError:
+        return
+    for entry in entries:
+        path = os.path.join(ARCHIVE_DIR, entry)
+        try:
+            if now - os.path.getmtime(path) > (ARCHIVE_MAX_AGE if not entry.endswith(".tmp") else 3600):
+                os.remove(path)
+                with _archive_lock:
+                    _archive_indexes.pop(entry.split(".", 1)[0], None)
+        except OSError:
+            pass
+
+
+def _archive_index(archive_id: str) -> Optional[Dict]:
+    """Member index of an uploaded archive (rebuilt from the stored archive after a restart)."""
+    with _archive_lock:
+        if archive_id in _archive_indexes:
+            return _archive_indexes[archive_id]
+    try:
+        stored = [f for f in os.listdir(ARCHIVE_DIR) if f.startswith(archive_id + ".")]
+    except OSError:
+        return None
+    if not stored:
+        return None
+    fmt, name = stored[0].split(".")[1], stored[0].split(".", 2)[2]
+    path = os.path.join(ARCHIVE_DIR, stored[0])
+    members, truncated = _list_archive(path, fmt, name)
+    index = {"path": path, "name": name, "format": fmt, "members": members, "truncated": truncated}
+    with _archive_lock:
+        _archive_indexes[archive_id] = index
+    return index
+
+
+def ingest_archive_upload(name: str, source) -> Dict:
+    """
+    ARCHIVE INGESTION: Store the archive once by hash and list its members without extracting them.
+    The upload message carries the archive id and a (capped) file tree; members are extracted
+    later when the user or an agent references them.
+    """
+    import tempfile
+    size = _upload_size(source)
+    fmt = _archive_format(name)
+    if fmt is None:
+        return {"text": f"\n\n[ARCHIVE: {name} - {size:,} bytes] (contents not listed - zip, tar(.gz/.bz2/.xz) and .gz are supported)",
+                "images": []}
+    
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    _sweep_archives()
+    fd, tmp_path = tempfile.mkstemp(dir=ARCHIVE_DIR, suffix=".tmp")
+    digest = hashlib.sha256()
+    with os.fdopen(fd, "wb") as out:
+        if isinstance(source, (bytes, bytearray)):
+            digest.update(source)
+            out.write(source)
+        else:
+            source.seek(0)
+            for block in iter(lambda: source.read(TEXT_STREAM_BLOCK), b""):
+                digest.update(block)
+                out.write(block)
+    archive_id = digest.hexdigest()[:16]
+    safe_name = re.sub(r"[^\w.\-]", "_", name)
+    path = os.path.join(ARCHIVE_DIR, f"{archive_id}.{fmt}.{safe_name}")
+    if os.path.exists(path):
+        os.remove(tmp_path)
+        os.utime(path)
+    else:
+        os.replace(tmp_path, path)
+    
+    try:
+        index = _archive_index(archive_id)
+    except Exception as e:
+        return {"text": f"\n\n[ARCHIVE: {name} - Could not parse: {str(e)[:50]}]", "images": []}
+    members = index["members"]
+    total = sum(s for s, _ in members.values())
+    listing = "\n".join(f"{path} ({s:,} bytes)" for path, (s, _) in sorted(members.items())[:ARCHIVE_LISTING_MAX_ENTRIES])
+    if len(members) > ARCHIVE_LISTING_MAX_ENTRIES:
+        top = {}
+        for path in members:
+            top[path.split("/", 1)[0]] = top.get(path.split("/", 1)[0], 0) + 1
+        listing += (f"\n... {len(members) - ARCHIVE_LISTING_MAX_ENTRIES:,} more files. Top-level: "
+                    + ", ".join(f"{d} ({n})" for d, n in sorted(top.items(), key=lambda x: -x[1])[:20]))
+    if index["truncated"]:
+        listing += f"\n... listing stopped after {ARCHIVE_TAR_SCAN_MAX_BYTES:,} uncompressed bytes - later files are not available"
+    return {"text": f"\n\n[ARCHIVE: {name} - {size:,} bytes | id={archive_id} | {len(members):,} files, {total:,} bytes uncompressed]\n"
+                    f"Files are extracted on request - mention a path, or agents use [ARCHIVE_FILE: path or glob]\n```\n{listing}\n```",
+            "images": []}
+
+
+def _read_archive_member(index: Dict, member: str) -> bytes:
+    """Member bytes with size / ratio limits; the read itself is capped in case headers lie."""
+    import zipfile
+    import tarfile
+    import gzip
+    size, compressed = index["members"][member]
+    if size > ARCHIVE_MEMBER_MAX_BYTES:
+        raise ValueError(f"{size:,} bytes exceeds the {ARCHIVE_MEMBER_MAX_BYTES:,} byte member limit")
+    if size > 1024 * 1024 and compressed and size / compressed > ARCHIVE_MAX_RATIO:
+        raise ValueError(f"compression ratio {size / compressed:,.0f}:1 looks like a zip bomb")
+    
+    def capped(stream) -> bytes:
+        data = stream.read(ARCHIVE_MEMBER_MAX_BYTES + 1)
+        if len(data) > ARCHIVE_MEMBER_MAX_BYTES:
+            raise ValueError(f"expands past the {ARCHIVE_MEMBER_MAX_BYTES:,} byte member limit")
+        return data
+    
+    if index["format"] == "zip":
+        with zipfile.ZipFile(index["path"]) as zf, zf.open(member) as stream:
+            return capped(stream)
+    if index["format"] == "tar":
+        # Walk to the member instead of extractfile(name), which indexes the whole archive first
+        with tarfile.open(index["path"], "r:*") as tf:
+            for info in tf:
+                if info.name == member:
+                    stream = tf.extractfile(info)
+                    if stream is None:
+                        raise ValueError("not a regular file")
+                    return capped(stream)
+        raise ValueError("member not found")
+    with gzip.open(index["path"], "rb") as stream:
+        return capped(stream)
+
+
+def _match_members(members: Dict[str, Tuple[int, int]], pattern: str) -> List[str]:
+    """Exact path, unique basename / path suffix, or glob (src/*.py)."""
+    import fnmatch
+    pattern = pattern.strip().strip("`'\"").lstrip("./")
+    if pattern in members:
+        return [pattern]
+    if any(c in pattern for c in "*?["):
+        return sorted(m for m in members if fnmatch.fnmatch(m, pattern) or fnmatch.fnmatch(m, "*/" + pattern))
+    suffix = [m for m in members if m.endswith("/" + pattern)]
+    return suffix if len(suffix) == 1 else []
+
+
+def session_archives(session_id: str, extra_text: str = "") -> List[str]:
+    """Archive ids uploaded in this session (from history + the current message), oldest first."""
+    text = "\n".join(m.get("content") or "" for m in get_history(session_id)) + "\n" + (extra_text or "")
+    return list(dict.fromkeys(archive_id for _, archive_id in ARCHIVE_REF_PATTERN.findall(text)))
+
+
+def extract_archive_members(session_id: str, archive_id: str, patterns: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    ON-DEMAND EXTRACTION: Matching members -> file cache (large ones streamed into the store).
+    Returns (member paths now cached, error notes).
+    """
+    index = _archive_index(archive_id)
+    if index is None or not os.path.exists(index["path"]):
+        return [], [f"archive {archive_id} is no longer stored - re-upload it"]
+    try:
+        os.utime(index["path"])  # In use - keep it out of the sweep
+    except OSError:
+        pass
+    wanted = list(dict.fromkeys(m for p in patterns for m in _match_members(index["members"], p)))
+    cached = {f["name"] for f in _session_files(session_id)}
+    done, errors = [m for m in wanted if m in cached], []
+    for member in [m for m in wanted if m not in cached][:ARCHIVE_REQUEST_MAX_FILES]:
+        with _archive_lock:
+            used = _archive_extracted.get(session_id, 0)
+        if used + index["members"][member][0] > ARCHIVE_SESSION_MAX_BYTES:
+            errors.append(f"{member}: session extraction budget ({ARCHIVE_SESSION_MAX_BYTES:,} bytes) used up")
+            break
+        try:
+            data = _read_archive_member(index, member)
+        except Exception as e:
+            errors.append(f"{member}: {str(e)[:120]}")
+            continue
+        if b"\0" in data[:8192]:
+            errors.append(f"{member}: binary file skipped")
+            continue
+        with _archive_lock:
+            _archive_extracted[session_id] = _archive_extracted.get(session_id, 0) + len(data)
+        if len(data) > TEXT_STREAM_MIN_BYTES:
+            cache_files(session_id, ingest_text_upload(member, data, session_user(session_id))["files"])
+        else:
+            cache_files(session_id, [{"name": member, "content": data.decode("utf-8", errors="ignore")}])
+        done.append(member)
+    if len(wanted) > ARCHIVE_REQUEST_MAX_FILES:
+        errors.append(f"{len(wanted)} members matched - extracted the first {ARCHIVE_REQUEST_MAX_FILES}; narrow the pattern")
+    return done, errors
+
+
+def archive_query_members(session_id: str, query: str) -> str:
+    """
+    Members of the session's archives that the query names (full path or unique file name) are
+    extracted before context assembly, so the excerpt tier can serve them. Returns a status note.
+    """
+    archive_ids = session_archives(session_id, query)
+    if not archive_ids:
+        return ""
+    # Only what the user wrote - not listings or file bodies pasted into the same message
+    query = FILE_BLOCK_PATTERN.sub("", ARCHIVE_LISTING_PATTERN.sub(r"\1", query))
+    tokens = set(re.findall(r"[\w.\-/]+\.\w+", query))
+    notes = []
+    for archive_id in archive_ids:
+        index = _archive_index(archive_id)
+        if index is None:
+            continue
+        named = [t for t in tokens if _match_members(index["members"], t)]
+        if not named:
+            continue
+        done, errors = extract_archive_members(session_id, archive_id, named)
+        if done:
+            notes.append(f"[EXTRACTED FROM ARCHIVE {index['name']}]: {', '.join(done)}")
+        notes.extend(f"[ARCHIVE NOTE] {e}" for e in errors)
+    return "\n".join(notes)
+
+
+def read_archive_files(session_id: str, request: str) -> str:
+    """[ARCHIVE_FILE: path or glob, ...] or [ARCHIVE_FILE: archive name | path] -> file blocks for the context."""
+    archive_ids = session_archives(session_id)
+    if not archive_ids:
+        return "[ARCHIVE_FILE ERROR] no archive uploaded in this session"
+    if "|" in request:
+        which, request = [part.strip() for part in request.split("|", 1)]
+        stored_name = re.sub(r"[^\w.\-]", "_", which)
+        archive_ids = [a for a in archive_ids if a == which or (_archive_index(a) or {}).get("name") == stored_name] or archive_ids
+    patterns = [p for p in re.split(r"[,\s]+", request) if p]
+    
+    blocks, errors = [], []
+    for archive_id in reversed(archive_ids):   # Newest upload wins for duplicate paths
+        done, errs = extract_archive_members(session_id, archive_id, patterns)
+        errors.extend(errs)
+        if done:
+            budget = max(2000, FILE_CONTEXT_BUDGET // len(done))
+            records = {f["name"]: f for f in _session_files(session_id)}
+            for member in done:
+                record = records.get(member)
+                if record is None:
+                    continue
+                content = file_read_bytes(record["sha256"], 0, budget * 4).decode("utf-8", errors="ignore")[:budget]
+                more = f"\n... ({record['chars']:,} chars total - cached, relevant excerpts are served per query)" if record["chars"] > budget else ""
+                blocks.append(f"[FILE: {member}]\n```\n{content}{more}\n```")
+            break
+    if not blocks:
+        return "[ARCHIVE_FILE ERROR] " + ("; ".join(errors) or f"no member matches '{request}'")
+    return "\n\n".join(blocks + [f"[ARCHIVE NOTE] {e}" for e in errors])
+
+
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# TABULAR UPLOADS - Large CSV/Excel frames become schema + stats + stratified sample in context
+# The full frame is kept in a columnar cache; agents pull rows/filters/aggregates with [TABLE_QUERY:]
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+TABLE_INLINE_MAX_ROWS = 200      # Frames up to this size are still inlined in full
+TABLE_SAMPLE_ROWS = 30           # Evenly spaced rows in the stratified sample (plus head/tail/categories)
+TABLE_CATEGORY_MAX = 12          # Columns with at most this many distinct values get one sample row per value
+TABLE_DESCRIBE_MAX_COLS = 40     # Wide frames: describe()/dtypes cover the first N columns
+TABLE_QUERY_MAX_ROWS = 200       # Row cap for a single [TABLE_QUERY:] result
+TABLE_QUERY_MAX_CHARS = 20000
+TABLE_DIR = os.path.join(CACHE_DIR, "tables")
+TABLE_MAX_AGE = 7 * 86400        # Seconds since last use before a cached table file is removed
+TABLE_SWEEP_INTERVAL = 3600      # Seconds between sweeps of TABLE_DIR
+TABLE_QUERY_PATTERN = re.compile(r'\[TABLE[_\s]?QUERY[:\s]+([0-9a-f]{8,64})\s*\|\s*([^\]]+)\]', re.I)
+
+TABLE_FRAME_CACHE = 4            # Recently queried frames kept in memory
+
+_table_frames: "OrderedDict[str, object]" = OrderedDict()  # table_id -> DataFrame
+_table_lock = threading.Lock()
+_table_last_sweep = 0.0
+
+_TABLE_AGGS = {"sum", "mean", "min", "max", "count", "median", "nunique", "std"}
+_TABLE_OPS = ("==", "!=", ">=", "<=", ">", "<", "=", "contains")
+
+
+def _table_path(table_id: str, ext: str) -> str:
+    return os.path.join(TABLE_DIR, f"{table_id}.{ext}")
+
+
+def _sweep_tables():
+    """Remove table files unused for TABLE_MAX_AGE (and stale spool files); throttled."""
+    global _table_last_sweep
+    now = time.time()
+    if now - _table_last_sweep < TABLE_SWEEP_INTERVAL:
+        return
+    _table_last_sweep = now
+    try:
+        entries = os.listdir(TABLE_DIR)
+    except OSError:
+        return
+    for entry in entries:
+        path = os.path.join(TABLE_DIR, entry)
+        try:
+            if now - os.path.getmtime(path) > (TABLE_MAX_AGE if not entry.endswith(".tmp") else 3600):
+                os.remove(path)
+                with _table_lock:
+                    _table_frames.pop(entry.split(".", 1)[0], None)
+        except OSError:
+            pass
+
+
+def _table_touch(path: str):
+    """In use - keep it out of the sweep."""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _table_save(df, table_id: str) -> str:
+    """
+    Write the full frame as Parquet (pyarrow), or as CSV when Parquet can't hold it. Returns the format.
+    Never pickled - a table file must not be able to run code when it is loaded back.
+    """
+    os.makedirs(TABLE_DIR, exist_ok=True)
+    _sweep_tables()
+    for fmt in ("parquet", "csv"):
+        if os.path.exists(_table_path(table_id, fmt)):
+            _table_touch(_table_path(table_id, fmt))
+            return fmt
+    tmp = _table_path(table_id, f"{os.getpid()}.tmp")
+    try:
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, _table_path(table_id, "parquet"))
+        return "parquet"
+    except Exception:
+        # No pyarrow, or mixed-type object columns / non-string headers - CSV loses dtypes, not rows
+        df.to_csv(tmp, index=False)
+        os.replace(tmp, _table_path(table_id, "csv"))
+        return "csv"
+
+
+def _table_load(table_id: str):
+    for fmt in ("parquet", "csv"):
+        _table_touch(_table_path(table_id, fmt))
+    _sweep_tables()
+    with _table_lock:
+        if table_id in _table_frames:
+            _table_frames.move_to_end(table_id)
+            return _table_frames[table_id]
+    import pandas as pd
+    if os.path.exists(_table_path(table_id, "parquet")):
+        df = pd.read_parquet(_table_path(table_id, "parquet"))
+    elif os.path.exists(_table_path(table_id, "csv")):
+        df = pd.read_csv(_table_path(table_id, "csv"), low_memory=False)
+    else:
+        return None  # Legacy .pkl files are ignored, never unpickled
+    with _table_lock:
+        _table_frames[table_id] = df
+        while len(_table_frames) > TABLE_FRAME_CACHE:
+            _table_frames.popitem(last=False)
+    return df
+
+
+def _table_sample(df):
+    """Stratified sample: head, tail, evenly spaced rows and the first row of each low-cardinality value."""
+    n = len(df)
+    rows = set(range(min(5, n))) | set(range(max(0, n - 5), n))
+    rows |= set(np.linspace(0, n - 1, min(TABLE_SAMPLE_ROWS, n)).astype(int).tolist())
+    for col in df.columns[:TABLE_DESCRIBE_MAX_COLS]:
+        try:
+            values = df[col].reset_index(drop=True)
+            if values.dtype.kind in "fc":
+                continue
+            firsts = values.drop_duplicates()
+            if 1 < len(firsts) <= TABLE_CATEGORY_MAX:
+                rows |= set(firsts.index.tolist())
+        except Exception:
+            continue
+    return df.iloc[sorted(rows)]
+
+
+def summarize_table(df, name: str, label: str, table_id: str) -> str:
+    """
+    TABULAR SUMMARY: Context block for a frame too large to inline.
+    Keeps the [LABEL: name] / Columns / Rows header so attachment and file-chunk handling still apply.
+    """
+    import pandas as pd
+    cols = df.columns[:TABLE_DESCRIBE_MAX_COLS]
+    more = f" (first {len(cols)} of {len(df.columns)} columns)" if len(df.columns) > len(cols) else ""
+    schema = pd.DataFrame({"dtype": df[cols].dtypes.astype(str), "nulls": df[cols].isna().sum(),
+                           "distinct": [df[c].nunique(dropna=True) for c in cols]})
+    try:
+        stats = df[cols].describe(include="all").T.to_string(max_colwidth=30)
+    except Exception as e:
+        stats = f"(describe failed: {str(e)[:80]})"
+    sample = _table_sample(df).to_string(max_colwidth=40)
+    body = (f"[TABLE: id={table_id} | {len(df):,} rows x {len(df.columns)} cols]\n"
+            f"Full data is cached. Query it with TABLE_QUERY: {table_id} and ';'-separated clauses - "
+            f"rows 0-50 | where col > 5 | columns a, b | agg sum(col) by col2 | sort col desc | limit 20\n\n"
+            f"SCHEMA{more}:\n{schema.to_string()}\n\n"
+            f"STATISTICS:\n{stats}\n\n"
+            f"STRATIFIED SAMPLE (head, tail, evenly spaced, one row per category; left column = row number):\n{sample}")
+    return f"\n\n[{label}: {name}]\nColumns: {list(df.columns)}\nRows: {len(df)}\n```\n{body}\n```"
+
+
+def _table_value(raw: str):
+    raw = raw.strip()
+    if len(raw) >= 2 and raw[0] == raw[-1] and raw[0] in "'\"":
+        return raw[1:-1]
+    try:
+        return float(raw) if any(c in raw for c in ".eE") else int(raw)
+    except ValueError:
+        return raw
+
+
+def _table_column(df, raw: str):
+    name = raw.strip().strip('`"\'')
+    if name in df.columns:
+        return name
+    lowered = {str(c).lower(): c for c in df.columns}
+    if name.lower() in lowered:
+        return lowered[name.lower()]
+    raise ValueError(f"unknown column '{name}' (columns: {', '.join(map(str, df.columns[:30]))})")
+
+
+def _table_filter(df, clause: str):
+    """`<column> <op> <value>` - no eval; quote column names with spaces."""
+    match = re.match(r'^(`[^`]+`|"[^"]+"|\'[^\']+\'|\S+?)\s*(==|!=|>=|<=|>|<|=|contains\b)\s*(.+)$', clause.strip(), re.I)
+    if not match:
+        raise ValueError(f"can't parse filter '{clause}'")
+    col, op, value = _table_column(df, match.group(1)), match.group(2).lower(), _table_value(match.group(3))
+    series = df[col]
+    if op == "contains":
+        return df[series.astype(str).str.contains(str(value), case=False, regex=False, na=False)]
+    if op in ("==", "="):
+        return df[series == value]
+    if op == "!=":
+        return df[series != value]
+    mask = {">": series > value, ">=": series >= value, "<": series < value, "<=": series <= value}[op]
+    return df[mask]
+
+
+def query_table(table_id: str, spec: str) -> str:
+    """
+    TABLE QUERIES: Run a small query spec against a cached upload. Clauses are separated by ';':
+        rows 100-150                     row range (0-based, end exclusive)
+        where amount > 500               filters (==, !=, >, >=, <, <=, contains); repeat to AND
+        columns region, amount           column subset
+        agg sum(amount), count(id) by region   aggregates (sum/mean/min/max/count/median/nunique/std)
+        sort amount desc                 ordering
+        limit 20                         row cap (never above TABLE_QUERY_MAX_ROWS)
+    """
+    try:
+        df = _table_load(table_id.strip().lower())
+    except Exception as e:
+        return f"[TABLE_QUERY ERROR] could not load table {table_id}: {str(e)[:200]}"
+    if df is None:
+        return f"[TABLE_QUERY ERROR] table {table_id} is not cached - ask the user to re-upload the file"
+    
+    try:
+        limit, row_range, sort, aggregate, columns = TABLE_QUERY_MAX_ROWS, None, None, None, None
+        for clause in [c.strip() for c in spec.split(";") if c.strip()]:
+            verb, _, rest = clause.partition(" ")
+            verb = verb.lower()
+            if verb == "rows":
+                match = re.match(r'^(\d+)\s*(?:-|to|:)\s*(\d+)$', rest.strip())
+                if not match:
+                    raise ValueError(f"rows expects 'start-end', got '{rest}'")
+                row_range = (int(match.group(1)), int(match.group(2)))
+            elif verb in ("where", "filter"):
+                df = _table_filter(df, rest)
+            elif verb in ("columns", "cols", "select"):
+                columns = [_table_column(df, c) for c in rest.split(",") if c.strip()]
+            elif verb in ("agg", "aggregate"):
+                aggregate = rest
+            elif verb in ("sort", "order"):
+                parts = rest.rsplit(None, 1)
+                descending = len(parts) == 2 and parts[1].lower() in ("desc", "descending")
+                sort = (parts[0] if descending else rest, not descending)  # May name an aggregate
+            elif verb == "limit":
+                limit = min(int(rest), TABLE_QUERY_MAX_ROWS)
+            else:
+                raise ValueError(f"unknown clause '{verb}'")
+        
+        matched = len(df)
+        if aggregate:
+            funcs, _, by = aggregate.partition(" by ")
+            specs = re.findall(r'(\w+)\(\s*([^)]+?)\s*\)', funcs)
+            if not specs:
+                raise ValueError(f"agg expects e.g. 'sum(amount) by region', got '{aggregate}'")
+            named = {}
+            for func, col in specs:
+                if func.lower() not in _TABLE_AGGS:
+                    raise ValueError(f"unsupported aggregate '{func}'")
+                column = df.columns[0] if col == "*" else _table_column(df, col)
+                named[f"{func.lower()}({col})"] = (column, "size" if col == "*" else func.lower())
+            keys = [_table_column(df, c) for c in by.split(",") if c.strip()]
+            if keys:
+                df = df.groupby(keys, dropna=False).agg(**named).reset_index()
+            else:
+                df = df.groupby(lambda _: "all").agg(**named)
+        if columns and not aggregate:
+            df = df[columns]
+        if sort:
+            key = sort[0].strip().strip('`"\'')
+            df = df.sort_values(key if key in df.columns else _table_column(df, key), ascending=sort[1])
+        if row_range:
+            df = df.iloc[row_range[0]:row_range[1]]
+        shown = df.head(limit)
+        
+        text = shown.to_string(max_colwidth=60)
+        if len(text) > TABLE_QUERY_MAX_CHARS:
+            text = text[:TABLE_QUERY_MAX_CHARS] + "\n... (output truncated - narrow the query)"
+        note = f"{len(shown)} of {len(df):,} result rows" + (f" ({matched:,} rows matched filters)" if not aggregate else "")
+        return f"[TABLE {table_id} | {spec.strip()}] {note}\n{text}"
+    except Exception as e:
+        return f"[TABLE_QUERY ERROR] {str(e)[:300]}"
+
+
 # ═══════════════════════════════════════════════════════════════════════════════════════════════════════
 # THE COUNCIL OF 4 - TRUE AGENTIC PROMPTS
 # ═══════════════════════════════════════════════════════════════════════════════════════════════════════
@@ -160,6 +2284,9 @@ AUTONOMOUS CAPABILITIES:
 - If user needs current info: [SEARCH: query]
 - If user needs an image created: [GENERATE_IMAGE: detailed prompt]
 - If user needs a video created: [GENERATE_VIDEO: detailed prompt]
+- If an uploaded table is summarized ([TABLE: id=...]): [TABLE_QUERY: id | where col > 5; agg sum(col) by col2; rows 0-50]
+- If you need specific pages of an uploaded PDF: [PDF_PAGES: filename.pdf | 12-15]
+- If you need files from an uploaded archive: [ARCHIVE_FILE: path/in/archive.py] (globs like src/*.py work)
 
 For complex tasks, create a clear plan the Executor can follow.
 For simple queries (time, facts, greetings), answer directly - you ARE smart enough.
@@ -187,6 +2314,9 @@ CAPABILITIES:
 - BROWSE WITH AUTOMATION: [BROWSE: https://example.com] - Full browser with JS!
 - SCREENSHOT ANY PAGE: [SCREENSHOT: https://example.com]
 - READ GITHUB REPOS: [GITHUB: https://github.com/user/repo]
+- QUERY UPLOADED TABLES: [TABLE_QUERY: id | rows 100-150] or [TABLE_QUERY: id | where region == "EU"; agg sum(amount) by month; sort sum(amount) desc]
+- READ PDF PAGES: [PDF_PAGES: filename.pdf | 12-15]
+- READ FILES INSIDE UPLOADED ARCHIVES: [ARCHIVE_FILE: src/main.py] or [ARCHIVE_FILE: repo.zip | src/*.py]
 
 CODE RULES:
 - Write COMPLETE code, never "..."  or "rest of implementation"
@@ -235,7 +2365,8 @@ THEMES = {
 # API CALLERS
 # ═══════════════════════════════════════════════════════════════════════════════════════════════════════
 
-def call_anthropic(model: str, system_prompt: str, messages: List[Dict], max_tokens: int = 16384) -> Tuple[str, int]:
+def call_anthropic(model: str, system_prompt: str, messages: List[Dict], max_tokens: int = 16384,
+                   auto_continue: bool = True) -> Tuple[str, int]:
     global _total_tokens_used
     if not AZURE_API_KEY:
         return "⚠️ Azure API key not configured", 0
@@ -358,7 +2489,7 @@ def call_anthropic(model: str, system_prompt: str, messages: List[Dict], max_tok
                 
                 # AUTO-CONTINUE: If response hit max_tokens, request continuation
                 stop_reason = data.get("stop_reason", "")
-                if stop_reason == "max_tokens" and len(content) > 100:
+                if stop_reason == "max_tokens" and len(content) > 100 and auto_continue:
                     # Response was cut off - auto-continue up to 6 times
                     full_content = content
                     for cont_attempt in range(6):  # Max 6 continuations
@@ -515,9 +2646,25 @@ def call_agent(agent_key: str, messages: List[Dict], max_tokens: int = 8000) ->
     return call_openai(agent["model"], agent["prompt"], messages, max_tokens)
 
 
-def call_anthropic_with_vision(model: str, system_prompt: str, messages: List[Dict], image_b64: str, max_tokens: int = 8192) -> Tuple[str, int]:
+VISION_MAX_IMAGES = 20           # Images per vision request (uploads + video keyframes)
+
+
+def _image_block(image_b64: str) -> Dict:
+    """Data URL or raw base64 -> Anthropic image content block."""
+    media_type, image_data = "image/png", image_b64
+    # Extract base64 data if it's a data URL
+    if image_b64.startswith("data:"):
+        parts = image_b64.split(",", 1)
+        if len(parts) == 2:
+            media_type = parts[0].split(";")[0].replace("data:", "")
+            image_data = parts[1]
+    return {"type": "image", "source": {"type": "base64", "media_type": media_type, "data": image_data}}
+
+
+def call_anthropic_with_vision(model: str, system_prompt: str, messages: List[Dict], image_b64, max_tokens: int = 8192) -> Tuple[str, int]:
     """
-    TRUE VISION: Call Anthropic with an image for visual analysis.
+    TRUE VISION: Call Anthropic with one image (data URL / base64) or a list of them for visual analysis.
+    Multiple images (e.g. video keyframes) go in one request, in order, up to VISION_MAX_IMAGES.
     This is what makes us #1 - we can actually SEE screenshots.
     """
     global _total_tokens_used
@@ -526,30 +2673,9 @@ def call_anthropic_with_vision(model: str, system_prompt: str, messages: List[Di
     
     headers = {"Content-Type": "application/json", "Authorization": f"Bearer {AZURE_API_KEY}", "anthropic-version": "2023-06-01"}
     
-    # Build vision message with image
-    image_content = []
-    if image_b64:
-        # Extract base64 data if it's a data URL
-        if image_b64.startswith("data:"):
-            parts = image_b64.split(",", 1)
-            if len(parts) == 2:
-                media_type = parts[0].split(";")[0].replace("data:", "")
-                image_data = parts[1]
-            else:
-                media_type = "image/png"
-                image_data = image_b64
-        else:
-            media_type = "image/png"
-            image_data = image_b64
-        
-        image_content = [{
-            "type": "image",
-            "source": {
-                "type": "base64",
-                "media_type": media_type,
-                "data": image_data
-            }
-        }]
+    # Build vision message with image(s)
+    images = [image_b64] if isinstance(image_b64, str) else list(image_b64 or [])
+    image_content = [_image_block(img) for img in images[:VISION_MAX_IMAGES] if img]
     
     # Build messages with vision content
     api_messages = []
@@ -588,43 +2714,529 @@ def call_anthropic_with_vision(model: str, system_prompt: str, messages: List[Di
         return f"⚠️ Vision Exception: {str(e)}", 0
 
 
-def call_agent_with_vision(agent_key: str, messages: List[Dict], image_b64: str, max_tokens: int = 8000) -> Tuple[str, int]:
-    """Call agent with vision capability (only works for Anthropic models)."""
-    agent = AGENTS.get(agent_key)
-    if not agent:
-        return "⚠️ Unknown agent", 0
-    if agent["api"] == "anthropic":
-        return call_anthropic_with_vision(agent["model"], agent["prompt"], messages, image_b64, max_tokens)
-    # Fallback for non-vision models
-    return call_agent(agent_key, messages, max_tokens)
+def call_agent_with_vision(agent_key: str, messages: List[Dict], image_b64, max_tokens: int = 8000) -> Tuple[str, int]:
+    """Call agent with vision capability (only works for Anthropic models). image_b64: one image or a list."""
+    agent = AGENTS.get(agent_key)
+    if not agent:
+        return "⚠️ Unknown agent", 0
+    if agent["api"] == "anthropic":
+        return call_anthropic_with_vision(agent["model"], agent["prompt"], messages, image_b64, max_tokens)
+    # Fallback for non-vision models
+    return call_agent(agent_key, messages, max_tokens)
+
+
+def get_embeddings(texts: List[str]) -> Optional[List[List[float]]]:
+    """
+    BATCH EMBEDDINGS: Embed many texts in ONE API call.
+    Returns None if the API is unavailable - callers pick their own fallback.
+    """
+    if not AZURE_API_KEY or not texts:
+        return None
+
+    try:
+        url = f"{OPENAI_ENDPOINT}/{EMBEDDING_MODEL}/embeddings?api-version=2024-10-21"
+        headers = {"Content-Type": "application/json", "api-key": AZURE_API_KEY}
+        response = requests.post(url, headers=headers,
+            json={"input": [t[:8000] for t in texts], "dimensions": EMBEDDING_DIMENSIONS},
+            timeout=60)
+        if response.status_code == 200:
+            items = sorted(response.json().get("data", []), key=lambda d: d.get("index", 0))
+            if len(items) == len(texts):
+                return [item["embedding"] for item in items]
+        else:
+            print(f"[get_embeddings ERROR] Status {response.status_code}: {response.text[:300]}")
+    except Exception as e:
+        print(f"[get_embeddings ERROR] {str(e)}")
+    return None
+
+
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# MAP-REDUCE FOR OVERSIZED INPUTS - Token-bounded chunks analyzed concurrently by a cheaper model
+# Partial results are reduced level by level into one digest for the council (no truncation)
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+MAP_MODEL = os.getenv("COUNCIL_MAP_MODEL", "claude-haiku-4-5")  # Anthropic model for map / reduce calls
+MAP_TRIGGER_CHARS = 100000       # Current messages larger than this are map-reduced instead of truncated
+MAP_CHARS_PER_TOKEN = 4          # Rough estimate used for token-bounded chunking
+MAP_CHUNK_TOKENS = 12000         # Input tokens per map call
+MAP_OUTPUT_TOKENS = 1500         # Output tokens per map / reduce call
+MAP_DIGEST_MAX_CHARS = 40000     # Reduce until the digest fits (~10K tokens)
+MAP_MAX_LEVELS = 3               # Reduce levels before the digest is cut
+MAP_MAX_CHUNKS = 64              # Larger inputs: the tail beyond this many chunks is dropped (and reported)
+MAP_MAX_CONCURRENT = 4           # Shared by every session - bounds parallel calls against the API rate limit
+MAP_CALL_TIMEOUT = 150           # Seconds per map / reduce call, counted from when a pool thread picks it up
+MAP_QUEUE_TIMEOUT = 600          # Seconds a call may wait for a free pool slot (the pool is shared by all sessions)
+MAP_CACHE_MAX_AGE = 7 * 86400    # Seconds cached map / reduce results are kept
+MAP_FALLBACK_CHARS = 2000        # Raw excerpt kept for a chunk whose call failed
+MAP_QUESTION_MAX_CHARS = 4000    # Request text passed to every map call
+MAP_PROMPT_VERSION = 1           # Bump when the prompts change (invalidates cached results)
+
+MAP_SYSTEM_PROMPT = """You are a precise analyst working on one part of an input too large to read at once.
+Other parts are handled separately and your notes will be merged, so only report on the text you are given.
+Keep exact names, numbers, identifiers, error messages and code signatures. Quote verbatim where precision matters.
+Never invent content that is not in the text."""
+
+# One pool for all sessions: at most MAP_MAX_CONCURRENT map/reduce calls in flight process-wide
+_map_pool = concurrent.futures.ThreadPoolExecutor(max_workers=MAP_MAX_CONCURRENT, thread_name_prefix="council-map")
+_map_stats = {"chunks": 0, "cached": 0, "failed": 0, "reduces": 0}
+
+
+def _map_cache_key(stage: str, question: str, text: str) -> str:
+    return hashlib.sha256(f"{MAP_PROMPT_VERSION}|{MAP_MODEL}|{stage}|{question}|{text}".encode("utf-8", errors="replace")).hexdigest()
+
+
+def _map_cache_get(key: str) -> Optional[str]:
+    try:
+        with _parse_cache_lock:
+            row = _parse_cache().execute("SELECT result FROM map_results WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+    except Exception as e:
+        print(f"[map cache ERROR] {str(e)}")
+        return None
+
+
+def _map_cache_put(key: str, result: str):
+    try:
+        with _parse_cache_lock:
+            _parse_cache().execute("INSERT OR REPLACE INTO map_results (key, result, created_at) VALUES (?, ?, ?)",
+                                   (key, result, time.time()))
+    except Exception as e:
+        print(f"[map cache ERROR] {str(e)}")
+    _parse_cache_prune()
+
+
+def split_token_chunks(text: str, max_tokens: int = MAP_CHUNK_TOKENS) -> List[Tuple[str, List[str]]]:
+    """
+    Line-aligned chunks of at most max_tokens (estimated). Returns [(chunk, names of the FILE blocks it
+    covers)] - a file's header travels with it so every part knows which file it is reading.
+    """
+    limit = max_tokens * MAP_CHARS_PER_TOKEN
+    chunks, current, size, names, current_file = [], [], 0, [], None
+    
+    def flush():
+        nonlocal current, size, names
+        if current:
+            chunks.append(("".join(current), names))
+        current, size, names = [], 0, ([current_file] if current_file else [])
+    
+    for line in text.splitlines(keepends=True):
+        header = re.match(r'\[FILE: ([^\]|]+?)(?: - [^\]]*)?\]', line)
+        if header:
+            current_file = header.group(1).strip()
+            if current and size > limit // 2:
+                flush()  # Start a large file on a fresh chunk
+            names.append(current_file)
+        while len(line) > limit:   # One huge line (minified code, base64) - hard split
+            flush()
+            chunks.append((line[:limit], list(names)))
+            line = line[limit:]
+        if size + len(line) > limit:
+            flush()
+            if current_file:
+                current.append(f"[FILE: {current_file} (continued)]\n")
+                size += len(current[0])
+        current.append(line)
+        size += len(line)
+    flush()
+    return [(chunk, list(dict.fromkeys(n))) for chunk, n in chunks if chunk.strip()]
+
+
+def _map_call(stage: str, question: str, text: str, label: str) -> Tuple[str, bool]:
+    """One cached map / reduce call. Returns (notes, served from cache)."""
+    key = _map_cache_key(stage, question, text)
+    cached = _map_cache_get(key)
+    if cached is not None:
+        return cached, True
+    if stage == "map":
+        prompt = f"""USER REQUEST:
+{question}
+
+Below is {label} of the input. Extract everything in it that is relevant to the request: facts, figures,
+names, definitions, code structure (functions/classes and what they do), errors and conclusions, noting
+which file or section each item comes from. If nothing is relevant, summarize what this part contains in 3 lines.
+
+{text}"""
+    else:
+        prompt = f"""USER REQUEST:
+{question}
+
+Below are notes taken from consecutive parts of one large input ({label}). Merge them into one set of
+notes: keep every detail relevant to the request and the file/section it came from, drop repetition.
+
+{text}"""
+    # No auto-continue: notes are bounded by design, continuations would hold a shared pool slot for minutes
+    notes, _ = call_anthropic(MAP_MODEL, MAP_SYSTEM_PROMPT, [{"role": "user", "content": prompt}], MAP_OUTPUT_TOKENS,
+                              auto_continue=False)
+    if not notes or notes.startswith("⚠️"):
+        raise RuntimeError(notes or "empty response")
+    _map_cache_put(key, notes)
+    return notes, False
+
+
+def _map_level(stage: str, question: str, jobs: List[Tuple[str, str]], progress) -> Generator[Tuple[str, str, str], None, List[str]]:
+    """Run one level of (label, text) jobs on the shared pool; yields progress, returns notes in input order."""
+    results: List[Optional[str]] = [None] * len(jobs)
+    futures = {_map_pool.submit(_map_call, stage, question, text, label): i for i, (label, text) in enumerate(jobs)}
+    done, cached, step = 0, 0, max(1, len(jobs) // 4)
+    # Each call is timed from when a pool thread picks it up; waiting for a slot is capped separately
+    waiting, started, queued_since = set(futures), {}, time.time()
+    while waiting:
+        finished, _ = concurrent.futures.wait(waiting, timeout=PARSE_POLL_INTERVAL,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+        now = time.time()
+        for future in waiting - finished:
+            if future not in started and future.running():
+                started[future] = now
+            late = (now - started[future] > MAP_CALL_TIMEOUT) if future in started else (now - queued_since > MAP_QUEUE_TIMEOUT)
+            if late:
+                future.cancel()  # Only succeeds while queued - a running call ends with its HTTP timeout
+                print(f"[map_reduce ERROR] {jobs[futures[future]][0]}: timed out {'running' if future in started else 'queued'}")
+                _map_stats["failed"] += 1
+                finished.add(future)
+        for future in finished:
+            waiting.discard(future)
+            i = futures[future]
+            if future.done() and not future.cancelled():
+                try:
+                    results[i], hit = future.result()
+                    cached += hit
+                    _map_stats["cached"] += hit
+                except Exception as e:
+                    print(f"[map_reduce ERROR] {jobs[i][0]}: {str(e)[:200]}")
+                    _map_stats["failed"] += 1
+            done += 1
+            if done % step == 0 or done == len(jobs):
+                yield ("System", progress(done, cached), "system")
+    # Failed / timed-out parts keep a raw excerpt rather than disappearing
+    return [notes if notes is not None else f"[{label} - analysis failed, raw excerpt]\n{text[:MAP_FALLBACK_CHARS]}"
+            for notes, (label, text) in zip(results, jobs)]
+
+
+def map_reduce_input(text: str) -> Generator[Tuple[str, str, str], None, str]:
+    """
+    MAP-REDUCE: Oversized message -> digest for the council. Yields progress events; the digest is the
+    generator's return value (result = yield from map_reduce_input(text)).
+    
+    1. MAP: token-bounded chunks analyzed concurrently against the user's request (cached by content hash)
+    2. REDUCE: consecutive notes merged level by level until they fit MAP_DIGEST_MAX_CHARS
+    """
+    question = FILE_BLOCK_PATTERN.sub("", text).strip()
+    if len(question) > MAP_QUESTION_MAX_CHARS:
+        # Long free text - the request is usually at the start or the end
+        half = MAP_QUESTION_MAX_CHARS // 2
+        question = question[:half] + "\n[...]\n" + question[-half:]
+    
+    chunks = split_token_chunks(text)
+    dropped = max(0, len(chunks) - MAP_MAX_CHUNKS)
+    chunks = chunks[:MAP_MAX_CHUNKS]
+    total = len(chunks)
+    yield ("System", f"🗺️ Input too large ({len(text):,} chars) → analyzing {total} parts of ≤{MAP_CHUNK_TOKENS // 1000}K tokens"
+           + (f" ({dropped} trailing parts skipped)" if dropped else ""), "system")
+    
+    jobs = []
+    for i, (chunk, names) in enumerate(chunks):
+        label = f"part {i + 1}/{total}" + (f" ({', '.join(names[:5])})" if names else "")
+        jobs.append((label, chunk))
+    _map_stats["chunks"] += total
+    notes = yield from _map_level("map", question, jobs,
+                                  lambda done, cached: f"🗺️ Analyzed {done}/{total} parts" + (f" ({cached} cached)" if cached else ""))
+    parts = [(i + 1, i + 1, f"[{label}]\n{note}") for i, ((label, _), note) in enumerate(zip(jobs, notes))]
+    
+    # REDUCE: merge runs of consecutive notes that fit one call, until the digest fits
+    level, limit = 0, MAP_CHUNK_TOKENS * MAP_CHARS_PER_TOKEN
+    while sum(len(p[2]) for p in parts) > MAP_DIGEST_MAX_CHARS and len(parts) > 1 and level < MAP_MAX_LEVELS:
+        level += 1
+        groups, current = [], []
+        for part in parts:
+            if current and sum(len(p[2]) for p in current) + len(part[2]) > limit:
+                groups.append(current)
+                current = []
+            current.append(part)
+        groups.append(current)
+        if len(groups) == len(parts):
+            break  # Every note already fills a call on its own - merging cannot shrink it
+        jobs = [(f"parts {g[0][0]}-{g[-1][1]} of {total}", "\n\n".join(p[2] for p in g)) for g in groups]
+        _map_stats["reduces"] += len(jobs)
+        merged = yield from _map_level("reduce", question, jobs,
+                                       lambda done, cached, n=len(jobs), lv=level: f"🧮 Reduce level {lv}: merged {done}/{n} groups")
+        parts = [(g[0][0], g[-1][1], f"[{label}]\n{note}") for g, (label, _), note in zip(groups, jobs, merged)]
+    
+    digest = "\n\n".join(p[2] for p in parts)
+    if len(digest) > MAP_DIGEST_MAX_CHARS:
+        digest = digest[:MAP_DIGEST_MAX_CHARS] + "\n[...digest cut at the size limit...]"
+    header = f"[MAP-REDUCE DIGEST: the user's message was {len(text):,} chars, analyzed in {total} parts"
+    if dropped:
+        header += f"; the last {dropped} parts were not analyzed"
+    return f"{question}\n\n{header}]\n{digest}"
+
+
+def get_map_reduce_stats() -> Dict:
+    return dict(_map_stats)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# EMBEDDING CACHE + BATCHER - Content-hash keyed (memory LRU + on-disk float16)
+# Concurrent misses are coalesced into one multi-input API call
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_DIMENSIONS = 1536
+EMBEDDING_CACHE_SIZE = 2048          # Vectors kept in memory (~12MB at 1536 float32)
+EMBEDDING_STORE_PATH = os.path.join(CACHE_DIR, "embeddings.db")
+EMBEDDING_STORE_MAX_ROWS = 100000    # Vectors kept on disk (~300MB at 1536 float16); oldest evicted first
+EMBEDDING_STORE_MAX_AGE = 90 * 86400 # Seconds an on-disk vector is kept
+EMBEDDING_STORE_PRUNE_INTERVAL = 600 # Seconds between disk evictions
+EMBED_BATCH_WINDOW = 0.01            # Seconds to wait for more requests to join a batch
+EMBED_BATCH_MAX = 64                 # Inputs per API call
+EMBED_WAIT_TIMEOUT = 90              # Seconds a caller waits for its batch
+
+_embedding_lru: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_embedding_lock = threading.Lock()
+_embedding_store = None
+_embedding_store_failed = False
+_embedding_store_lock = threading.Lock()   # Disk store only - never held together with _embedding_lock
+_embedding_store_last_prune = 0.0
+# Batcher state: queued misses and keys already in flight (identical texts share one request)
+_embed_pending: List[Tuple[str, str]] = []
+_embed_inflight: Dict[str, concurrent.futures.Future] = {}
+_embed_cv = threading.Condition()
+_embed_worker: Optional[threading.Thread] = None
+_embedding_stats = {"memory_hits": 0, "disk_hits": 0, "api_calls": 0, "api_inputs": 0}
+
+
+def _embedding_key(text: str) -> str:
+    return hashlib.sha256(f"{EMBEDDING_MODEL}|{EMBEDDING_DIMENSIONS}|{text[:8000]}".encode()).hexdigest()
+
+
+def _embedding_db():
+    """Lazily open the on-disk embedding store (None if the cache dir is unusable)."""
+    global _embedding_store, _embedding_store_failed
+    if _embedding_store is None and not _embedding_store_failed:
+        try:
+            import sqlite3
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            conn = sqlite3.connect(EMBEDDING_STORE_PATH, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_created ON embeddings(created_at)")
+            _embedding_store = conn
+        except Exception as e:
+            print(f"[embedding store] Disabled: {str(e)}")
+            _embedding_store_failed = True
+    return _embedding_store
+
+
+def _embedding_store_prune(db, now: float):
+    """Drop vectors older than EMBEDDING_STORE_MAX_AGE, then the oldest beyond EMBEDDING_STORE_MAX_ROWS (throttled)."""
+    global _embedding_store_last_prune
+    if now - _embedding_store_last_prune < EMBEDDING_STORE_PRUNE_INTERVAL:
+        return
+    _embedding_store_last_prune = now
+    db.execute("DELETE FROM embeddings WHERE created_at < ?", (now - EMBEDDING_STORE_MAX_AGE,))
+    count = db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    if count > EMBEDDING_STORE_MAX_ROWS:
+        # Down to 80% so the next inserts don't immediately trigger another eviction
+        db.execute("DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY created_at LIMIT ?)",
+                   (count - int(EMBEDDING_STORE_MAX_ROWS * 0.8),))
+
+
+def _embedding_remember(items: Dict[str, np.ndarray], persist: bool = True):
+    """Put vectors in the memory LRU (and the float16 disk store, written outside the LRU lock)."""
+    with _embedding_lock:
+        for key, vector in items.items():
+            _embedding_lru[key] = vector
+            _embedding_lru.move_to_end(key)
+        while len(_embedding_lru) > EMBEDDING_CACHE_SIZE:
+            _embedding_lru.popitem(last=False)
+    if not persist:
+        return
+    rows = [(k, v.astype(np.float16).tobytes()) for k, v in items.items()]
+    with _embedding_store_lock:
+        db = _embedding_db()
+        if db is None:
+            return
+        try:
+            now = time.time()
+            db.executemany("INSERT OR REPLACE INTO embeddings (key, vector, created_at) VALUES (?, ?, ?)",
+                           [(k, blob, now) for k, blob in rows])
+            _embedding_store_prune(db, now)
+        except Exception as e:
+            print(f"[embedding store ERROR] {str(e)}")
+
+
+def _embedding_lookup(keys: List[str]) -> Dict[str, np.ndarray]:
+    """Cached vectors for keys: memory LRU first, then one batched disk read."""
+    found: Dict[str, np.ndarray] = {}
+    disk: Dict[str, np.ndarray] = {}
+    with _embedding_lock:
+        for key in keys:
+            if key in _embedding_lru:
+                _embedding_lru.move_to_end(key)
+                found[key] = _embedding_lru[key]
+        _embedding_stats["memory_hits"] += len(found)
+    missing = [k for k in keys if k not in found]
+    rows = []
+    if missing:
+        with _embedding_store_lock:
+            db = _embedding_db()
+            if db is not None:
+                try:
+                    rows = db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(missing))})",
+                                      missing).fetchall()
+                except Exception:
+                    rows = []
+    disk = {k: np.frombuffer(blob, dtype=np.float16).astype(np.float32) for k, blob in rows}
+    found.update(disk)
+    if disk:
+        with _embedding_lock:
+            _embedding_stats["disk_hits"] += len(disk)
+        _embedding_remember(disk, persist=False)
+    return found
+
+
+def _embed_batch_loop():
+    """Worker: collect misses for EMBED_BATCH_WINDOW, then embed them in one call."""
+    while True:
+        with _embed_cv:
+            while not _embed_pending:
+                _embed_cv.wait()
+        time.sleep(EMBED_BATCH_WINDOW)
+        with _embed_cv:
+            batch = _embed_pending[:EMBED_BATCH_MAX]
+            del _embed_pending[:EMBED_BATCH_MAX]
+        
+        vectors = get_embeddings([text for _, text in batch])
+        with _embedding_lock:
+            _embedding_stats["api_calls"] += 1
+            _embedding_stats["api_inputs"] += len(batch)
+        results = {}
+        if vectors:
+            results = {key: np.asarray(v, dtype=np.float32) for (key, _), v in zip(batch, vectors)}
+            _embedding_remember(results)
+        with _embed_cv:
+            for key, _ in batch:
+                future = _embed_inflight.pop(key, None)
+                if future:
+                    future.set_result(results.get(key))
+
+
+def embed_texts(texts: List[str]) -> List[Optional[np.ndarray]]:
+    """
+    CACHED BATCH EMBEDDINGS: float32 vectors for texts (None where the API is unavailable).
+    Cache hits return immediately; misses from all threads are coalesced into batched API calls.
+    """
+    global _embed_worker
+    keys = [_embedding_key(t) for t in texts]
+    found = _embedding_lookup(list(dict.fromkeys(keys)))
+    if len(found) < len(set(keys)) and AZURE_API_KEY:
+        futures: Dict[str, concurrent.futures.Future] = {}
+        with _embed_cv:
+            if _embed_worker is None or not _embed_worker.is_alive():
+                _embed_worker = threading.Thread(target=_embed_batch_loop, name="council-embed", daemon=True)
+                _embed_worker.start()
+            for key, text in zip(keys, texts):
+                if key in found or key in futures:
+                    continue
+                if key not in _embed_inflight:
+                    _embed_inflight[key] = concurrent.futures.Future()
+                    _embed_pending.append((key, text[:8000]))
+                futures[key] = _embed_inflight[key]
+            _embed_cv.notify()
+        for key, future in futures.items():
+            try:
+                vector = future.result(timeout=EMBED_WAIT_TIMEOUT)
+            except Exception:
+                vector = None
+            if vector is not None:
+                found[key] = vector
+    return [found.get(key) for key in keys]
 
 
-def get_real_embedding(text: str) -> List[float]:
+def get_embedding_stats() -> Dict:
+    """Cache/batching counters (for the sidebar and benchmarks)."""
+    with _embedding_lock:
+        return dict(_embedding_stats, cached=len(_embedding_lru))
+
+
+def get_real_embedding(text: str) -> Optional[List[float]]:
     """
     TRUE EMBEDDINGS: Use Azure OpenAI embeddings API instead of hash.
-    Falls back to hash if API unavailable.
+    Served from the embedding cache / batcher. Returns None if the API is unavailable - local n-gram
+    vectors live in a different space and must never be stored next to API embeddings.
     """
-    if not AZURE_API_KEY:
-        # Fallback to hash
-        h = hashlib.sha256(text.encode()).digest()
-        return [(h[i % len(h)] / 255.0) * 2 - 1 for i in range(1536)]
-    
-    try:
-        url = f"{OPENAI_ENDPOINT}/text-embedding-3-large/embeddings?api-version=2024-10-21"
-        headers = {"Content-Type": "application/json", "api-key": AZURE_API_KEY}
-        response = requests.post(url, headers=headers, 
-            json={"input": text[:8000], "dimensions": 1536}, 
-            timeout=30)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get("data") and len(data["data"]) > 0:
-                return data["data"][0]["embedding"]
-    except:
-        pass
-    
-    # Fallback to hash
-    h = hashlib.sha256(text.encode()).digest()
-    return [(h[i % len(h)] / 255.0) * 2 - 1 for i in range(1536)]
+    vector = embed_texts([text])[0]
+    return vector.tolist() if vector is not None else None
+
+
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# LOCAL EMBEDDER - Feature-hashed word + character n-grams with TF-IDF weighting (no network)
+# Offline fallback for the embeddings API and a zero-latency first-stage retriever
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+LOCAL_EMBED_CHAR_NGRAMS = (3, 4, 5)   # Character n-grams within each padded word ("<word>")
+LOCAL_EMBED_CHAR_WEIGHT = 0.5         # Character features count half as much as whole words
+LOCAL_EMBED_MAX_TOKENS = 2000         # Words considered per text
+LOCAL_DF_BUCKETS = 1 << 18            # Document-frequency table resolution (hashed)
+LOCAL_INDEX_DF_BUCKETS = 1 << 16      # Per-user memory index embedders (256 KB of IDF statistics each)
+
+
+class LocalEmbedder:
+    """
+    Hashing-trick embedder: sublinear TF x IDF over word unigrams/bigrams and character n-grams,
+    signed-hashed into `dim` buckets. IDF is learned incrementally from fit() - one instance per corpus
+    (each memory index has its own); the shared instance is never fitted and weights all features equally.
+    """
+
+    def __init__(self, dim: int = 1536, df_buckets: int = LOCAL_DF_BUCKETS):
+        self.dim = dim
+        self.df_buckets = df_buckets
+        self.df = np.zeros(df_buckets, dtype=np.float32)
+        self.docs = 0
+        self.lock = threading.Lock()
+
+    def _features(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """(feature hashes, per-occurrence weights)."""
+        words = re.findall(r"\w+", text.lower())[:LOCAL_EMBED_MAX_TOKENS]
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        weights = [1.0] * len(features)
+        for word in words:
+            padded = f"<{word}>"
+            grams = [padded[i:i + n] for n in LOCAL_EMBED_CHAR_NGRAMS for i in range(len(padded) - n + 1)]
+            features.extend("#" + g for g in grams)
+            weights.extend([LOCAL_EMBED_CHAR_WEIGHT] * len(grams))
+        hashes = np.fromiter((zlib.crc32(f.encode()) for f in features), dtype=np.uint32, count=len(features))
+        return hashes, np.asarray(weights, dtype=np.float32)
+
+    def fit(self, texts: List[str]):
+        """Add documents to the IDF statistics."""
+        with self.lock:
+            for text in texts:
+                hashes, _ = self._features(text)
+                self.df[np.unique(hashes % self.df_buckets)] += 1
+                self.docs += 1
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Normalized float32 matrix (len(texts), dim)."""
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            hashes, weights = self._features(text)
+            if not len(hashes):
+                continue
+            unique, inverse = np.unique(hashes, return_inverse=True)
+            tf = np.log1p(np.bincount(inverse, weights=weights))
+            idf = np.log((self.docs + 1) / (self.df[unique % self.df_buckets] + 1)) + 1
+            signs = np.where((unique >> 31) & 1, -1.0, 1.0)
+            out[row] = np.bincount(unique % self.dim, weights=tf * idf * signs, minlength=self.dim)
+        return _normalize(out)
+
+
+_local_embedder = LocalEmbedder(EMBEDDING_DIMENSIONS)
+
+
+def local_embedding(text: str) -> np.ndarray:
+    """Offline embedding for one text (normalized float32)."""
+    return _local_embedder.embed([text])[0]
 
 
 def rate_response_quality(response: str) -> float:
@@ -1419,6 +4031,18 @@ def process_ai_commands(text: str) -> List[Tuple[str, str]]:
             if url:
                 commands.append(("github", url))
     
+    # Page ranges of cached PDFs: [PDF_PAGES: report.pdf | 12-15]
+    for match in re.finditer(r'\[(?:PDF[_\s]?)?PAGES[:\s]+([^\]|]+)\|\s*(\d+(?:\s*-\s*\d+)?)\s*\]', text, re.I):
+        commands.append(("file_pages", f"{match.group(1).strip()}|{match.group(2)}"))
+    
+    # Archive members: [ARCHIVE_FILE: src/app.py] / [ARCHIVE_FILE: repo.zip | src/*.py]
+    for match in ARCHIVE_FILE_PATTERN.finditer(text):
+        commands.append(("archive_file", match.group(1).strip()))
+    
+    # Cached table queries: [TABLE_QUERY: <table id> | <spec>]
+    for match in TABLE_QUERY_PATTERN.finditer(text):
+        commands.append(("table_query", f"{match.group(1)}|{match.group(2).strip()}"))
+    
     return commands
 
 
@@ -1565,6 +4189,173 @@ def needs_debate(text: str, query_type: str) -> bool:
     return any(trigger in lower for trigger in debate_triggers)
 
 
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# EMBEDDING ROUTER - NEAREST-CENTROID QUERY CLASSIFICATION
+# Replaces keyword scans ("error" -> code) with semantic routing over a labeled example set
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+ROUTER_LABELS = ['simple', 'code', 'creative', 'research', 'reasoning', 'general']
+ROUTER_CENTROIDS_PATH = os.path.join(CACHE_DIR, "router_centroids.npz")
+ROUTER_MIN_CONFIDENCE = 0.35    # Below this, fall back to keyword routing
+ROUTER_TEMPERATURE = 0.05       # Softmax temperature over centroid cosine similarities
+ROUTER_SIMPLE_MAX_CHARS = 200   # Long queries never take the fast path
+ROUTER_RETRY_SECONDS = 300      # Wait before retrying a failed centroid build
+
+# Labeled example set - centroids are rebuilt automatically when this list changes
+ROUTER_EXAMPLES: List[Tuple[str, str]] = [
+    ("hi", "simple"),
+    ("hello there!", "simple"),
+    ("thanks, that worked", "simple"),
+    ("good morning", "simple"),
+    ("what time is it", "simple"),
+    ("what's today's date?", "simple"),
+    ("who are you?", "simple"),
+    ("ok cool", "simple"),
+    ("how are you doing today", "simple"),
+    ("what is the capital of France?", "simple"),
+    ("write a python function that merges two sorted lists", "code"),
+    ("why does my react component re-render on every keystroke", "code"),
+    ("fix this TypeError: 'NoneType' object is not subscriptable", "code"),
+    ("convert this SQL query to use a left join", "code"),
+    ("build a REST API in node with express and JWT auth", "code"),
+    ("my docker build fails at the pip install step", "code"),
+    ("refactor this class to use dependency injection", "code"),
+    ("implement binary search in rust", "code"),
+    ("how do I parse JSON in Go", "code"),
+    ("write unit tests for this module", "code"),
+    ("write a short poem about the ocean at night", "creative"),
+    ("help me outline a fantasy novel with three main characters", "creative"),
+    ("come up with a catchy slogan for a coffee shop", "creative"),
+    ("write a bedtime story about a brave little fox", "creative"),
+    ("draft song lyrics about leaving home", "creative"),
+    ("brainstorm names for my indie game studio", "creative"),
+    ("rewrite this paragraph to sound more dramatic", "creative"),
+    ("describe a cyberpunk city at dawn", "creative"),
+    ("compare the market share of the top cloud providers", "research"),
+    ("summarize recent studies on intermittent fasting", "research"),
+    ("what are the main findings of the IPCC report", "research"),
+    ("give me an overview of battery chemistries used in EVs", "research"),
+    ("analyze the pros and cons of remote work based on surveys", "research"),
+    ("what does the literature say about spaced repetition", "research"),
+    ("find statistics on global smartphone adoption", "research"),
+    ("review the competitors for a meal-kit startup", "research"),
+    ("why is the sky blue", "reasoning"),
+    ("prove that the square root of 2 is irrational", "reasoning"),
+    ("explain the trolley problem and its ethical implications", "reasoning"),
+    ("if all bloops are razzies and some razzies are lazzies, are some bloops lazzies?", "reasoning"),
+    ("how does inflation affect interest rates", "reasoning"),
+    ("what would happen if the moon disappeared", "reasoning"),
+    ("explain the Monty Hall problem step by step", "reasoning"),
+    ("is free will compatible with determinism", "reasoning"),
+    ("give me a weekly meal plan for a vegetarian", "general"),
+    ("how should I prepare for a job interview", "general"),
+    ("plan a 5 day trip to Japan", "general"),
+    ("what's a good workout routine for beginners", "general"),
+    ("help me write an email asking my landlord to fix the heater", "general"),
+    ("recommend some productivity tips for working from home", "general"),
+    ("how do I care for a monstera plant", "general"),
+    ("tips for learning a new language quickly", "general"),
+]
+
+_router_state = {"centroids": None, "failed_at": 0.0}
+_router_lock = threading.Lock()
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize a vector or the rows of a matrix (float32)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def get_query_embedding(text: str) -> Optional[np.ndarray]:
+    """Normalized float32 embedding for a query (shared embedding cache). None if embeddings are unavailable."""
+    if not AZURE_API_KEY:
+        return None
+    vector = embed_texts([text])[0]
+    return _normalize(vector) if vector is not None else None
+
+
+def _router_signature() -> str:
+    """Fingerprint of the example set + embedding model, so stale centroids are never reused."""
+    payload = f"{json.dumps(ROUTER_EXAMPLES)}|{EMBEDDING_MODEL}|{EMBEDDING_DIMENSIONS}"
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def _load_router_centroids() -> bool:
+    """Load centroids from disk, or embed the example set (one batched call) and persist it."""
+    if _router_state["centroids"] is not None:
+        return True
+    if time.time() - _router_state["failed_at"] < ROUTER_RETRY_SECONDS:
+        return False
+
+    with _router_lock:
+        if _router_state["centroids"] is not None:
+            return True
+        signature = _router_signature()
+
+        try:
+            if os.path.exists(ROUTER_CENTROIDS_PATH):
+                data = np.load(ROUTER_CENTROIDS_PATH, allow_pickle=False)
+                if str(data["signature"]) == signature and list(data["labels"]) == ROUTER_LABELS:
+                    _router_state["centroids"] = data["centroids"].astype(np.float32)
+                    return True
+        except Exception as e:
+            print(f"[router] Could not load centroids: {str(e)}")
+
+        vectors = get_embeddings([text for text, _ in ROUTER_EXAMPLES])
+        if not vectors:
+            _router_state["failed_at"] = time.time()
+            return False
+
+        examples = _normalize(np.asarray(vectors, dtype=np.float32))
+        example_labels = np.array([label for _, label in ROUTER_EXAMPLES])
+        centroids = _normalize(np.stack([examples[example_labels == label].mean(axis=0) for label in ROUTER_LABELS]))
+        _router_state["centroids"] = centroids
+
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            np.savez(ROUTER_CENTROIDS_PATH, centroids=centroids, labels=np.array(ROUTER_LABELS),
+                     examples=examples, example_labels=example_labels, signature=np.array(signature))
+        except Exception as e:
+            print(f"[router] Could not save centroids: {str(e)}")
+        return True
+
+
+def route_query(text: str) -> Tuple[str, float]:
+    """
+    EMBEDDING ROUTER: Classify a query by nearest centroid over the labeled example set.
+    Returns (route, confidence) with route in ROUTER_LABELS.
+    Falls back to keyword routing when embeddings are unavailable or the router is unsure.
+    """
+    def keyword_route() -> str:
+        return 'simple' if is_simple_query(text) else classify_query(text)
+
+    # Code fences are structural, not a keyword guess
+    if '```' in text:
+        return 'code', 1.0
+
+    if not _load_router_centroids():
+        return keyword_route(), 0.0
+    query = get_query_embedding(text)
+    if query is None:
+        return keyword_route(), 0.0
+
+    sims = _router_state["centroids"] @ query
+    probs = np.exp((sims - sims.max()) / ROUTER_TEMPERATURE)
+    probs /= probs.sum()
+
+    order = np.argsort(-probs)
+    best = int(order[0])
+    if ROUTER_LABELS[best] == 'simple' and len(text) > ROUTER_SIMPLE_MAX_CHARS:
+        best = int(order[1])
+    confidence = float(probs[best])
+
+    if confidence < ROUTER_MIN_CONFIDENCE:
+        return keyword_route(), confidence
+    return ROUTER_LABELS[best], confidence
+
+
 
 def process_input_tools(user_input: str) -> Tuple[str, List[str]]:
     """Process user input for time, search, URL reading."""
@@ -1607,6 +4398,394 @@ def get_supabase():
     return _supabase
 
 
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# STORAGE BACKENDS - Supabase (default) or fully local SQLite (COUNCIL_STORAGE=sqlite)
+# All session/message/memory persistence goes through get_storage()
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+COUNCIL_STORAGE = os.getenv("COUNCIL_STORAGE", "supabase").lower()
+COUNCIL_SQLITE_PATH = os.getenv("COUNCIL_SQLITE_PATH", os.path.join(CACHE_DIR, "council.db"))
+
+
+class StorageBackend(ABC):
+    """
+    Persistence interface for sessions, messages and memories.
+    Methods raise on failure - the public helpers keep their own fallbacks.
+    """
+    name = "base"
+    inline_attachments = False  # True if the backend cannot store attachments separately
+
+    @abstractmethod
+    def create_session(self, data: Dict) -> str:
+        ...
+
+    @abstractmethod
+    def list_sessions(self, user_id: str = None, limit: int = 20) -> List[Dict]:
+        ...
+
+    @abstractmethod
+    def get_session(self, session_id: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    def update_session(self, session_id: str, fields: Dict):
+        ...
+
+    @abstractmethod
+    def delete_session(self, session_id: str):
+        ...
+
+    @abstractmethod
+    def upsert_messages(self, rows: List[Dict]):
+        """Multi-row insert, idempotent on idempotency_key."""
+
+    @abstractmethod
+    def get_messages(self, session_id: str, after: str = None, before: str = None,
+                     limit: int = None, newest_first: bool = False) -> List[Dict]:
+        """Messages ordered by created_at, optionally bounded (exclusive) by after/before."""
+
+    @abstractmethod
+    def insert_memory(self, row: Dict):
+        ...
+
+    @abstractmethod
+    def match_memories(self, embedding: List[float], user_id: str = None,
+                       threshold: float = 0.6, count: int = 5) -> List[str]:
+        ...
+
+    @abstractmethod
+    def get_memories(self, user_id: str = None, limit: int = 5000, after: str = None) -> List[Dict]:
+        """
+        Newest memories with their embeddings: [{id, content, embedding (float32 array), created_at}],
+        only those created after `after` when given.
+        """
+
+    @abstractmethod
+    def delete_memories(self, ids: List):
+        ...
+
+    @abstractmethod
+    def put_attachments(self, rows: List[Dict]):
+        """Store attachment blobs, idempotent on sha256."""
+
+    @abstractmethod
+    def get_attachment(self, sha256: str) -> Optional[Dict]:
+        ...
+
+    @abstractmethod
+    def put_attachment_owners(self, rows: List[Dict]):
+        """Record which users may read an attachment ({sha256, user_id}; "" = anonymous), idempotent."""
+
+    @abstractmethod
+    def attachment_owned(self, sha256: str, user_id: str) -> bool:
+        ...
+
+
+class SupabaseStorage(StorageBackend):
+    name = "supabase"
+
+    def __init__(self, db):
+        self.db = db
+        self.keyless = False  # messages table has no idempotency_key column
+        self.inline_attachments = False  # Set on the first missing-table error - messages then carry resolved content
+
+    def create_session(self, data: Dict) -> str:
+        return self.db.table("chat_sessions").insert(data).execute().data[0]["id"]
+
+    def list_sessions(self, user_id: str = None, limit: int = 20) -> List[Dict]:
+        query = self.db.table("chat_sessions").select("*").order("created_at", desc=True).limit(limit)
+        if user_id:
+            query = query.eq("user_id", user_id)
+        return query.execute().data or []
+
+    def get_session(self, session_id: str) -> Optional[Dict]:
+        # Older schemas have no summary_offset column
+        try:
+            result = self.db.table("chat_sessions").select("summary, summary_offset").eq("id", session_id).execute()
+        except Exception:
+            result = self.db.table("chat_sessions").select("summary").eq("id", session_id).execute()
+        return result.data[0] if result.data else None
+
+    def update_session(self, session_id: str, fields: Dict):
+        try:
+            self.db.table("chat_sessions").update(fields).eq("id", session_id).execute()
+        except Exception:
+            if "summary_offset" not in fields:
+                raise
+            fields = {k: v for k, v in fields.items() if k != "summary_offset"}
+            self.db.table("chat_sessions").update(fields).eq("id", session_id).execute()
+
+    def delete_session(self, session_id: str):
+        self.db.table("messages").delete().eq("session_id", session_id).execute()
+        self.db.table("chat_sessions").delete().eq("id", session_id).execute()
+
+    def upsert_messages(self, rows: List[Dict]):
+        if self.inline_attachments:
+            rows = [dict(r, content=resolve_attachments(r.get("content"), session_user(r["session_id"]))) for r in rows]
+        if not self.keyless:
+            try:
+                self.db.table("messages").upsert(rows, on_conflict="idempotency_key", ignore_duplicates=True).execute()
+                return
+            except Exception as e:
+                if "idempotency_key" not in str(e):
+                    raise
+                print("[storage] messages.idempotency_key column missing - falling back to plain inserts")
+                self.keyless = True
+        self.db.table("messages").insert([{k: v for k, v in r.items() if k != "idempotency_key"} for r in rows]).execute()
+
+    def get_messages(self, session_id: str, after: str = None, before: str = None,
+                     limit: int = None, newest_first: bool = False) -> List[Dict]:
+        query = self.db.table("messages").select("*").eq("session_id", session_id)
+        if after:
+            query = query.gt("created_at", after)
+        if before:
+            query = query.lt("created_at", before)
+        query = query.order("created_at", desc=newest_first)
+        if limit:
+            query = query.limit(limit)
+        return query.execute().data or []
+
+    def insert_memory(self, row: Dict):
+        self.db.table("memories").insert(row).execute()
+
+    def match_memories(self, embedding: List[float], user_id: str = None,
+                       threshold: float = 0.6, count: int = 5) -> List[str]:
+        params = {"query_embedding": embedding, "match_threshold": threshold, "match_count": count}
+        if user_id:
+            params["p_user_id"] = user_id
+        return [m["content"] for m in self.db.rpc("match_memories", params).execute().data]
+
+    def get_memories(self, user_id: str = None, limit: int = 5000, after: str = None) -> List[Dict]:
+        # PostgREST caps rows per response (max-rows) - page until `limit` or a short page
+        rows = []
+        while len(rows) < limit:
+            size = min(MEMORY_FETCH_PAGE, limit - len(rows))
+            query = self.db.table("memories").select("id, content, embedding, created_at").order("created_at", desc=True)
+            if user_id:
+                query = query.eq("user_id", user_id)
+            if after:
+                query = query.gt("created_at", after)
+            page = query.range(len(rows), len(rows) + size - 1).execute().data or []
+            rows.extend(page)
+            if len(page) < size:
+                break
+        for row in rows:
+            # pgvector columns come back as "[0.1,0.2,...]" strings
+            embedding = row.get("embedding")
+            if isinstance(embedding, str):
+                embedding = json.loads(embedding)
+            row["embedding"] = np.asarray(embedding or [], dtype=np.float32)
+        return rows
+
+    def delete_memories(self, ids: List):
+        for start in range(0, len(ids), 100):
+            self.db.table("memories").delete().in_("id", ids[start:start + 100]).execute()
+
+    def put_attachments(self, rows: List[Dict]):
+        if self.inline_attachments:
+            return
+        try:
+            self.db.table("attachments").upsert(rows, on_conflict="sha256", ignore_duplicates=True).execute()
+        except Exception as e:
+            if "attachments" not in str(e):
+                raise
+            print("[storage] attachments table missing - storing attachments inline in messages")
+            self.inline_attachments = True
+
+    def get_attachment(self, sha256: str) -> Optional[Dict]:
+        if self.inline_attachments:
+            return None
+        result = self.db.table("attachments").select("*").eq("sha256", sha256).execute()
+        return result.data[0] if result.data else None
+
+    def put_attachment_owners(self, rows: List[Dict]):
+        if self.inline_attachments:
+            return
+        try:
+            self.db.table("attachment_owners").upsert(rows, on_conflict="sha256,user_id", ignore_duplicates=True).execute()
+        except Exception as e:
+            if "attachment_owners" not in str(e):
+                raise
+            # Unscoped attachments must not be readable by everyone - keep content in the (owned) messages instead
+            print("[storage] attachment_owners table missing - storing attachments inline in messages")
+            self.inline_attachments = True
+
+    def attachment_owned(self, sha256: str, user_id: str) -> bool:
+        if self.inline_attachments:
+            return False
+        result = self.db.table("attachment_owners").select("sha256").eq("sha256", sha256).eq("user_id", user_id).limit(1).execute()
+        return bool(result.data)
+
+
+class SQLiteStorage(StorageBackend):
+    """Single-node storage: one local SQLite file (WAL), no network round trips."""
+    name = "sqlite"
+
+    MESSAGE_COLUMNS = ["id", "idempotency_key", "session_id", "role", "agent_name", "content", "created_at"]
+    SESSION_COLUMNS = ["id", "user_id", "title", "theme", "summary", "summary_offset", "created_at"]
+
+    def __init__(self, path: str):
+        import sqlite3
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS chat_sessions (
+                id TEXT PRIMARY KEY, user_id TEXT, title TEXT, theme TEXT,
+                summary TEXT, summary_offset INTEGER DEFAULT 0, created_at TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS idx_sessions_user_created ON chat_sessions(user_id, created_at);
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, idempotency_key TEXT UNIQUE, session_id TEXT NOT NULL,
+                role TEXT, agent_name TEXT, content TEXT, created_at TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS idx_messages_session_created ON messages(session_id, created_at);
+            CREATE TABLE IF NOT EXISTS memories (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, content TEXT, embedding BLOB, created_at TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS idx_memories_user_created ON memories(user_id, created_at);
+            CREATE TABLE IF NOT EXISTS attachments (
+                sha256 TEXT PRIMARY KEY, name TEXT, content TEXT NOT NULL, size INTEGER, created_at TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS attachment_owners (
+                sha256 TEXT NOT NULL, user_id TEXT NOT NULL, PRIMARY KEY (sha256, user_id));
+        """)
+
+    def _rows(self, sql: str, params: tuple, columns: List[str]) -> List[Dict]:
+        with self.lock:
+            return [dict(zip(columns, row)) for row in self.conn.execute(sql, params).fetchall()]
+
+    def create_session(self, data: Dict) -> str:
+        session_id = str(uuid.uuid4())
+        with self.lock:
+            self.conn.execute("INSERT INTO chat_sessions (id, user_id, title, theme, created_at) VALUES (?, ?, ?, ?, ?)",
+                              (session_id, data.get("user_id"), data.get("title"), data.get("theme"), data["created_at"]))
+        return session_id
+
+    def list_sessions(self, user_id: str = None, limit: int = 20) -> List[Dict]:
+        columns = ", ".join(self.SESSION_COLUMNS)
+        if user_id:
+            return self._rows(f"SELECT {columns} FROM chat_sessions WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+                              (user_id, limit), self.SESSION_COLUMNS)
+        return self._rows(f"SELECT {columns} FROM chat_sessions ORDER BY created_at DESC LIMIT ?",
+                          (limit,), self.SESSION_COLUMNS)
+
+    def get_session(self, session_id: str) -> Optional[Dict]:
+        rows = self._rows(f"SELECT {', '.join(self.SESSION_COLUMNS)} FROM chat_sessions WHERE id = ?",
+                          (session_id,), self.SESSION_COLUMNS)
+        return rows[0] if rows else None
+
+    def update_session(self, session_id: str, fields: Dict):
+        fields = {k: v for k, v in fields.items() if k in self.SESSION_COLUMNS and k != "id"}
+        if fields:
+            with self.lock:
+                self.conn.execute(f"UPDATE chat_sessions SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                                  list(fields.values()) + [session_id])
+
+    def delete_session(self, session_id: str):
+        with self.lock:
+            self.conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self.conn.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
+
+    def upsert_messages(self, rows: List[Dict]):
+        columns = self.MESSAGE_COLUMNS[1:]
+        with self.lock:
+            self.conn.executemany(
+                f"INSERT OR IGNORE INTO messages ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                [[r.get(c) for c in columns] for r in rows])
+
+    def get_messages(self, session_id: str, after: str = None, before: str = None,
+                     limit: int = None, newest_first: bool = False) -> List[Dict]:
+        sql = f"SELECT {', '.join(self.MESSAGE_COLUMNS)} FROM messages WHERE session_id = ?"
+        params: list = [session_id]
+        if after:
+            sql += " AND created_at > ?"
+            params.append(after)
+        if before:
+            sql += " AND created_at < ?"
+            params.append(before)
+        sql += f" ORDER BY created_at {'DESC' if newest_first else 'ASC'}"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self._rows(sql, tuple(params), self.MESSAGE_COLUMNS)
+
+    def insert_memory(self, row: Dict):
+        vector = np.asarray(row.get("embedding") or [], dtype=np.float32)
+        with self.lock:
+            self.conn.execute("INSERT INTO memories (user_id, content, embedding, created_at) VALUES (?, ?, ?, ?)",
+                              (row.get("user_id"), row["content"], vector.tobytes(), row["created_at"]))
+
+    def match_memories(self, embedding: List[float], user_id: str = None,
+                       threshold: float = 0.6, count: int = 5) -> List[str]:
+        if user_id:
+            rows = self._rows("SELECT content, embedding FROM memories WHERE user_id = ?", (user_id,), ["content", "embedding"])
+        else:
+            rows = self._rows("SELECT content, embedding FROM memories", (), ["content", "embedding"])
+        query = _normalize(np.asarray(embedding, dtype=np.float32))
+        rows = [r for r in rows if r["embedding"] and len(r["embedding"]) == query.nbytes]
+        if not rows:
+            return []
+        sims = _normalize(np.stack([np.frombuffer(r["embedding"], dtype=np.float32) for r in rows])) @ query
+        order = [i for i in np.argsort(-sims)[:count] if sims[i] >= threshold]
+        return [rows[i]["content"] for i in order]
+
+    def get_memories(self, user_id: str = None, limit: int = 5000, after: str = None) -> List[Dict]:
+        columns = ["id", "content", "embedding", "created_at"]
+        where, params = ["created_at > ?"] if after else [], [after] if after else []
+        if user_id:
+            where.append("user_id = ?")
+            params.append(user_id)
+        rows = self._rows(f"SELECT id, content, embedding, created_at FROM memories {'WHERE ' + ' AND '.join(where) if where else ''} "
+                          "ORDER BY created_at DESC LIMIT ?", (*params, limit), columns)
+        for row in rows:
+            row["embedding"] = np.frombuffer(row["embedding"] or b"", dtype=np.float32)
+        return rows
+
+    def delete_memories(self, ids: List):
+        with self.lock:
+            self.conn.executemany("DELETE FROM memories WHERE id = ?", [(i,) for i in ids])
+
+    def put_attachments(self, rows: List[Dict]):
+        with self.lock:
+            self.conn.executemany("INSERT OR IGNORE INTO attachments (sha256, name, content, size, created_at) VALUES (?, ?, ?, ?, ?)",
+                                  [(r["sha256"], r.get("name"), r["content"], r.get("size"), r["created_at"]) for r in rows])
+
+    def get_attachment(self, sha256: str) -> Optional[Dict]:
+        rows = self._rows("SELECT sha256, name, content, size, created_at FROM attachments WHERE sha256 = ?",
+                          (sha256,), ["sha256", "name", "content", "size", "created_at"])
+        return rows[0] if rows else None
+
+    def put_attachment_owners(self, rows: List[Dict]):
+        with self.lock:
+            self.conn.executemany("INSERT OR IGNORE INTO attachment_owners (sha256, user_id) VALUES (?, ?)",
+                                  [(r["sha256"], r["user_id"]) for r in rows])
+
+    def attachment_owned(self, sha256: str, user_id: str) -> bool:
+        return bool(self._rows("SELECT 1 FROM attachment_owners WHERE sha256 = ? AND user_id = ? LIMIT 1",
+                               (sha256, user_id), ["found"]))
+
+
+_storage: Optional[StorageBackend] = None
+_storage_lock = threading.Lock()
+
+
+def get_storage() -> Optional[StorageBackend]:
+    """The configured storage backend, or None if it is unavailable (callers fall back to local)."""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                try:
+                    if COUNCIL_STORAGE == "sqlite":
+                        _storage = SQLiteStorage(COUNCIL_SQLITE_PATH)
+                    else:
+                        db = get_supabase()
+                        if db:
+                            _storage = SupabaseStorage(db)
+                except Exception as e:
+                    print(f"[get_storage ERROR] {str(e)}")
+    return _storage
+
+
 def register_user(email: str, password: str) -> Tuple[Optional[str], Optional[str]]:
     try:
         db = get_supabase()
@@ -1668,13 +4847,14 @@ def update_user_profile(user_id: str, theme: str):
 
 def create_session(title: str, theme: str, user_id: str = None) -> str:
     try:
-        db = get_supabase()
-        if db:
+        storage = get_storage()
+        if storage:
             data = {"title": (title or "New Quest")[:100], "theme": theme, "created_at": datetime.now(timezone.utc).isoformat()}
             if user_id:
                 data["user_id"] = user_id
-            result = db.table("chat_sessions").insert(data).execute()
-            return result.data[0]["id"]
+            session_id = storage.create_session(data)
+            register_session_user(session_id, user_id)
+            return session_id
     except:
         pass
     return f"local-{hashlib.md5(f'{title}{time.time()}'.encode()).hexdigest()[:16]}"
@@ -1682,57 +4862,669 @@ def create_session(title: str, theme: str, user_id: str = None) -> str:
 
 def update_session_title(session_id: str, title: str):
     try:
-        db = get_supabase()
-        if db and not session_id.startswith("local-"):
-            db.table("chat_sessions").update({"title": title[:100]}).eq("id", session_id).execute()
+        storage = get_storage()
+        if storage and not session_id.startswith("local-"):
+            storage.update_session(session_id, {"title": title[:100]})
     except:
         pass
 
 
 def delete_session(session_id: str):
     try:
-        db = get_supabase()
-        if db and not session_id.startswith("local-"):
-            db.table("messages").delete().eq("session_id", session_id).execute()
-            db.table("chat_sessions").delete().eq("id", session_id).execute()
+        storage = get_storage()
+        if storage and not session_id.startswith("local-"):
+            storage.delete_session(session_id)
     except:
         pass
-
-# Local message cache for when Supabase fails
-_local_messages: Dict[str, List[Dict]] = {}
+    with _history_lock:
+        _history_cache.pop(session_id, None)
+    remove_session_documents(session_id)
+    _drop_session_files(session_id)
 
 def get_sessions(user_id: str = None) -> List[Dict]:
     """Get recent sessions, including local fallback sessions."""
     sessions = []
     
-    # Try Supabase
+    # Try the storage backend
     try:
-        db = get_supabase()
-        if db:
-            query = db.table("chat_sessions").select("*").order("created_at", desc=True).limit(20)
-            if user_id:
-                query = query.eq("user_id", user_id)
-            result = query.execute()
-            if result.data:
-                sessions = result.data
+        storage = get_storage()
+        if storage:
+            sessions = storage.list_sessions(user_id, limit=20)
     except Exception as e:
         print(f"[get_sessions ERROR] {str(e)}")
     
-    # Add local sessions (if any messages exist for them)
-    for session_id in _local_messages.keys():
-        if not any(s.get('id') == session_id for s in sessions):
-            msgs = _local_messages[session_id]
-            if msgs:
-                sessions.append({
-                    'id': session_id,
-                    'title': msgs[0].get('content', 'Local Chat')[:30] if msgs else 'Local Chat',
-                    'created_at': msgs[0].get('created_at', '') if msgs else ''
-                })
+    # Add local sessions (local-only chats + chats with unsynced messages in the journal)
+    for local in _journal_sessions():
+        if not any(s.get('id') == local['id'] for s in sessions):
+            sessions.append(local)
     
     return sessions
 
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# DURABLE LOCAL JOURNAL - SQLite (WAL) record of every message until Supabase confirms it
+# Survives restarts; replayed in the background with multi-row idempotent upserts
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+LOCAL_JOURNAL_PATH = os.path.join(CACHE_DIR, "journal.db")
+JOURNAL_SYNC_INTERVAL = 30       # Seconds between background replays while a backlog exists
+JOURNAL_SYNC_BATCH = 500         # Max rows replayed per pass
+JOURNAL_RETENTION = 24 * 3600    # Seconds synced rows are kept before pruning
+JOURNAL_REPLAY_GRACE = 30        # Seconds a fresh row is left to the write-behind worker before replay
+
+_journal_conn = None
+_journal_lock = threading.Lock()
+_journal_syncer: Optional[threading.Thread] = None
+_journal_state = {"last_sync_ms": 0.0, "synced": 0, "sync_failures": 0}
+JOURNAL_COLUMNS = ["idempotency_key", "session_id", "role", "agent_name", "content", "created_at"]
+
+
+def _journal():
+    """Lazily open the journal (WAL mode, one shared connection guarded by _journal_lock)."""
+    global _journal_conn
+    if _journal_conn is None:
+        import sqlite3
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(LOCAL_JOURNAL_PATH, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS journal (
+            idempotency_key TEXT PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            role TEXT,
+            agent_name TEXT,
+            content TEXT,
+            created_at TEXT NOT NULL,
+            synced INTEGER NOT NULL DEFAULT 0,
+            synced_at REAL
+        )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_journal_session ON journal(session_id, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_journal_unsynced ON journal(synced, created_at)")
+        conn.execute("""CREATE TABLE IF NOT EXISTS attachments (
+            sha256 TEXT PRIMARY KEY,
+            name TEXT,
+            content TEXT NOT NULL,
+            size INTEGER,
+            created_at REAL NOT NULL,
+            synced INTEGER NOT NULL DEFAULT 0
+        )""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS attachment_owners (
+            sha256 TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            synced INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (sha256, user_id)
+        )""")
+        # Upload failures per row - rows that keep failing are quarantined (synced = -1)
+        for table, column in [("attachments", "attempts INTEGER NOT NULL DEFAULT 0"),
+                              ("attachment_owners", "attempts INTEGER NOT NULL DEFAULT 0"),
+                              ("attachment_owners", "created_at REAL NOT NULL DEFAULT 0")]:
+            if column.split()[0] not in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+        _journal_conn = conn
+    return _journal_conn
+
+
+def _journal_record(msg: Dict):
+    """Durably record a message (unsynced) before anything else happens to it."""
+    try:
+        with _journal_lock:
+            _journal().execute(
+                f"INSERT OR IGNORE INTO journal ({', '.join(JOURNAL_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)",
+                [msg.get(c) for c in JOURNAL_COLUMNS])
+    except Exception as e:
+        print(f"[journal ERROR] {str(e)}")
+
+
+def _journal_mark_synced(keys: List[str]):
+    if not keys:
+        return
+    try:
+        with _journal_lock:
+            conn = _journal()
+            now = time.time()
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                conn.execute(f"UPDATE journal SET synced = 1, synced_at = ? WHERE idempotency_key IN ({','.join('?' * len(chunk))})",
+                             [now] + chunk)
+            conn.execute("DELETE FROM journal WHERE synced = 1 AND synced_at < ?", (now - JOURNAL_RETENTION,))
+            conn.execute("DELETE FROM attachments WHERE synced = 1 AND created_at < ?", (now - JOURNAL_RETENTION,))
+    except Exception as e:
+        print(f"[journal ERROR] {str(e)}")
+
+
+def _journal_messages(session_id: str) -> List[Dict]:
+    """All journaled messages for a session (local sessions live here entirely)."""
+    try:
+        with _journal_lock:
+            rows = _journal().execute(
+                f"SELECT {', '.join(JOURNAL_COLUMNS)} FROM journal WHERE session_id = ? ORDER BY created_at",
+                (session_id,)).fetchall()
+        return [dict(zip(JOURNAL_COLUMNS, row)) for row in rows]
+    except Exception as e:
+        print(f"[journal ERROR] {str(e)}")
+        return []
+
+
+def _journal_sessions() -> List[Dict]:
+    """Sessions that only exist locally or still have unsynced messages."""
+    try:
+        with _journal_lock:
+            rows = _journal().execute("""
+                SELECT session_id, MIN(created_at),
+                       (SELECT content FROM journal j2 WHERE j2.session_id = j.session_id ORDER BY created_at LIMIT 1)
+                FROM journal j WHERE synced = 0 OR session_id LIKE 'local-%'
+                GROUP BY session_id ORDER BY MIN(created_at) DESC LIMIT 20""").fetchall()
+        return [{'id': sid, 'title': (first or 'Local Chat')[:30], 'created_at': created}
+                for sid, created, first in rows]
+    except Exception as e:
+        print(f"[journal ERROR] {str(e)}")
+        return []
+
+
+def sync_journal() -> int:
+    """Replay unsynced journal rows to the storage backend (per session, in order). Returns rows synced."""
+    storage = get_storage()
+    if not storage:
+        return 0
+    try:
+        with _journal_lock:
+            rows = _journal().execute(
+                f"SELECT {', '.join(JOURNAL_COLUMNS)} FROM journal WHERE synced = 0 AND session_id NOT LIKE 'local-%' "
+                "AND length(session_id) >= 32 ORDER BY created_at LIMIT ?", (JOURNAL_SYNC_BATCH,)).fetchall()
+    except Exception as e:
+        print(f"[journal ERROR] {str(e)}")
+        return 0
+    
+    # Rows still queued for (or inside) the write-behind worker belong to it - replaying them too would
+    # write duplicates wherever the backend cannot dedupe on idempotency_key. Fresh rows may not be queued yet.
+    with _write_cv:
+        queued = {m["idempotency_key"] for m in _write_pending} | {m["idempotency_key"] for m in _write_inflight}
+    cutoff = (time.time() - JOURNAL_REPLAY_GRACE) * 1_000_000
+    msgs = [dict(zip(JOURNAL_COLUMNS, row)) for row in rows]
+    msgs = [m for m in msgs if m["idempotency_key"] not in queued and _ts_micros(m["created_at"]) < cutoff]
+    if msgs:
+        # The worker marks rows synced before releasing them - drop any it finished since the select
+        try:
+            keys = [m["idempotency_key"] for m in msgs]
+            with _journal_lock:
+                done = {k for (k,) in _journal().execute(
+                    f"SELECT idempotency_key FROM journal WHERE synced = 1 AND idempotency_key IN ({','.join('?' * len(keys))})",
+                    keys).fetchall()}
+            msgs = [m for m in msgs if m["idempotency_key"] not in done]
+        except Exception as e:
+            print(f"[journal ERROR] {str(e)}")
+            return 0
+    
+    started = time.perf_counter()
+    by_session: Dict[str, List[Dict]] = {}
+    for msg in msgs:
+        by_session.setdefault(msg["session_id"], []).append(msg)
+    
+    synced = 0
+    for session_id, msgs in by_session.items():
+        try:
+            for i in range(0, len(msgs), WRITE_BATCH_MAX_ROWS):
+                chunk = msgs[i:i + WRITE_BATCH_MAX_ROWS]
+                if not _upload_attachments(_referenced_shas(chunk)):
+                    raise RuntimeError("referenced attachments not uploaded yet")
+                storage.upsert_messages(chunk)
+                _journal_mark_synced([m["idempotency_key"] for m in chunk])
+                synced += len(chunk)
+        except Exception as e:
+            _journal_state["sync_failures"] += 1
+            print(f"[sync_journal ERROR] session_id={session_id}, error={str(e)}")
+    
+    if msgs:
+        _journal_state["last_sync_ms"] = (time.perf_counter() - started) * 1000
+        _journal_state["synced"] += synced
+    return synced
+
+
+def get_journal_stats() -> Dict:
+    """Backlog metrics for the local journal."""
+    stats = {"unsynced": 0, "local_only": 0, "oldest_unsynced_age": 0.0,
+             "last_sync_ms": _journal_state["last_sync_ms"], "synced": _journal_state["synced"],
+             "sync_failures": _journal_state["sync_failures"]}
+    try:
+        with _journal_lock:
+            conn = _journal()
+            unsynced, oldest = conn.execute(
+                "SELECT COUNT(*), MIN(created_at) FROM journal WHERE synced = 0 AND session_id NOT LIKE 'local-%'").fetchone()
+            stats["local_only"] = conn.execute("SELECT COUNT(*) FROM journal WHERE session_id LIKE 'local-%'").fetchone()[0]
+        stats["unsynced"] = unsynced
+        if oldest:
+            stats["oldest_unsynced_age"] = max(0.0, time.time() - _ts_micros(oldest) / 1_000_000)
+    except Exception as e:
+        print(f"[journal ERROR] {str(e)}")
+    return stats
+
+
+def _journal_sync_loop():
+    while True:
+        time.sleep(JOURNAL_SYNC_INTERVAL)
+        try:
+            if get_journal_stats()["unsynced"]:
+                sync_journal()
+        except Exception as e:
+            print(f"[journal sync ERROR] {str(e)}")
+
+
+def _ensure_journal_syncer():
+    """Background replay thread (also picks up backlog left by a previous process)."""
+    global _journal_syncer
+    if _journal_syncer is None or not _journal_syncer.is_alive():
+        _journal_syncer = threading.Thread(target=_journal_sync_loop, name="council-journal-sync", daemon=True)
+        _journal_syncer.start()
+
+
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# ATTACHMENT STORE - Uploaded blocks stored once by sha256, messages hold lightweight references
+# [ATTACHMENT: name | sha256=<hex> | N chars] is resolved lazily (RAM -> journal -> storage)
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+ATTACHMENT_MIN_CHARS = 1000                    # Smaller blocks stay inline
+ATTACHMENT_CACHE_MAX_BYTES = 32 * 1024 * 1024  # Resolved attachments kept in RAM
+ATTACHMENT_UPLOAD_BATCH = 50                   # Attachments per upsert ...
+ATTACHMENT_UPLOAD_BATCH_BYTES = 8 * 1024 * 1024  # ... and at most this much content per upsert
+ATTACHMENT_UPLOAD_MAX_BYTES = 32 * 1024 * 1024   # Larger blocks are never uploaded (kept in the local journal)
+ATTACHMENT_STREAMED_MAX_BYTES = 16 * 1024 * 1024  # Streamed uploads copied into the store; larger live only as blobs
+ATTACHMENT_UPLOAD_MAX_ATTEMPTS = 5             # Failed uploads of one row before it is quarantined ...
+ATTACHMENT_QUARANTINE_AGE = 3600               # ... once it is also this many seconds old (a short outage doesn't)
+ATTACHMENT_PATTERN = re.compile(
+    r'\[(?:FILE|EXCEL|CSV|WORD|POWERPOINT): ([^\]\n]+)\]\n(?:(?:Columns|Rows): [^\n]*\n){0,2}```[^\n]*\n[\s\S]*?```')
+ATTACHMENT_REF_PATTERN = re.compile(r'\[ATTACHMENT: ([^|\]\n]+) \| sha256=([0-9a-f]{64}) \| ([\d,]+) chars\]')
+
+_attachment_cache: "OrderedDict[str, str]" = OrderedDict()
+_attachment_cache_bytes = 0
+_attachment_lock = threading.Lock()
+# Streamed uploads are copied into the attachment store off the request thread
+_attachment_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="council-attach")
+
+
+def _attachment_remember(sha: str, block: str):
+    global _attachment_cache_bytes
+    with _attachment_lock:
+        if sha not in _attachment_cache:
+            _attachment_cache[sha] = block
+            _attachment_cache_bytes += len(block)
+        _attachment_cache.move_to_end(sha)
+        while _attachment_cache_bytes > ATTACHMENT_CACHE_MAX_BYTES and len(_attachment_cache) > 1:
+            _, evicted = _attachment_cache.popitem(last=False)
+            _attachment_cache_bytes -= len(evicted)
+
+
+def _attachment_add_owner(sha: str, user_id: str = None):
+    """Record user_id (None = anonymous) as allowed to read the attachment / streamed file sha."""
+    try:
+        with _journal_lock:
+            _journal().execute("INSERT OR IGNORE INTO attachment_owners (sha256, user_id, created_at) VALUES (?, ?, ?)",
+                               (sha, user_id or "", time.time()))
+    except Exception as e:
+        print(f"[attachment ERROR] {str(e)}")
+
+
+def store_attachment(name: str, block: str, user_id: str = None) -> str:
+    """
+    Store an attachment block once (journal first, uploaded by the write-behind worker) and record
+    user_id as one of its owners - the block is shared, read access is per user. Returns its sha256.
+    """
+    sha = hashlib.sha256(block.encode("utf-8", errors="replace")).hexdigest()
+    try:
+        with _journal_lock:
+            _journal().execute("INSERT OR IGNORE INTO attachments (sha256, name, content, size, created_at) VALUES (?, ?, ?, ?, ?)",
+                               (sha, name, block, len(block), time.time()))
+    except Exception as e:
+        print(f"[attachment ERROR] {str(e)}")
+    _attachment_add_owner(sha, user_id)
+    _attachment_remember(sha, block)
+    return sha
+
+
+def store_streamed_attachment(name: str, sha: str):
+    """
+    Copy a streamed upload's blob into the attachment store under its own sha256: the message only holds
+    a reference, and the local blob goes when the session idles or on another instance. Blobs over
+    ATTACHMENT_STREAMED_MAX_BYTES are not copied (excerpts come from the blob while it exists) - a second
+    full copy of a multi-hundred-MB log would defeat streaming it. The owner is recorded at ingestion.
+    """
+    try:
+        size = os.path.getsize(_file_blob_path(sha))
+        if not size or size > ATTACHMENT_STREAMED_MAX_BYTES:
+            return
+        with _journal_lock:
+            if _journal().execute("SELECT 1 FROM attachments WHERE sha256 = ?", (sha,)).fetchone():
+                return
+        text = file_read_bytes(sha).decode("utf-8", errors="replace")
+        with _journal_lock:
+            _journal().execute("INSERT OR IGNORE INTO attachments (sha256, name, content, size, created_at) VALUES (?, ?, ?, ?, ?)",
+                               (sha, name, text, size, time.time()))
+    except Exception as e:
+        print(f"[attachment ERROR] Streamed {name}: {str(e)}")
+
+
+def externalize_attachments(content: str, user_id: str = None) -> str:
+    """Replace inlined upload blocks with [ATTACHMENT: ...] references owned by user_id."""
+    if "```" not in content:
+        return content
+    
+    def to_ref(match):
+        block = match.group(0)
+        if len(block) < ATTACHMENT_MIN_CHARS:
+            return block
+        name = match.group(1).strip()
+        return f"[ATTACHMENT: {name} | sha256={store_attachment(name, block, user_id)} | {len(block):,} chars]"
+    return ATTACHMENT_PATTERN.sub(to_ref, content)
+
+
+def attachment_refs(content: str) -> List[Tuple[str, str, int]]:
+    """[(name, sha256, chars)] referenced by a message."""
+    return [(name, sha, int(chars.replace(",", ""))) for name, sha, chars in ATTACHMENT_REF_PATTERN.findall(content or "")]
+
+
+def _attachment_owned(sha: str, user_id: str = None) -> bool:
+    """Whether user_id (None = anonymous) stored this attachment: local journal, then the storage backend."""
+    try:
+        with _journal_lock:
+            if _journal().execute("SELECT 1 FROM attachment_owners WHERE sha256 = ? AND user_id = ?",
+                                  (sha, user_id or "")).fetchone():
+                return True
+    except Exception as e:
+        print(f"[attachment ERROR] {str(e)}")
+    try:
+        storage = get_storage()
+        return bool(storage and storage.attachment_owned(sha, user_id or ""))
+    except Exception as e:
+        print(f"[attachment ERROR] Owner check {sha[:12]} failed: {str(e)}")
+        return False
+
+
+def get_attachment(sha: str, user_id: str = None) -> Optional[str]:
+    """Attachment block by sha256 - only for a user who stored it (None if missing or not theirs)."""
+    if not _attachment_owned(sha, user_id):
+        return None
+    return _attachment_content(sha)
+
+
+def _attachment_content(sha: str) -> Optional[str]:
+    """
+    Attachment block by sha256 (unscoped): RAM cache, then the local journal, then the storage backend.
+    Callers check ownership first - get_attachment, or _attachment_owned for streamed files.
+    """
+    with _attachment_lock:
+        if sha in _attachment_cache:
+            _attachment_cache.move_to_end(sha)
+            return _attachment_cache[sha]
+    try:
+        with _journal_lock:
+            row = _journal().execute("SELECT content FROM attachments WHERE sha256 = ?", (sha,)).fetchone()
+        if row:
+            _attachment_remember(sha, row[0])
+            return row[0]
+    except Exception as e:
+        print(f"[attachment ERROR] {str(e)}")
+    try:
+        storage = get_storage()
+        row = storage.get_attachment(sha) if storage else None
+        if row:
+            _attachment_remember(sha, row["content"])
+            return row["content"]
+    except Exception as e:
+        print(f"[attachment ERROR] Fetch {sha[:12]} failed: {str(e)}")
+    return None
+
+
+def resolve_attachments(content: str, user_id: str = None) -> str:
+    """Expand references user_id may read back into the original blocks (others are left as-is)."""
+    return ATTACHMENT_REF_PATTERN.sub(lambda m: get_attachment(m.group(2), user_id) or m.group(0), content or "")
+
+
+def _referenced_shas(rows: List[Dict]) -> set:
+    """sha256s of attachments and streamed files referenced by message rows."""
+    shas = set()
+    for row in rows:
+        content = row.get("content") or ""
+        shas.update(sha for _, sha, _ in attachment_refs(content))
+        shas.update(sha for _, _, sha in STREAMED_FILE_PATTERN.findall(content))
+    return shas
+
+
+def _upload_journal_rows(table: str, key_columns: List[str], keys: List[Tuple], put) -> bool:
+    """
+    Upload journal rows (primary-key tuples) with put(keys) as one batch, falling back to one row at a time.
+    A failing row counts an attempt; after ATTACHMENT_UPLOAD_MAX_ATTEMPTS, once older than
+    ATTACHMENT_QUARANTINE_AGE, it is quarantined - kept locally, no longer blocking the messages that reference it.
+    Returns True if no row is still pending.
+    """
+    where = " AND ".join(f"{c} = ?" for c in key_columns)
+    try:
+        put(keys)
+    except Exception as e:
+        if len(keys) > 1:
+            return all([_upload_journal_rows(table, key_columns, [key], put) for key in keys])
+        with _journal_lock:
+            conn = _journal()
+            conn.execute(f"UPDATE {table} SET attempts = attempts + 1 WHERE {where}", keys[0])
+            quarantined = conn.execute(
+                f"UPDATE {table} SET synced = -1 WHERE {where} AND attempts >= ? AND created_at < ?",
+                (*keys[0], ATTACHMENT_UPLOAD_MAX_ATTEMPTS, time.time() - ATTACHMENT_QUARANTINE_AGE)).rowcount
+        print(f"[attachment upload ERROR] {table} {keys[0][0][:12]}: {str(e)[:200]}"
+              + (" - quarantined, kept in the local journal" if quarantined else ""))
+        return bool(quarantined)
+    with _journal_lock:
+        _journal().executemany(f"UPDATE {table} SET synced = 1 WHERE {where}", keys)
+    return True
+
+
+def _put_attachment_rows(storage, keys: List[Tuple]):
+    """Load the content of one upload batch from the journal and upsert it."""
+    shas = [sha for sha, in keys]
+    with _journal_lock:
+        rows = _journal().execute(f"SELECT sha256, name, content, size FROM attachments WHERE sha256 IN "
+                                  f"({','.join('?' * len(shas))})", shas).fetchall()
+    storage.put_attachments([{"sha256": sha, "name": name, "content": content, "size": size,
+                              "created_at": datetime.now(timezone.utc).isoformat()}
+                             for sha, name, content, size in rows])
+
+
+def _upload_attachments(shas: Optional[set] = None) -> bool:
+    """
+    Push unsynced attachments and their owner rows to storage - only `shas` when given (a message chunk
+    waits just for what it references), else everything. Batches are bounded by rows and bytes;
+    blocks over ATTACHMENT_UPLOAD_MAX_BYTES stay local. Returns True if none of them is still pending.
+    """
+    storage = get_storage()
+    if not storage:
+        return False
+    scope, params = "", []
+    if shas is not None:
+        if not shas:
+            return True
+        scope, params = f" AND sha256 IN ({','.join('?' * len(shas))})", list(shas)
+    try:
+        with _journal_lock:
+            conn = _journal()
+            oversized = conn.execute(f"UPDATE attachments SET synced = -1 WHERE synced = 0 AND size > ?{scope}",
+                                     [ATTACHMENT_UPLOAD_MAX_BYTES] + params).rowcount
+            pending = conn.execute(f"SELECT sha256, size FROM attachments WHERE synced = 0{scope}", params).fetchall()
+            owners = conn.execute(f"SELECT sha256, user_id FROM attachment_owners WHERE synced = 0{scope}", params).fetchall()
+        if oversized:
+            print(f"[attachment upload] {oversized} block(s) over {ATTACHMENT_UPLOAD_MAX_BYTES:,} bytes kept local")
+        
+        ok, batch, batch_bytes = True, [], 0
+        for sha, size in pending + [(None, 0)]:
+            if batch and (sha is None or len(batch) >= ATTACHMENT_UPLOAD_BATCH
+                          or batch_bytes + (size or 0) > ATTACHMENT_UPLOAD_BATCH_BYTES):
+                ok &= _upload_journal_rows("attachments", ["sha256"], batch, lambda keys: _put_attachment_rows(storage, keys))
+                batch, batch_bytes = [], 0
+            if sha is not None:
+                batch.append((sha,))
+                batch_bytes += size or 0
+        for start in range(0, len(owners), ATTACHMENT_UPLOAD_BATCH * 10):
+            ok &= _upload_journal_rows(
+                "attachment_owners", ["sha256", "user_id"], owners[start:start + ATTACHMENT_UPLOAD_BATCH * 10],
+                lambda keys: storage.put_attachment_owners([{"sha256": sha, "user_id": user_id} for sha, user_id in keys]))
+        return ok
+    except Exception as e:
+        print(f"[attachment upload ERROR] {str(e)}")
+        return False
+
+
+def _rehydrate_session_files(session_id: str, history: List[Dict]):
+    """
+    Re-cache files referenced in history but missing from the file store (e.g. after a restart) for
+    excerpt retrieval: attachments from the attachment store, streamed files from their on-disk blob
+    or, once that is gone, from the copy in the attachment store. Only files the session owner
+    stored - a reference typed into a message is not a grant.
+    """
+    owner = session_user(session_id)
+    cached = {f["name"] for f in _session_files(session_id)}
+    latest: Dict[str, Tuple[str, str, int]] = {}   # name -> (source, sha, chars) of the newest reference
+    for msg in history:
+        content = msg.get("content") or ""
+        for name, sha, _ in attachment_refs(content):
+            latest[name] = ("attachment", sha, 0)
+        for name, chars, sha in STREAMED_FILE_PATTERN.findall(content):
+            latest[name] = ("streamed", sha, int(chars.replace(",", "")))
+    missing = [(name, ref) for name, ref in latest.items() if name not in cached][-MAX_CACHED_FILES:]
+    files = []
+    for name, (source, sha, chars) in missing:
+        if not _attachment_owned(sha, owner):
+            continue
+        if source == "streamed":
+            if os.path.exists(_file_blob_path(sha)):
+                files.append({"name": name, "sha256": sha, "size": os.path.getsize(_file_blob_path(sha)), "chars": chars})
+                continue
+            text = _attachment_content(sha)
+            if text:
+                files.append({"name": name, "content": text})
+            continue
+        block = _attachment_content(sha)
+        if block:
+            match = FILE_BLOCK_PATTERN.match(block)
+            files.append({"name": name, "content": match.group(2) if match else block})
+    if files:
+        cache_files(session_id, files)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# WRITE-BEHIND MESSAGE QUEUE - save_message acknowledges immediately, a worker batches inserts
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+WRITE_BATCH_MAX_ROWS = 50       # Rows per multi-row insert
+WRITE_BATCH_WINDOW = 0.25       # Seconds the worker waits to coalesce more rows
+WRITE_MAX_RETRIES = 3
+WRITE_SHUTDOWN_TIMEOUT = 10     # Seconds to drain the queue at interpreter exit
+
+_write_pending: List[Dict] = []     # Queued rows, global enqueue order
+_write_inflight: List[Dict] = []    # Rows the worker is currently inserting
+_write_cv = threading.Condition()
+_write_flush_requested = False
+_write_worker: Optional[threading.Thread] = None
+_write_stats = {"enqueued": 0, "flushed": 0, "batches": 0, "failed": 0,
+                "last_flush_ms": 0.0, "total_flush_ms": 0.0, "flushes": 0}
+
+
+def _ensure_write_worker():
+    global _write_worker
+    if _write_worker is None or not _write_worker.is_alive():
+        _write_worker = threading.Thread(target=_write_worker_loop, name="council-write-behind", daemon=True)
+        _write_worker.start()
+
+
+def _insert_message_batch(rows: List[Dict]) -> bool:
+    """One multi-row idempotent upsert with retry + backoff. Runs on the worker thread only."""
+    for attempt in range(WRITE_MAX_RETRIES):
+        try:
+            storage = get_storage()
+            if not storage:
+                return False
+            storage.upsert_messages(rows)
+            return True
+        except Exception as e:
+            if attempt < WRITE_MAX_RETRIES - 1:
+                time.sleep(0.5 * (attempt + 1))  # Backoff: 0.5s, 1s
+            else:
+                print(f"[write-behind ERROR after {WRITE_MAX_RETRIES} attempts] {str(e)}")
+    return False
+
+
+def _write_worker_loop():
+    global _write_flush_requested, _write_inflight
+    while True:
+        with _write_cv:
+            while not _write_pending:
+                _write_cv.wait()
+            # Coalesce: give other saves in this run a moment to join the batch
+            if not _write_flush_requested:
+                _write_cv.wait(timeout=WRITE_BATCH_WINDOW)
+            _write_flush_requested = False
+            batch = _write_pending[:]
+            del _write_pending[:]
+            _write_inflight = batch
+
+        started = time.perf_counter()
+        # Group per session - dicts keep insertion order, so per-session ordering is preserved
+        by_session: Dict[str, List[Dict]] = {}
+        for row in batch:
+            by_session.setdefault(row["session_id"], []).append(row)
+
+        flushed, failed = 0, 0
+        for session_id, rows in by_session.items():
+            for i in range(0, len(rows), WRITE_BATCH_MAX_ROWS):
+                chunk = rows[i:i + WRITE_BATCH_MAX_ROWS]
+                # A chunk waits only for the attachments it references
+                if _upload_attachments(_referenced_shas(chunk)) and _insert_message_batch(chunk):
+                    _journal_mark_synced([r["idempotency_key"] for r in chunk])
+                    flushed += len(chunk)
+                else:
+                    # Rows stay unsynced in the journal - the background syncer replays them in order
+                    failed += len(rows) - i
+                    _ensure_journal_syncer()
+                    break
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with _write_cv:
+            _write_inflight = []
+            _write_stats["flushed"] += flushed
+            _write_stats["failed"] += failed
+            _write_stats["batches"] += len(by_session)
+            _write_stats["flushes"] += 1
+            _write_stats["last_flush_ms"] = elapsed_ms
+            _write_stats["total_flush_ms"] += elapsed_ms
+            _write_cv.notify_all()
+
+
+def flush_messages(wait: bool = True, timeout: float = WRITE_SHUTDOWN_TIMEOUT) -> bool:
+    """
+    Flush the write-behind queue now.
+    wait=False just skips the batching window; wait=True blocks until drained (or timeout).
+    Returns True if the queue is empty.
+    """
+    global _write_flush_requested
+    with _write_cv:
+        if not _write_pending and not _write_inflight:
+            return True
+        _write_flush_requested = True
+        _write_cv.notify_all()
+        if not wait:
+            return False
+        return _write_cv.wait_for(lambda: not _write_pending and not _write_inflight, timeout=timeout)
+
+
+def get_write_queue_stats() -> Dict:
+    """Queue depth + flush latency metrics for the write-behind queue."""
+    with _write_cv:
+        stats = dict(_write_stats)
+        stats["depth"] = len(_write_pending) + len(_write_inflight)
+    stats["local_backlog"] = get_journal_stats()["unsynced"]
+    stats["avg_flush_ms"] = stats["total_flush_ms"] / stats["flushes"] if stats["flushes"] else 0.0
+    return stats
+
+
+atexit.register(flush_messages)
+
+
 def save_message(session_id: str, role: str, content: str, agent_name: str = None):
-    """Save message to Supabase with retry logic and local fallback."""
+    """Journal the message locally, then queue it for write-behind persistence (returns immediately)."""
     if not session_id or not content:
         return
     
@@ -1740,7 +5532,10 @@ def save_message(session_id: str, role: str, content: str, agent_name: str = Non
     # Supabase expects valid UUID format - local sessions use 'local-xxx' format
     is_local_session = session_id.startswith("local-") or len(session_id) < 32
     
+    # Uploaded blocks are stored once by content hash - the row keeps a reference, readable by the session owner
+    content = externalize_attachments(content, session_user(session_id))
     msg_data = {
+        "idempotency_key": uuid.uuid4().hex,
         "session_id": session_id, 
         "role": role, 
         "agent_name": agent_name, 
@@ -1748,101 +5543,785 @@ def save_message(session_id: str, role: str, content: str, agent_name: str = Non
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    # Retry up to 3 times (only if NOT a local session)
-    if not is_local_session:
-        for attempt in range(3):
-            try:
-                db = get_supabase()
-                if db:
-                    db.table("messages").insert(msg_data).execute()
-                    # Success! Also try to sync any pending local messages
-                    _sync_local_messages(session_id)
-                    return
-            except Exception as e:
-                if attempt < 2:
-                    time.sleep(0.5 * (attempt + 1))  # Exponential backoff: 0.5s, 1s
-                else:
-                    print(f"[save_message ERROR after 3 attempts] {str(e)}")
+    # Durable first: the journal keeps the message across outages and restarts
+    _journal_record(msg_data)
+    index_document("message", msg_data["idempotency_key"], agent_name or role, content,
+                   session_id=session_id, created_at=msg_data["created_at"])
+    if is_local_session:
+        return
+    
+    _append_history(msg_data)
+    if not get_storage():
+        return  # Stays unsynced in the journal until storage is reachable
     
-    # All retries failed - save to local memory
-    if session_id not in _local_messages:
-        _local_messages[session_id] = []
-    _local_messages[session_id].append(msg_data)
+    with _write_cv:
+        _write_pending.append(msg_data)
+        _write_stats["enqueued"] += 1
+        _write_cv.notify_all()
+    _ensure_write_worker()
+    _ensure_journal_syncer()
 
 
-def _sync_local_messages(session_id: str):
-    """Try to sync local messages to Supabase when connection is restored."""
-    if session_id not in _local_messages or not _local_messages[session_id]:
-        return
-    
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# SESSION HISTORY CACHE - append-on-write, delta sync by created_at, tail-N queries
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+HISTORY_SYNC_INTERVAL = 5.0     # Seconds between delta syncs against Supabase (per session)
+HISTORY_PAGE_SIZE = 30          # Messages per lazy-load page in the UI
+
+# {session_id: {"messages": [...], "keys": set, "loaded": bool, "complete": bool,
+#               "watermark": newest server created_at, "oldest": oldest server created_at, "synced_at": float,
+#               "fetch_lock": one storage fetch per session at a time}}
+# _history_lock guards the cache only - storage round trips happen outside it, under the session's fetch_lock
+_history_cache: Dict[str, Dict] = {}
+_history_lock = threading.Lock()
+
+
+def _ts_micros(created_at: str) -> int:
+    """created_at -> integer microseconds (Supabase trims trailing zeros, so compare parsed values)."""
     try:
-        db = get_supabase()
-        if db:
-            # Try to insert all pending local messages
-            for msg in _local_messages[session_id]:
-                try:
-                    db.table("messages").insert(msg).execute()
-                except:
-                    pass  # Individual message failed, continue
-            # Clear synced messages
-            _local_messages[session_id] = []
-    except:
-        pass  # Sync failed, will try again later
+        return int(datetime.fromisoformat(str(created_at).replace("Z", "+00:00")).timestamp() * 1_000_000)
+    except Exception:
+        return 0
+
+
+def _message_key(msg: Dict) -> Tuple:
+    return (_ts_micros(msg.get("created_at", "")), msg.get("role"), hash(msg.get("content") or ""))
+
+
+def _history_entry(session_id: str) -> Dict:
+    entry = _history_cache.get(session_id)
+    if entry is None:
+        entry = {"messages": [], "keys": set(), "loaded": False, "complete": False,
+                 "watermark": None, "oldest": None, "synced_at": 0.0, "fetch_lock": threading.Lock()}
+        _history_cache[session_id] = entry
+    return entry
+
+
+def _merge_history(entry: Dict, rows: List[Dict], from_server: bool = True):
+    """Merge rows into a cache entry (dedupe + keep created_at order). Caller holds _history_lock."""
+    added = False
+    for row in rows:
+        key = _message_key(row)
+        if key not in entry["keys"]:
+            entry["keys"].add(key)
+            entry["messages"].append(row)
+            added = True
+        if from_server and row.get("created_at"):
+            ts = _ts_micros(row["created_at"])
+            if entry["watermark"] is None or ts > _ts_micros(entry["watermark"]):
+                entry["watermark"] = row["created_at"]
+            if entry["oldest"] is None or ts < _ts_micros(entry["oldest"]):
+                entry["oldest"] = row["created_at"]
+    if added:
+        entry["messages"].sort(key=lambda m: _ts_micros(m.get("created_at", "")))
+
+
+def _append_history(msg: Dict):
+    """Append-on-write: save_message makes new rows visible to readers immediately."""
+    with _history_lock:
+        _merge_history(_history_entry(msg["session_id"]), [msg], from_server=False)
+
+
+def _sync_history(session_id: str, want: Optional[int] = None) -> Optional[List[Dict]]:
+    """
+    Bring the cache up to date and make sure it holds the last `want` messages (None = all).
+    Returns the cached messages, or None if storage is unavailable for this session.
+    """
+    storage = get_storage()
+    if not storage or session_id.startswith("local-"):
+        return None
+    
+    with _history_lock:
+        entry = _history_entry(session_id)
+    
+    with entry["fetch_lock"]:
+        # Only this lock's holder merges server rows, so watermark / oldest / loaded can be read, then
+        # fetched against without _history_lock - saves and other sessions never wait on the network
+        if not entry["loaded"]:
+            # Cold cache: fetch only the tail we need, newest first
+            rows = list(reversed(storage.get_messages(session_id, limit=want, newest_first=True)))
+            with _history_lock:
+                _merge_history(entry, rows)
+                entry["loaded"] = True
+                entry["complete"] = want is None or len(rows) < want
+                entry["synced_at"] = time.time()
+        elif time.time() - entry["synced_at"] >= HISTORY_SYNC_INTERVAL:
+            # Delta sync: only rows newer than the newest row we have seen from the server
+            rows = storage.get_messages(session_id, after=entry["watermark"])
+            with _history_lock:
+                _merge_history(entry, rows)
+                entry["synced_at"] = time.time()
+        
+        # Backfill older messages if the caller wants more than we hold
+        with _history_lock:
+            backfill = not entry["complete"] and (want is None or len(entry["messages"]) < want)
+            missing = None if want is None else want - len(entry["messages"])
+        if backfill:
+            rows = storage.get_messages(session_id, before=entry["oldest"], limit=missing, newest_first=True)
+            with _history_lock:
+                _merge_history(entry, rows)
+                entry["complete"] = missing is None or len(rows) < missing
+    
+    with _history_lock:
+        return list(entry["messages"])
 
 
 def get_history(session_id: str) -> List[Dict]:
-    """Get message history for a session, with local fallback."""
+    """Get full message history for a session (cached, delta-synced), with local fallback."""
     if not session_id:
         return []
     
-    # Try Supabase first
     try:
-        db = get_supabase()
-        if db:
-            result = db.table("messages").select("*").eq("session_id", session_id).order("created_at").execute()
-            if result.data:
-                return result.data
+        messages = _sync_history(session_id)
+        if messages is not None:
+            return messages
     except Exception as e:
         print(f"[get_history ERROR] session_id={session_id}, error={str(e)}")
+        with _history_lock:
+            if session_id in _history_cache and _history_cache[session_id]["messages"]:
+                return list(_history_cache[session_id]["messages"])
+    
+    # Fallback: the durable local journal
+    return _journal_messages(session_id)
+
+
+def get_history_tail(session_id: str, n: int) -> List[Dict]:
+    """Get only the last n messages of a session (fetches just the tail on a cold cache)."""
+    if not session_id or n <= 0:
+        return []
     
-    # Fallback: check local memory cache
-    if session_id in _local_messages:
-        return sorted(_local_messages[session_id], key=lambda x: x.get("created_at", ""))
+    try:
+        messages = _sync_history(session_id, want=n)
+        if messages is not None:
+            return messages[-n:]
+    except Exception as e:
+        print(f"[get_history_tail ERROR] session_id={session_id}, error={str(e)}")
+        with _history_lock:
+            if session_id in _history_cache and _history_cache[session_id]["messages"]:
+                return list(_history_cache[session_id]["messages"][-n:])
     
-    return []
+    return get_history(session_id)[-n:]
+
+
+def has_older_history(session_id: str, n: int) -> bool:
+    """True if the session has more than the last n messages (for lazy 'load older' paging)."""
+    with _history_lock:
+        entry = _history_cache.get(session_id)
+        if entry and entry["loaded"]:
+            return len(entry["messages"]) > n or not entry["complete"]
+    return len(_journal_messages(session_id)) > n
+
+
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# FULL-TEXT SEARCH - SQLite FTS5 (BM25) index over messages and cached files, updated incrementally
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+SEARCH_INDEX_PATH = os.path.join(CACHE_DIR, "search.db")
+SEARCH_SNIPPET_TOKENS = 24
+SEARCH_MAX_BODY_CHARS = 200000   # Index at most this much of a single document
+SEARCH_STOPWORDS = {"the", "a", "an", "and", "or", "of", "to", "in", "is", "it", "for", "on", "with", "this",
+                    "that", "be", "are", "was", "as", "at", "by", "how", "what", "do", "i", "you", "me", "my"}
+
+_search_conn = None
+_search_lock = threading.Lock()
+_search_disabled = False
+# session_id -> user_id, so messages can be searched per user (memoizes the session_owners table)
+_session_users: Dict[str, str] = {}
+
+
+def _search_index():
+    """Lazily open the FTS5 index. Returns None if SQLite was built without FTS5."""
+    global _search_conn, _search_disabled
+    if _search_conn is None and not _search_disabled:
+        try:
+            import sqlite3
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            conn = sqlite3.connect(SEARCH_INDEX_PATH, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS search_docs USING fts5(
+                title, body, kind UNINDEXED, ref UNINDEXED, session_id UNINDEXED,
+                user_id UNINDEXED, created_at UNINDEXED, tokenize='porter unicode61')""")
+            # Owners persist with the index - documents written before registration or after a restart stay scoped
+            conn.execute("CREATE TABLE IF NOT EXISTS session_owners (session_id TEXT PRIMARY KEY, user_id TEXT NOT NULL)")
+            _search_conn = conn
+        except Exception as e:
+            print(f"[search] Full-text index disabled: {str(e)}")
+            _search_disabled = True
+    return _search_conn
+
+
+def register_session_user(session_id: str, user_id: str = None):
+    """
+    Record which user owns a session (used to scope search results). Persisted with the index, and
+    documents of the session indexed before registration are claimed for the owner.
+    """
+    if not session_id or not user_id or _session_users.get(session_id) == user_id:
+        return
+    _session_users[session_id] = user_id
+    try:
+        with _search_lock:
+            conn = _search_index()
+            if conn is None:
+                return
+            conn.execute("INSERT OR REPLACE INTO session_owners (session_id, user_id) VALUES (?, ?)", (session_id, user_id))
+            conn.execute("UPDATE search_docs SET user_id = ? WHERE session_id = ? AND user_id IS NULL", (user_id, session_id))
+    except Exception as e:
+        print(f"[search index ERROR] {str(e)}")
+
+
+def session_user(session_id: str) -> Optional[str]:
+    """Registered owner of a session (None if anonymous or unknown)."""
+    if session_id in _session_users:
+        return _session_users[session_id]
+    try:
+        with _search_lock:
+            conn = _search_index()
+            return _session_owner(conn, session_id) if conn is not None else None
+    except Exception as e:
+        print(f"[search index ERROR] {str(e)}")
+        return None
+
+
+def _session_owner(conn, session_id: str) -> Optional[str]:
+    """Owner of a session: memoized, else the persisted session_owners row. Caller holds _search_lock."""
+    if not session_id:
+        return None
+    if session_id not in _session_users:
+        row = conn.execute("SELECT user_id FROM session_owners WHERE session_id = ?", (session_id,)).fetchone()
+        if not row:
+            return None
+        _session_users[session_id] = row[0]
+    return _session_users[session_id]
+
+
+def index_document(kind: str, ref: str, title: str, body: str, session_id: str = None,
+                   user_id: str = None, created_at: str = None):
+    """Add or replace one document in the search index (kind: 'message' or 'file')."""
+    if not body:
+        return
+    try:
+        with _search_lock:
+            conn = _search_index()
+            if conn is None:
+                return
+            conn.execute("DELETE FROM search_docs WHERE ref = ? AND kind = ?", (ref, kind))
+            conn.execute("INSERT INTO search_docs (title, body, kind, ref, session_id, user_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (title or "", body[:SEARCH_MAX_BODY_CHARS], kind, ref, session_id,
+                          user_id or _session_owner(conn, session_id), created_at or datetime.now(timezone.utc).isoformat()))
+    except Exception as e:
+        print(f"[search index ERROR] {str(e)}")
+
+
+def remove_session_documents(session_id: str):
+    try:
+        with _search_lock:
+            conn = _search_index()
+            if conn is not None:
+                conn.execute("DELETE FROM search_docs WHERE session_id = ?", (session_id,))
+    except Exception as e:
+        print(f"[search index ERROR] {str(e)}")
+
+
+def _fts_query(text: str) -> str:
+    """Free text -> FTS5 OR-query of quoted terms (BM25 ranks documents matching more/rarer terms first)."""
+    terms = [t for t in re.findall(r"\w+", text.lower()) if len(t) > 1 and t not in SEARCH_STOPWORDS]
+    return " OR ".join(f'"{t}"' for t in dict.fromkeys(terms[:32]))
+
+
+def search(query: str, user_id: str = None, session_id: str = None, kinds: List[str] = None,
+           exclude_session: str = None, limit: int = 10) -> List[Dict]:
+    """
+    SEARCH: Full-text search over past messages and cached files.
+    Without user_id or session_id, only documents with no owner are searched.
+    Returns [{kind, title, snippet, session_id, ref, created_at, score}], best match first.
+    """
+    match = _fts_query(query)
+    if not match:
+        return []
+    
+    sql = f"""SELECT kind, title, snippet(search_docs, 1, '**', '**', '…', {SEARCH_SNIPPET_TOKENS}),
+                     session_id, ref, created_at, bm25(search_docs, 5.0, 1.0) AS score
+              FROM search_docs WHERE search_docs MATCH ?"""
+    params: list = [match]
+    if user_id:
+        sql += " AND user_id = ?"
+        params.append(user_id)
+    elif not session_id:
+        sql += " AND user_id IS NULL"
+    if session_id:
+        sql += " AND session_id = ?"
+        params.append(session_id)
+    if exclude_session:
+        sql += " AND session_id != ?"
+        params.append(exclude_session)
+    if kinds:
+        sql += f" AND kind IN ({','.join('?' * len(kinds))})"
+        params.extend(kinds)
+    sql += " ORDER BY score LIMIT ?"
+    params.append(limit)
+    
+    try:
+        with _search_lock:
+            conn = _search_index()
+            if conn is None:
+                return []
+            rows = conn.execute(sql, params).fetchall()
+        return [{"kind": kind, "title": title, "snippet": snippet, "session_id": sid, "ref": ref,
+                 "created_at": created_at, "score": -score}
+                for kind, title, snippet, sid, ref, created_at, score in rows]
+    except Exception as e:
+        print(f"[search ERROR] {str(e)}")
+        return []
+
+
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# LONG-TERM MEMORY - Local vector index (in-process, quantized scoring + exact float rerank)
+# Warmed per user from storage, appended on save_memory - recall needs no network round trip
+# RAM holds int8 codes (or sign bits); full-precision vectors live in a memory-mapped file
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+MEMORY_MATCH_THRESHOLD = 0.6
+MEMORY_MATCH_COUNT = 5
+MEMORY_INDEX_MAX_ROWS = 20000     # Newest memories kept in the index per user
+MEMORY_INDEX_REFRESH = 600        # Seconds before an incremental sync (picks up writes from other processes)
+MEMORY_INDEX_FULL_REFRESH = 6 * 3600  # Seconds before a full rebuild (picks up other processes' deletions)
+MEMORY_FETCH_PAGE = 1000          # Memories per storage request (PostgREST max-rows)
+MEMORY_LOCAL_THRESHOLD = 0.2      # Match threshold when recalling with local (offline) embeddings
+MEMORY_QUANTIZATION = os.getenv("COUNCIL_MEMORY_QUANTIZATION", "int8")  # int8 | binary | none
+MEMORY_RERANK_FACTOR = 8          # Approximate candidates reranked exactly = k * factor ...
+MEMORY_RERANK_MIN = 50            # ... but never fewer than this
+MEMORY_SCORE_BLOCK = 1024         # int8 rows dequantized per block (bounds scratch memory)
+MEMORY_VECTORS_DIR = os.path.join(CACHE_DIR, "memory_vectors")
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# {user_key: {"contents": [str], "quantization": str, "full": float32 (memmap), "codes"/"scales" or "bits", ...}}
+_memory_index: Dict[str, Dict] = {}
+_memory_index_lock = threading.Lock()
+_memory_warm_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="council-memwarm")
+_memory_warming: set = set()      # User keys with a warm / sync queued or running
+_memory_vectors_swept = False
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric per-row int8 quantization: vectors ≈ codes * scales[:, None]."""
+    scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def quantize_binary(vectors: np.ndarray) -> np.ndarray:
+    """Sign bits packed 8 per byte (1536 dims -> 192 bytes)."""
+    return np.packbits(vectors > 0, axis=1)
+
+
+def _memory_vectors_path(user_key: str) -> str:
+    """One file per (user, process) - a rewrite replaces it in place, a restart reuses or sweeps it."""
+    return os.path.join(MEMORY_VECTORS_DIR, f"{hashlib.sha256(user_key.encode()).hexdigest()[:16]}-{os.getpid()}.f32")
+
+
+def _sweep_memory_vectors():
+    """Remove vector files left by processes that are no longer running (runs once, on the first index build)."""
+    global _memory_vectors_swept
+    if _memory_vectors_swept:
+        return
+    _memory_vectors_swept = True
+    try:
+        names = os.listdir(MEMORY_VECTORS_DIR)
+    except OSError:
+        return
+    for name in names:
+        owner = name.rsplit(".", 1)[0].rpartition("-")[2]
+        if owner == str(os.getpid()):
+            continue
+        if owner.isdigit():
+            try:
+                os.kill(int(owner), 0)
+                continue  # Another live process still maps it
+            except PermissionError:
+                continue
+            except OSError:
+                pass
+        try:
+            os.remove(os.path.join(MEMORY_VECTORS_DIR, name))
+        except OSError:
+            pass
+
+
+def _set_index_vectors(index: Dict, vectors: np.ndarray):
+    """(Re)build the quantized codes and the memory-mapped full-precision copy for normalized vectors."""
+    if index["quantization"] == "none":
+        index["full"] = vectors
+        return
+    
+    index["path"] = _memory_vectors_path(index["user_key"])
+    os.makedirs(MEMORY_VECTORS_DIR, exist_ok=True)
+    _sweep_memory_vectors()
+    vectors.tofile(index["path"] + ".tmp")
+    os.replace(index["path"] + ".tmp", index["path"])  # Open maps keep the old inode alive
+    index["full"] = np.memmap(index["path"], dtype=np.float32, mode="r", shape=vectors.shape) if len(vectors) else vectors
+    if index["quantization"] == "binary":
+        index["bits"] = quantize_binary(vectors)
+    else:
+        index["codes"], index["scales"] = quantize_int8(vectors)
+
+
+def _build_memory_index(user_key: str, vectors: np.ndarray, contents: List[str], quantization: str = None) -> Dict:
+    index = {"user_key": user_key, "contents": list(contents), "quantization": quantization or MEMORY_QUANTIZATION,
+             "warmed_at": time.time()}
+    _set_index_vectors(index, _normalize(vectors).reshape(-1, EMBEDDING_DIMENSIONS))
+    return index
+
+
+def _memory_index_add(user_id: str, content: str, vector: np.ndarray):
+    """Append one memory to a warm index (cold indexes pick it up when they warm)."""
+    with _memory_index_lock:
+        index = _memory_index.get(user_id or "anonymous")
+        if index is None:
+            return
+        if index.get("rebuild") is not None:
+            index["rebuild"].append((content, vector))  # The rebuild may have read storage before this save
+        _memory_index_append(index, content, vector)
+
+
+def _memory_index_append(index: Dict, content: str, vector: np.ndarray):
+    """Append under _memory_index_lock (rewrites the vector file when trimming)."""
+    index["contents"].append(content)
+    if "local_codes" in index:
+        index["local_embedder"].fit([content])
+        codes, scales = quantize_int8(index["local_embedder"].embed([content]))
+        index["local_codes"] = np.vstack([index["local_codes"], codes])
+        index["local_scales"] = np.concatenate([index["local_scales"], scales])
+    full = index["full"]
+    if index["quantization"] == "none":
+        index["full"] = np.vstack([full, vector[None, :]])[-MEMORY_INDEX_MAX_ROWS:]
+        index["contents"] = index["contents"][-MEMORY_INDEX_MAX_ROWS:]
+    elif len(index["contents"]) > MEMORY_INDEX_MAX_ROWS * 1.25 or not len(full):
+        # Rewrite trimmed (amortized - most appends are a single write)
+        index["contents"] = index["contents"][-MEMORY_INDEX_MAX_ROWS:]
+        _set_index_vectors(index, np.vstack([np.asarray(full), vector[None, :]])[-MEMORY_INDEX_MAX_ROWS:])
+    else:
+        with open(index["path"], "ab") as f:
+            f.write(vector.astype(np.float32).tobytes())
+        index["full"] = np.memmap(index["path"], dtype=np.float32, mode="r", shape=(len(full) + 1, EMBEDDING_DIMENSIONS))
+        if index["quantization"] == "binary":
+            index["bits"] = np.vstack([index["bits"], quantize_binary(vector[None, :])])
+        else:
+            codes, scales = quantize_int8(vector[None, :])
+            index["codes"] = np.vstack([index["codes"], codes])
+            index["scales"] = np.concatenate([index["scales"], scales])
+    if "local_codes" in index:
+        # Trimming drops the oldest rows - keep the local codes aligned
+        index["local_codes"] = index["local_codes"][-len(index["contents"]):]
+        index["local_scales"] = index["local_scales"][-len(index["contents"]):]
+
+
+def _int8_scores(codes: np.ndarray, scales: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Approximate dot products against int8 codes, dequantized block by block."""
+    scores = np.empty(len(codes), dtype=np.float32)
+    for start in range(0, len(codes), MEMORY_SCORE_BLOCK):
+        block = codes[start:start + MEMORY_SCORE_BLOCK].astype(np.float32)
+        scores[start:start + MEMORY_SCORE_BLOCK] = (block @ query) * scales[start:start + MEMORY_SCORE_BLOCK]
+    return scores
+
+
+def _memory_candidates(index: Dict, query: np.ndarray, count: int) -> np.ndarray:
+    """Row ids of the top `count` rows by approximate (quantized) score."""
+    n = len(index["contents"])
+    if count >= n:
+        return np.arange(n)
+    if index["quantization"] == "binary":
+        hamming = _POPCOUNT[index["bits"] ^ quantize_binary(query[None, :])].sum(axis=1, dtype=np.int32)
+        approx = -hamming.astype(np.float32)
+    else:
+        approx = _int8_scores(index["codes"], index["scales"], query)
+    return np.argpartition(-approx, count - 1)[:count]
+
+
+def _memory_search(index: Dict, query: np.ndarray, k: int) -> List[Tuple[int, float]]:
+    """
+    QUANTIZED SEARCH: approximate top-(k*factor) over codes, then exact float rerank.
+    Returns [(row, cosine)] best first.
+    """
+    n = len(index["contents"])
+    if not n:
+        return []
+    if index["quantization"] == "none":
+        candidates = np.arange(n)
+        exact = index["full"] @ query
+    else:
+        candidates = np.sort(_memory_candidates(index, query, max(k * MEMORY_RERANK_FACTOR, MEMORY_RERANK_MIN)))
+        exact = np.asarray(index["full"][candidates]) @ query
+    k = min(k, len(candidates))
+    top = np.argpartition(-exact, k - 1)[:k]
+    top = top[np.argsort(-exact[top])]
+    return [(int(candidates[i]), float(exact[i])) for i in top]
+
+
+def _memory_local_search(index: Dict, query: str, k: int) -> List[Tuple[int, float]]:
+    """
+    OFFLINE SEARCH: Top-k by local n-gram embeddings (built lazily, int8, only when the API is unavailable).
+    Returns [(row, cosine)] best first.
+    """
+    if "local_codes" not in index:
+        embedder = LocalEmbedder(EMBEDDING_DIMENSIONS, LOCAL_INDEX_DF_BUCKETS)
+        embedder.fit(index["contents"])
+        index["local_codes"], index["local_scales"] = quantize_int8(embedder.embed(index["contents"]))
+        index["local_embedder"] = embedder
+    scores = _int8_scores(index["local_codes"], index["local_scales"], index["local_embedder"].embed([query])[0])
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [(int(i), float(scores[i])) for i in top]
+
+
+def _warm_memory_index(user_id: str = None) -> Optional[Dict]:
+    """Build the user's index from storage and swap it in (None if storage is unavailable or the read fails)."""
+    user_key = user_id or "anonymous"
+    storage = get_storage()
+    if not storage:
+        return None
+    try:
+        rows = storage.get_memories(user_id, limit=MEMORY_INDEX_MAX_ROWS)
+    except Exception as e:
+        print(f"[memory index ERROR] Warm failed: {str(e)}")
+        return None
+    synced_through = max((r["created_at"] for r in rows), default=None, key=_ts_micros)
+    rows = [r for r in reversed(rows) if len(r["embedding"]) == EMBEDDING_DIMENSIONS]
+    vectors = np.stack([r["embedding"] for r in rows]) if rows else np.zeros((0, EMBEDDING_DIMENSIONS), dtype=np.float32)
+    with _memory_index_lock:
+        old = _memory_index.get(user_key)
+        # Same file as the old index - the rewrite replaces it, maps still held by readers keep the old inode
+        index = _build_memory_index(user_key, vectors, [r["content"] for r in rows])
+        index["built_at"], index["synced_through"] = index["warmed_at"], synced_through
+        known = set(index["contents"])
+        for content, vector in (old or {}).get("rebuild") or []:
+            if content not in known:
+                _memory_index_append(index, content, vector)
+        _memory_index[user_key] = index
+    return index
+
+
+def _sync_memory_index(user_id: str, index: Dict) -> bool:
+    """
+    INCREMENTAL SYNC: append memories stored since the index's newest row (written by other processes;
+    this process's saves are already in it). Returns False when a full rebuild is needed instead.
+    """
+    storage = get_storage()
+    if not storage or not index.get("synced_through"):
+        return False
+    rows = storage.get_memories(user_id, limit=MEMORY_INDEX_MAX_ROWS, after=index["synced_through"])
+    if len(rows) >= MEMORY_INDEX_MAX_ROWS:
+        return False
+    with _memory_index_lock:
+        known = set(index["contents"][-max(len(rows) * 4, 100):])
+        for row in reversed(rows):
+            if len(row["embedding"]) == EMBEDDING_DIMENSIONS and row["content"] not in known:
+                _memory_index_append(index, row["content"], _normalize(row["embedding"]))
+        if rows:
+            index["synced_through"] = max((r["created_at"] for r in rows), key=_ts_micros)
+        index["warmed_at"] = time.time()
+    return True
+
+
+def _rewarm_in_background(user_id: str):
+    """Warm a cold index, or bring a stale one up to date (incremental unless a full rebuild is due)."""
+    user_key = user_id or "anonymous"
+    try:
+        with _memory_index_lock:
+            index = _memory_index.get(user_key)
+        full = (index is None or index.get("needs_rebuild")
+                or time.time() - index.get("built_at", 0) >= MEMORY_INDEX_FULL_REFRESH)
+        if not full and _sync_memory_index(user_id, index):
+            return
+        if _warm_memory_index(user_id) is None and index is not None:
+            with _memory_index_lock:
+                index["warmed_at"] = time.time()  # Keep serving it; retried after the next refresh interval
+    except Exception as e:
+        print(f"[memory index ERROR] Re-warm failed: {str(e)}")
+    finally:
+        with _memory_index_lock:
+            _memory_warming.discard(user_key)
+            index = _memory_index.get(user_key)
+            if index is not None:
+                index["rebuild"] = None
+
+
+def _memory_index_for(user_id: str = None) -> Optional[Dict]:
+    """
+    The user's memory index, or None while it is first warmed in the background (callers fall back to
+    the storage backend's match_memories). A stale index keeps serving while it is synced.
+    """
+    user_key = user_id or "anonymous"
+    with _memory_index_lock:
+        index = _memory_index.get(user_key)
+        stale = index is None or time.time() - index["warmed_at"] >= MEMORY_INDEX_REFRESH
+        if stale and user_key not in _memory_warming:
+            _memory_warming.add(user_key)
+            if index is not None:
+                index["rebuild"] = []  # Saves made meanwhile are replayed if the index is rebuilt
+            _memory_warm_pool.submit(_rewarm_in_background, user_id)
+        return index
 
 
 def save_memory(content: str, user_id: str = None):
     """Save memory with TRUE semantic embeddings."""
     try:
-        db = get_supabase()
-        if db:
+        storage = get_storage()
+        if storage:
             embedding = get_real_embedding(content)
-            data = {"content": content, "embedding": embedding, "created_at": datetime.now(timezone.utc).isoformat()}
+            data = {"content": content, "created_at": datetime.now(timezone.utc).isoformat()}
+            if embedding is not None:
+                data["embedding"] = embedding
             if user_id:
                 data["user_id"] = user_id
-            db.table("memories").insert(data).execute()
+            storage.insert_memory(data)
+            if embedding is None:
+                return  # Kept without a vector: stays out of the API-space index and consolidation
+            _memory_index_add(user_id, content, _normalize(np.asarray(embedding, dtype=np.float32)))
+            _schedule_consolidation(user_id)
     except:
         pass
 
 
-
 def recall_memories(query: str, user_id: str = None) -> List[str]:
-    """Recall memories using TRUE semantic embeddings."""
+    """
+    MEMORY RECALL: Top-k over the local vector index.
+    Reuses the cached query embedding (already computed by the router), so a warm recall is sub-millisecond.
+    Without the embeddings API, falls back to the offline n-gram embedder. Until the index has warmed,
+    the storage backend's match_memories answers.
+    """
     try:
-        db = get_supabase()
-        if db:
-            embedding = get_real_embedding(query)
-            params = {"query_embedding": embedding, "match_threshold": 0.6, "match_count": 5}
-            if user_id:
-                params["p_user_id"] = user_id
-            result = db.rpc("match_memories", params).execute()
-            return [m["content"] for m in result.data]
-    except:
-        pass
+        index = _memory_index_for(user_id)
+        vector = get_query_embedding(query)
+        if index is None:
+            # Index still warming - one server-side similarity query instead of downloading every vector
+            storage = get_storage()
+            if not storage or vector is None:
+                return []
+            return storage.match_memories(vector.tolist(), user_id, MEMORY_MATCH_THRESHOLD, MEMORY_MATCH_COUNT)
+        if not index["contents"]:
+            return []
+        with _memory_index_lock:
+            if vector is None:
+                # Embeddings API unavailable - stored vectors are in its space, so match on local n-grams
+                hits = _memory_local_search(index, query, MEMORY_MATCH_COUNT)
+                return [index["contents"][row] for row, sim in hits if sim >= MEMORY_LOCAL_THRESHOLD]
+            hits = _memory_search(index, vector, MEMORY_MATCH_COUNT)
+            return [index["contents"][row] for row, sim in hits if sim >= MEMORY_MATCH_THRESHOLD]
+    except Exception as e:
+        print(f"[recall_memories ERROR] {str(e)}")
     return []
 
 
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# MEMORY CONSOLIDATION - Background dedupe / expiry / bounding of each user's memory store
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+MEMORY_DEDUPE_THRESHOLD = 0.92      # Cosine at which two memories are the same memory
+MEMORY_MAX_AGE_DAYS = 180           # Memories older than this expire
+MEMORY_STORE_MAX = 5000             # Newest memories kept per user after consolidation
+MEMORY_CONSOLIDATE_EVERY = 25       # Saves between background consolidations (per user)
+MEMORY_DEDUPE_BLOCK = 512           # Rows compared per block while clustering
+
+_consolidation_counts: Dict[str, int] = {}
+_consolidation_inflight: set = set()
+_consolidation_stats: Dict[str, Dict] = {}
+_consolidation_lock = threading.Lock()
+_consolidation_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="council-consolidate")
+
+
+def _duplicate_rows(vectors: np.ndarray) -> List[int]:
+    """
+    Greedy clustering, newest first: each row joins the first kept representative it matches
+    (cosine >= MEMORY_DEDUPE_THRESHOLD) and is reported as a duplicate; otherwise it becomes one.
+    """
+    reps = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+    duplicates = []
+    for start in range(0, len(vectors), MEMORY_DEDUPE_BLOCK):
+        block = vectors[start:start + MEMORY_DEDUPE_BLOCK]
+        seen = (block @ reps.T).max(axis=1) >= MEMORY_DEDUPE_THRESHOLD if len(reps) else np.zeros(len(block), bool)
+        inner = block @ block.T
+        kept = []
+        for i in range(len(block)):
+            if seen[i] or (kept and inner[i, kept].max() >= MEMORY_DEDUPE_THRESHOLD):
+                duplicates.append(start + i)
+            else:
+                kept.append(i)
+        reps = np.vstack([reps, block[kept]])
+    return duplicates
+
+
+def consolidate_memories(user_id: str = None) -> Dict:
+    """
+    MEMORY CONSOLIDATION: Merge near-duplicates (the newest copy survives), expire memories
+    older than MEMORY_MAX_AGE_DAYS and bound the store to MEMORY_STORE_MAX.
+    Returns {before, after, merged, expired, trimmed, ms}.
+    Anonymous memories are never consolidated - without a user filter the run would span every user.
+    """
+    start = time.time()
+    storage = get_storage()
+    if not storage or not user_id:
+        return {}
+    rows = storage.get_memories(user_id, limit=MEMORY_STORE_MAX * 4)  # newest first
+    cutoff = (time.time() - MEMORY_MAX_AGE_DAYS * 86400) * 1_000_000
+    
+    expired = [r for r in rows if 0 < _ts_micros(r["created_at"]) < cutoff]
+    live = [r for r in rows if not (0 < _ts_micros(r["created_at"]) < cutoff)]
+    comparable = [r for r in live if len(r["embedding"]) == EMBEDDING_DIMENSIONS]
+    merged = [comparable[i] for i in _duplicate_rows(_normalize(np.stack([r["embedding"] for r in comparable])))] if comparable else []
+    merged_ids = {r["id"] for r in merged}
+    trimmed = [r for r in live if r["id"] not in merged_ids][MEMORY_STORE_MAX:]
+    
+    doomed = [r["id"] for r in expired + merged + trimmed]
+    if doomed:
+        storage.delete_memories(doomed)
+        with _memory_index_lock:
+            index = _memory_index.get(user_id or "anonymous")
+            if index is not None:
+                index["warmed_at"], index["needs_rebuild"] = 0.0, True  # Rebuilt in the background on next recall
+    
+    stats = {"before": len(rows), "after": len(rows) - len(doomed), "merged": len(merged), "expired": len(expired),
+             "trimmed": len(trimmed), "ms": (time.time() - start) * 1000, "at": time.time()}
+    with _consolidation_lock:
+        _consolidation_stats[user_id or "anonymous"] = stats
+    print(f"[consolidate] {user_id or 'anonymous'}: {stats['before']} -> {stats['after']} memories "
+          f"(merged {stats['merged']}, expired {stats['expired']}, trimmed {stats['trimmed']}) in {stats['ms']:.0f}ms")
+    return stats
+
+
+def _consolidate_in_background(user_id: str):
+    try:
+        consolidate_memories(user_id)
+    except Exception as e:
+        print(f"[consolidate ERROR] {str(e)}")
+    finally:
+        with _consolidation_lock:
+            _consolidation_inflight.discard(user_id or "anonymous")
+
+
+def _schedule_consolidation(user_id: str = None):
+    """Count a save; every MEMORY_CONSOLIDATE_EVERY saves queue one consolidation (never blocks)."""
+    if not user_id:
+        return  # Anonymous saves have no user scope to consolidate
+    user_key = user_id
+    with _consolidation_lock:
+        _consolidation_counts[user_key] = _consolidation_counts.get(user_key, 0) + 1
+        if _consolidation_counts[user_key] < MEMORY_CONSOLIDATE_EVERY or user_key in _consolidation_inflight:
+            return
+        _consolidation_counts[user_key] = 0
+        _consolidation_inflight.add(user_key)
+    _consolidation_pool.submit(_consolidate_in_background, user_id)
+
+
+def get_consolidation_stats(user_id: str = None) -> Optional[Dict]:
+    """Size before/after of the user's last consolidation."""
+    with _consolidation_lock:
+        return _consolidation_stats.get(user_id or "anonymous")
+
+
 # ═══════════════════════════════════════════════════════════════════════════════════════════════════════
 # ULTRA-LONG CONTEXT MEMORY SYSTEM - THE PINNACLE
 # Handles 1M+ token conversations with perfect recall
@@ -1850,32 +6329,57 @@ def recall_memories(query: str, user_id: str = None) -> List[str]:
 
 # Session summary cache (in-memory for speed)
 _session_summaries: Dict[str, str] = {}
+# Summary checkpoints: number of history messages already folded into each summary
+_summary_offsets: Dict[str, int] = {}
+_summary_inflight: set = set()
+_summary_lock = threading.Lock()
+# Single background worker - summaries never block a query
+_summary_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="council-summary")
 
-def summarize_conversation(messages: List[Dict], max_length: int = 2000) -> str:
+SUMMARY_INTERVAL = 10            # Fold in new messages once this many have accumulated
+SUMMARY_MAX_NEW_MESSAGES = 50    # Cap on messages folded in by a single update (a backlog catches up over several)
+
+def summarize_conversation(messages: List[Dict], max_length: int = 2000, previous_summary: str = None) -> str:
     """
     CONVERSATION SUMMARIZATION: Compress long conversation history into key points.
-    Uses AI to create a comprehensive summary of the entire conversation.
+    With previous_summary, folds ONLY the given (new) messages into the existing summary.
     """
     if not messages:
-        return ""
+        return previous_summary or ""
     
     # Build conversation text
     conv_text = "\n".join([
         f"[{m.get('agent_name', m.get('role', 'User'))}]: {m.get('content', '')[:500]}" 
-        for m in messages[-50:]  # Last 50 messages for summarization
+        for m in messages[-SUMMARY_MAX_NEW_MESSAGES:]
     ])
+    fallback = (f"{previous_summary}\n{conv_text}" if previous_summary else conv_text)[-max_length:]
     
-    if len(conv_text) < 500:
+    if len(conv_text) < 500 and not previous_summary:
         return conv_text  # Too short to summarize
     
-    # Use Strategist to summarize (fast model)
-    summary_prompt = f"""Summarize this conversation history in {max_length} chars max.
-Focus on:
+    focus = """Focus on:
 1. Key topics discussed
 2. Important decisions made
 3. Code/solutions provided
 4. User preferences learned
-5. Ongoing tasks/projects
+5. Ongoing tasks/projects"""
+    
+    if previous_summary:
+        summary_prompt = f"""Update this running conversation summary with the NEW messages below, in {max_length} chars max.
+Keep everything from the CURRENT SUMMARY that is still relevant and fold in what is new.
+{focus}
+
+CURRENT SUMMARY:
+{previous_summary[:8000]}
+
+NEW MESSAGES:
+{conv_text[:15000]}
+
+UPDATED SUMMARY:"""
+    else:
+        # Use Strategist to summarize (fast model)
+        summary_prompt = f"""Summarize this conversation history in {max_length} chars max.
+{focus}
 
 CONVERSATION:
 {conv_text[:15000]}
@@ -1884,24 +6388,27 @@ SUMMARY:"""
     
     try:
         summary, _ = call_agent("Strategist", [{"role": "user", "content": summary_prompt}], 1000)
+        if not summary or "⚠️" in summary:
+            return fallback
         return summary[:max_length]
     except:
         # Fallback: just take key points
-        return conv_text[:max_length]
+        return fallback
 
 
 def get_session_summary(session_id: str) -> Optional[str]:
-    """Get cached session summary or generate one."""
+    """Get cached session summary (and its checkpoint offset) or load it from storage."""
     if session_id in _session_summaries:
         return _session_summaries[session_id]
     
     try:
-        db = get_supabase()
-        if db:
-            # Try to get stored summary
-            result = db.table("chat_sessions").select("summary").eq("id", session_id).execute()
-            if result.data and result.data[0].get("summary"):
-                _session_summaries[session_id] = result.data[0]["summary"]
+        storage = get_storage()
+        if storage:
+            # Stored summary + checkpoint
+            session = storage.get_session(session_id)
+            if session and session.get("summary"):
+                _session_summaries[session_id] = session["summary"]
+                _summary_offsets[session_id] = int(session.get("summary_offset") or 0)
                 return _session_summaries[session_id]
     except:
         pass
@@ -1909,27 +6416,47 @@ def get_session_summary(session_id: str) -> Optional[str]:
     return None
 
 
+def _fold_session_summary(session_id: str, new_messages: List[Dict], checkpoint: int):
+    """Background worker: fold new messages into the rolling summary and persist the checkpoint."""
+    try:
+        summary = summarize_conversation(new_messages, previous_summary=_session_summaries.get(session_id))
+        _session_summaries[session_id] = summary
+        _summary_offsets[session_id] = checkpoint
+        
+        storage = get_storage()
+        if storage and not session_id.startswith("local-"):
+            storage.update_session(session_id, {"summary": summary, "summary_offset": checkpoint})
+    except Exception as e:
+        print(f"[session_summary ERROR] session_id={session_id}, error={str(e)}")
+    finally:
+        with _summary_lock:
+            _summary_inflight.discard(session_id)
+
+
 def update_session_summary(session_id: str, history: List[Dict]):
-    """Update session summary in background (every 10 messages)."""
-    if not history or len(history) < 10:
+    """Schedule an incremental summary update in the background (never blocks the caller)."""
+    if not history:
         return
     
-    # Only update every 10 messages
-    if len(history) % 10 != 0:
+    offset = _summary_offsets.get(session_id, 0)
+    if offset > len(history):
+        offset = 0  # History shrank (deleted messages) - start over
+    
+    # Only update once SUMMARY_INTERVAL new messages have accumulated
+    if len(history) - offset < SUMMARY_INTERVAL:
         return
     
-    summary = summarize_conversation(history)
-    _session_summaries[session_id] = summary
+    with _summary_lock:
+        if session_id in _summary_inflight:
+            return
+        _summary_inflight.add(session_id)
     
-    try:
-        db = get_supabase()
-        if db:
-            db.table("chat_sessions").update({"summary": summary}).eq("id", session_id).execute()
-    except:
-        pass
+    # Oldest unsummarized first - the checkpoint only advances past what was actually folded in
+    new_messages = list(history[offset:offset + SUMMARY_MAX_NEW_MESSAGES])
+    _summary_pool.submit(_fold_session_summary, session_id, new_messages, offset + len(new_messages))
 
 
-def build_hierarchical_context(session_id: str, user_input: str, user_id: str = None) -> List[Dict]:
+def build_hierarchical_context(session_id: str, user_input: str, user_id: str = None, diffed_files: set = None) -> List[Dict]:
     """
     HIERARCHICAL CONTEXT BUILDER - ABSOLUTE MAXIMUM Token Usage
     
@@ -1940,7 +6467,9 @@ def build_hierarchical_context(session_id: str, user_input: str, user_id: str =
     1. IMMEDIATE (last 20 messages, 20000 chars each) - ~100K tokens max
     2. SESSION SUMMARY (compressed history) - ~8K tokens  
     3. LONG-TERM MEMORIES (semantic recall) - ~12K tokens
-    4. FILE CACHE REFERENCES - Shows available files without resending
+    4. FILE CACHE REFERENCES - Shows available files without resending,
+       plus pages and code symbols the query names and BM25-retrieved excerpts (~6K tokens)
+    5. RELATED PAST SESSIONS (full-text search snippets) - ~1K tokens
     
     Total: ~120K tokens (uses full 128K context window)
     """
@@ -1949,14 +6478,65 @@ def build_hierarchical_context(session_id: str, user_input: str, user_id: str =
     MAX_MESSAGES = 20       # Last 20 messages (ABSOLUTE MAX)
     MAX_MEMORY_CHARS = 6000  # Per memory (ABSOLUTE MAX)
     MAX_SUMMARY_CHARS = 8000  # Session summary (ABSOLUTE MAX)
+    MAX_RELATED_HITS = 3      # Snippets from other sessions
+    
+    # TIER 5: Related snippets from the user's other sessions (FTS index, milliseconds)
+    if user_id:
+        hits = search(user_input, user_id=user_id, kinds=["message"], exclude_session=session_id, limit=MAX_RELATED_HITS)
+        if hits:
+            related = "\n".join(f"- [{h['title']}, {str(h['created_at'])[:10]}]: {h['snippet']}" for h in hits)
+            context.append({
+                "role": "user",
+                "content": f"[RELATED PAST CONVERSATIONS]:\n{related}"
+            })
     
     # TIER 4: FILE CACHE REFERENCES - Shows what files are available
+    # (attachments referenced in history but not cached - e.g. after a restart - are re-cached first)
+    try:
+        _rehydrate_session_files(session_id, get_history(session_id))
+    except Exception as e:
+        print(f"[context] Attachment rehydrate failed: {str(e)}")
+    # Archive members the query names are extracted first so they show up below
+    try:
+        archive_note = archive_query_members(session_id, user_input)
+        if archive_note:
+            context.append({
+                "role": "user",
+                "content": archive_note
+            })
+    except Exception as e:
+        print(f"[context] Archive extraction failed: {str(e)}")
     file_refs = get_file_references(session_id)
     if file_refs:
         context.append({
             "role": "user",
             "content": file_refs
         })
+        # Files inlined in this message are already in full view - excerpt the rest
+        # (re-uploads sent only as a diff / reference still get excerpts)
+        inline_names = {name for name, _ in FILE_BLOCK_PATTERN.findall(user_input)} - (diffed_files or set())
+        query = FILE_BLOCK_PATTERN.sub("", user_input)
+        # Explicit page references ("page 12", "pp. 40-45") pull those pages from paged documents
+        pages_block, paged_names = page_range_context(session_id, query)
+        if pages_block:
+            context.append({
+                "role": "user",
+                "content": pages_block
+            })
+        # Symbols the query names (+ callers / callees) come from the symbol index, not whole files
+        symbols_block, symbol_chars = symbol_context(session_id, query)
+        if symbols_block:
+            context.append({
+                "role": "user",
+                "content": symbols_block
+            })
+        chunks = retrieve_file_chunks(session_id, query, exclude=inline_names | paged_names,
+                                      budget=max(FILE_CONTEXT_BUDGET - symbol_chars, FILE_CONTEXT_BUDGET // 4))
+        if chunks:
+            context.append({
+                "role": "user",
+                "content": format_file_chunks(chunks)
+            })
     
     # TIER 3: Long-term memories (semantic) - LIMITED
     try:
@@ -1988,23 +6568,31 @@ def build_hierarchical_context(session_id: str, user_input: str, user_id: str =
     try:
         history = get_history(session_id)
         
-        # Update session summary in background
+        # Schedule incremental session summary (background worker, never blocks)
         update_session_summary(session_id, history)
         
         # Take last N messages with SMART truncation
         recent_msgs = history[-MAX_MESSAGES:]
+        cached_names = {f["name"] for f in _session_files(session_id)}
+        owner = session_user(session_id)  # References typed into a message only resolve for their owner
         for i, msg in enumerate(recent_msgs):
             content = msg.get('content', '')
             
-            # For OLD messages (not last 2), strip file contents to save tokens
+            # For OLD messages (not last 2) and CACHED files (served as excerpts), strip file contents to save tokens
             is_recent = i >= len(recent_msgs) - 2
-            if not is_recent and "[FILE:" in content:
-                # Replace file contents with references
-                import re
+            if "[ATTACHMENT:" in content:
+                # Stored attachments: resolve only recent ones the excerpt tier doesn't cover
+                content = ATTACHMENT_REF_PATTERN.sub(
+                    lambda m: (get_attachment(m.group(2), owner) or m.group(0)) if is_recent and m.group(1).strip() not in cached_names
+                    else m.group(0),
+                    content
+                )
+            if "[FILE:" in content:
                 # Keep file markers but remove content
                 content = re.sub(
                     r'\[FILE: ([^\]]+)\]\n```[^`]*```',
-                    r'[FILE: \1 - content in cache, use "show file \1" to view]',
+                    lambda m: m.group(0) if is_recent and m.group(1) not in cached_names
+                    else f'[FILE: {m.group(1)} - content in cache, use "show file {m.group(1)}" to view]',
                     content
                 )
             
@@ -2023,15 +6611,145 @@ def build_hierarchical_context(session_id: str, user_input: str, user_id: str =
     return context
 
 
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+# SEMANTIC ANSWER CACHE - Near-duplicate queries skip the full council
+# Scoped per user, TTL-bounded, short TTL for time-sensitive queries
+# ═══════════════════════════════════════════════════════════════════════════════════════════════════════
+
+SEMANTIC_CACHE_THRESHOLD = 0.95        # Cosine similarity needed for a hit
+SEMANTIC_CACHE_TTL = 24 * 3600         # Seconds a verdict stays valid
+SEMANTIC_CACHE_FRESH_TTL = 10 * 60     # Seconds for time-sensitive queries (news, prices, "today"...)
+SEMANTIC_CACHE_MAX_ENTRIES = 200       # Per user, oldest evicted first
+SEMANTIC_CACHE_MAX_QUERY_CHARS = 2000  # Longer queries carry too much unique context to reuse
+SEMANTIC_CACHE_CONTEXT_MESSAGES = 4    # Latest session messages folded into the context fingerprint
+
+TIME_SENSITIVE_PATTERN = re.compile(
+    r"\b(today|tonight|tomorrow|yesterday|now|right now|current(?:ly)?|latest|recent(?:ly)?|news|"
+    r"this (?:week|month|year)|price|stock|weather|score|live|breaking)\b", re.I)
+UNCACHEABLE_MARKERS = ["[FILE:", "[ATTACHMENT:", "[IMAGE ATTACHED", "[VIDEO:", "[AUDIO:", "[EXCEL:", "[CSV:", "[WORD:",
+                       "[POWERPOINT:", "[JUPYTER:", "[ARCHIVE:", "search:", "http://", "https://"]
+
+# {user_key: [{"vector": np.ndarray, "query": str, "context": str, "verdict": str, "agent": str, "created_at": float, "expires_at": float}]}
+_semantic_cache: Dict[str, List[Dict]] = {}
+_semantic_cache_lock = threading.Lock()
+
+
+def is_cacheable_query(text: str) -> bool:
+    """Queries with attachments, URLs or live searches depend on more than their wording."""
+    if not text or len(text) > SEMANTIC_CACHE_MAX_QUERY_CHARS:
+        return False
+    return not any(marker.lower() in text.lower() for marker in UNCACHEABLE_MARKERS)
+
+
+def session_context_fingerprint(session_id: str) -> str:
+    """
+    Hash of the session's latest messages ("" for a fresh session). Verdicts are only reused under the
+    same fingerprint, so follow-ups ("now rewrite it in Rust") never get an answer from another conversation.
+    The key changes every turn, so hits are limited to opening questions (shared across all fresh sessions)
+    and a question repeated from the same conversation state (e.g. after a failed or abandoned run).
+    """
+    tail = get_history_tail(session_id, SEMANTIC_CACHE_CONTEXT_MESSAGES)
+    if not tail:
+        return ""
+    turns = "\n".join(f"{m.get('role')}: {m.get('content') or ''}" for m in tail)
+    return hashlib.sha256(turns.encode("utf-8", errors="replace")).hexdigest()
+
+
+def _semantic_cache_matches(query: str, user_id: str = None, context: str = None) -> Tuple[str, Optional[np.ndarray], List[Tuple[float, Dict]]]:
+    """
+    Return (user_key, query_vector, [(similarity, entry), ...]) for live entries above threshold
+    (only entries stored under `context`, unless it is None).
+    """
+    user_key = user_id or "anonymous"
+    vector = get_query_embedding(query)
+    if vector is None:
+        return user_key, None, []
+
+    now = time.time()
+    with _semantic_cache_lock:
+        live = [e for e in _semantic_cache.get(user_key, []) if e["expires_at"] > now]
+        _semantic_cache[user_key] = live
+        entries = [e for e in live if context is None or e["context"] == context]
+        if not entries:
+            return user_key, vector, []
+        sims = np.stack([e["vector"] for e in entries]) @ vector
+    hits = [(float(sims[i]), entries[i]) for i in np.flatnonzero(sims >= SEMANTIC_CACHE_THRESHOLD)]
+    return user_key, vector, sorted(hits, key=lambda h: -h[0])
+
+
+def lookup_cached_answer(query: str, user_id: str = None, context: str = "") -> Optional[Dict]:
+    """
+    SEMANTIC CACHE LOOKUP: Return the closest cached verdict for this user in this context
+    (session_context_fingerprint), or None.
+    Result: {"verdict", "agent", "similarity", "age"} (age in seconds)
+    """
+    if not is_cacheable_query(query):
+        return None
+    try:
+        _, _, hits = _semantic_cache_matches(query, user_id, context)
+        if hits:
+            similarity, entry = hits[0]
+            return {"verdict": entry["verdict"], "agent": entry["agent"], "similarity": similarity,
+                    "age": time.time() - entry["created_at"]}
+    except Exception as e:
+        print(f"[semantic_cache ERROR] {str(e)}")
+    return None
+
+
+def store_cached_answer(query: str, verdict: str, agent: str, user_id: str = None, context: str = ""):
+    """
+    Store a final verdict under its query embedding and the context fingerprint the query was asked in.
+    Time-sensitive queries get a short TTL.
+    """
+    if not is_cacheable_query(query) or not verdict:
+        return
+    try:
+        user_key, vector, hits = _semantic_cache_matches(query, user_id, context)
+        if vector is None:
+            return
+        now = time.time()
+        ttl = SEMANTIC_CACHE_FRESH_TTL if TIME_SENSITIVE_PATTERN.search(query) else SEMANTIC_CACHE_TTL
+        replaced = {id(entry) for _, entry in hits}
+        with _semantic_cache_lock:
+            entries = [e for e in _semantic_cache.get(user_key, []) if id(e) not in replaced]
+            entries.append({"vector": vector, "query": query, "context": context, "verdict": verdict, "agent": agent,
+                            "created_at": now, "expires_at": now + ttl})
+            _semantic_cache[user_key] = entries[-SEMANTIC_CACHE_MAX_ENTRIES:]
+    except Exception as e:
+        print(f"[semantic_cache ERROR] {str(e)}")
+
+
+def invalidate_cached_answer(query: str, user_id: str = None):
+    """Drop cached verdicts matching this query in any context (used by 'regenerate')."""
+    try:
+        user_key, _, hits = _semantic_cache_matches(query, user_id)
+        stale = {id(entry) for _, entry in hits}
+        if stale:
+            with _semantic_cache_lock:
+                _semantic_cache[user_key] = [e for e in _semantic_cache.get(user_key, []) if id(e) not in stale]
+    except Exception as e:
+        print(f"[semantic_cache ERROR] {str(e)}")
+
+
 # ═══════════════════════════════════════════════════════════════════════════════════════════════════════
 # THE COUNCIL - TRUE AGENTIC COLLABORATION
 # ═══════════════════════════════════════════════════════════════════════════════════════════════════════
 
-def run_council(theme: str, user_input: str, session_id: str, user_id: str = None, screenshot_b64: str = None) -> Generator[Tuple[str, str, str], None, None]:
+def run_council(theme: str, user_input: str, session_id: str, user_id: str = None, screenshot_b64=None, use_cache: bool = True) -> Generator[Tuple[str, str, str], None, None]:
+    """Run the council pipeline, then flush the write-behind queue on completion (any exit path)."""
+    register_session_user(session_id, user_id)
+    try:
+        yield from _council_pipeline(theme, user_input, session_id, user_id, screenshot_b64, use_cache)
+    finally:
+        flush_messages(wait=False)
+
+
+def _council_pipeline(theme: str, user_input: str, session_id: str, user_id: str = None, screenshot_b64=None, use_cache: bool = True) -> Generator[Tuple[str, str, str], None, None]:
     """
     THE TRUE PINNACLE COUNCIL
     
     - Direct image/video for explicit requests
+    - Semantic cache for near-duplicate queries (use_cache=False to regenerate)
     - Full council with TRUE collaboration for complex queries
     - AI-initiated media generation
     - Multi-round refinement
@@ -2069,6 +6787,28 @@ def run_council(theme: str, user_input: str, session_id: str, user_id: str = Non
             save_message(session_id, "assistant", f"Video generation failed: {error}", "System")
         return
     
+    # ═══════════════════════════════════════════════════════════════════════════════
+    # PHASE 0.5: SEMANTIC CACHE - near-duplicate query answered in milliseconds
+    # ═══════════════════════════════════════════════════════════════════════════════
+    
+    # Fingerprint of the conversation so far - cached verdicts are only reused in the same context
+    cache_context = session_context_fingerprint(session_id) if not screenshot_b64 else ""
+    if not use_cache:
+        invalidate_cached_answer(user_input, user_id)
+    elif not screenshot_b64:
+        cached = lookup_cached_answer(user_input, user_id, cache_context)
+        if cached:
+            age_min = int(cached["age"] // 60)
+            yield ("System", f"⚡ Semantic cache hit ({cached['similarity']:.0%} match, {age_min} min old) - use 🔄 Regenerate for a fresh answer", "system")
+            save_message(session_id, "user", user_input)
+            if len(get_history_tail(session_id, 2)) <= 1:
+                update_session_title(session_id, user_input[:40] + "..." if len(user_input) > 40 else user_input)
+            cached_agent = f"{cached['agent']} (Cached)"
+            save_message(session_id, "assistant", cached["verdict"], cached_agent)
+            yield (cached_agent, cached["verdict"], "emperor")
+            yield ("System", "🧠 Council Complete | 0 tokens (served from semantic cache)", "system")
+            return
+    
     # ═══════════════════════════════════════════════════════════════════════════════
     # PHASE 1: CONTEXT BUILDING
     # ═══════════════════════════════════════════════════════════════════════════════
@@ -2077,18 +6817,34 @@ def run_council(theme: str, user_input: str, session_id: str, user_id: str = Non
     for output in tool_outputs:
         yield ("System", output, "system")
     
+    enhanced_input, delta_names = delta_inline_files(session_id, enhanced_input)
+    if delta_names:
+        yield ("System", f"🔁 {len(delta_names)} re-uploaded file(s) → sending only the changes vs the cached version", "system")
+    
+    enhanced_input, compacted = compact_inline_files(session_id, enhanced_input)
+    if compacted:
+        yield ("System", f"📑 {compacted} large file(s) → sending only the most relevant excerpts", "system")
+    
+    # Still too large for one call: map-reduce it instead of letting call_anthropic truncate
+    if len(enhanced_input) > MAP_TRIGGER_CHARS:
+        enhanced_input = yield from map_reduce_input(enhanced_input)
+    
     if screenshot_b64:
-        enhanced_input += "\n\n[USER HAS ATTACHED A SCREENSHOT]"
-        yield ("System", "📸 Screenshot attached", "system")
+        if isinstance(screenshot_b64, list) and len(screenshot_b64) > 1:
+            enhanced_input += f"\n\n[USER HAS ATTACHED {len(screenshot_b64)} IMAGES]"
+            yield ("System", f"📸 {len(screenshot_b64)} images attached", "system")
+        else:
+            enhanced_input += "\n\n[USER HAS ATTACHED A SCREENSHOT]"
+            yield ("System", "📸 Screenshot attached", "system")
     
     # HIERARCHICAL CONTEXT - THE PINNACLE (replaces old 4-message limit)
     # 3 tiers: Long-term memories + Session summary + Last 15 messages (FULL content)
-    context = build_hierarchical_context(session_id, user_input, user_id)
+    context = build_hierarchical_context(session_id, user_input, user_id, set(delta_names))
     yield ("System", f"🧠 Context loaded: {len(context)} items", "system")
     
     # Save user message
     save_message(session_id, "user", user_input)
-    history = get_history(session_id)
+    history = get_history_tail(session_id, 2)
     if len(history) <= 1:
         update_session_title(session_id, user_input[:40] + "..." if len(user_input) > 40 else user_input)
     
@@ -2096,10 +6852,12 @@ def run_council(theme: str, user_input: str, session_id: str, user_id: str = Non
     context.append({"role": "user", "content": enhanced_input})
     
     # ═══════════════════════════════════════════════════════════════════════════════
-    # PHASE 2: SIMPLE QUERY FAST PATH
+    # PHASE 2: SIMPLE QUERY FAST PATH (embedding router decides)
     # ═══════════════════════════════════════════════════════════════════════════════
     
-    if is_simple_query(user_input):
+    route, route_confidence = route_query(user_input)
+    
+    if route == 'simple':
         yield ("System", "⚡ Fast response...", "system")
         answer, _ = call_agent("Strategist", context, 2000)
         
@@ -2132,10 +6890,10 @@ def run_council(theme: str, user_input: str, session_id: str, user_id: str = Non
     # PHASE 3: QUERY CLASSIFICATION & DYNAMIC ROUTING
     # ═══════════════════════════════════════════════════════════════════════════════
     
-    query_type = classify_query(user_input)
+    query_type = route
     use_debate = needs_debate(user_input, query_type)
     
-    yield ("System", f"📊 Query type: {query_type.upper()} | Debate mode: {'ON' if use_debate else 'OFF'}", "system")
+    yield ("System", f"📊 Query type: {query_type.upper()} ({route_confidence:.0%} confidence) | Debate mode: {'ON' if use_debate else 'OFF'}", "system")
     
     # ═══════════════════════════════════════════════════════════════════════════════
     # PHASE 4: STRATEGIST PLANNING (WITH VISION IF SCREENSHOT)
@@ -2189,6 +6947,16 @@ def run_council(theme: str, user_input: str, session_id: str, user_id: str = Non
             yield ("System", f"📂 Reading GitHub: {prompt[:50]}...", "system")
             content = read_github(prompt)
             context.append({"role": "user", "content": f"[GITHUB CONTENT]:\n{content}"})
+        elif cmd_type == "table_query":
+            table_id, spec = prompt.split("|", 1)
+            yield ("System", f"📊 Querying table {table_id[:8]}: {spec[:50]}", "system")
+            context.append({"role": "user", "content": f"[TABLE QUERY RESULT]:\n{query_table(table_id, spec)}"})
+        elif cmd_type == "file_pages":
+            yield ("System", f"📄 Reading pages: {prompt.replace('|', ' ')[:50]}", "system")
+            context.append({"role": "user", "content": read_file_pages(session_id, prompt)})
+        elif cmd_type == "archive_file":
+            yield ("System", f"🗜️ Extracting from archive: {prompt[:50]}", "system")
+            context.append({"role": "user", "content": read_archive_files(session_id, prompt)})
     
     # ═══════════════════════════════════════════════════════════════════════════════
     # PHASE 5: DEBATE MODE (if triggered)
@@ -2331,6 +7099,16 @@ def run_council(theme: str, user_input: str, session_id: str, user_id: str = Non
                     success, output = execute_code(code, lang)
                     yield ("System", output, "system")
                     context.append({"role": "user", "content": f"[AUTO-TEST RESULT]:\n{output}"})
+            elif cmd_type == "table_query":
+                table_id, spec = prompt.split("|", 1)
+                yield ("System", f"📊 Querying table {table_id[:8]}: {spec[:50]}", "system")
+                context.append({"role": "user", "content": f"[TABLE QUERY RESULT]:\n{query_table(table_id, spec)}"})
+            elif cmd_type == "file_pages":
+                yield ("System", f"📄 Reading pages: {prompt.replace('|', ' ')[:50]}", "system")
+                context.append({"role": "user", "content": read_file_pages(session_id, prompt)})
+            elif cmd_type == "archive_file":
+                yield ("System", f"🗜️ Extracting from archive: {prompt[:50]}", "system")
+                context.append({"role": "user", "content": read_archive_files(session_id, prompt)})
 
     
     # ═══════════════════════════════════════════════════════════════════════════════
@@ -2432,7 +7210,8 @@ If good, say "APPROVED" or "LGTM". If not, specify what's still wrong."""
     if skip_emperor:
         yield ("System", "⚡ Sage approved - using Executor solution directly (saving tokens)", "system")
         verdict = solution
-        save_message(session_id, "assistant", verdict, f"{AGENTS['Executor']['name']} (Final)")
+        final_agent = f"{AGENTS['Executor']['name']} (Final)"
+        save_message(session_id, "assistant", verdict, final_agent)
         yield (f"{AGENTS['Executor']['name']} (Sage-Approved)", verdict, "executor")
     else:
         yield ("System", "👑 Emperor synthesizing final answer...", "system")
@@ -2454,10 +7233,12 @@ Synthesize the FINAL answer. Fix issues. Make it PERFECT."""
         if not verdict or "⚠️" in verdict or "Exception:" in verdict:
             yield ("System", "⚠️ Emperor error - using Executor solution", "system")
             verdict = solution
-            save_message(session_id, "assistant", verdict, f"{AGENTS['Executor']['name']} (Final)")
+            final_agent = f"{AGENTS['Executor']['name']} (Final)"
+            save_message(session_id, "assistant", verdict, final_agent)
             yield (f"{AGENTS['Executor']['name']} (Fallback)", verdict, "executor")
         else:
-            save_message(session_id, "assistant", verdict, AGENTS["Emperor"]["name"])
+            final_agent = AGENTS["Emperor"]["name"]
+            save_message(session_id, "assistant", verdict, final_agent)
             yield (AGENTS["Emperor"]["name"], verdict, "emperor")
     
     # Process commands from final answer
@@ -2491,6 +7272,10 @@ Synthesize the FINAL answer. Fix issues. Make it PERFECT."""
     if len(user_input) > 100 and len(verdict) > 500:
         save_memory(f"Q: {user_input[:150]}\nA: {verdict[:400]}", user_id)
     
+    # Cache the verdict for near-duplicate queries (screenshots make the query unique)
+    if not screenshot_b64:
+        store_cached_answer(user_input, verdict, final_agent, user_id, cache_context)
+    
     # Final stats
     tokens_saved = "~50% saved via smart skip" if skip_emperor else ""
     yield ("System", f"🧠 Council Complete | {get_tokens_used():,} tokens | {round_num} refinements {tokens_saved}", "system")
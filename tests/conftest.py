@@ -0,0 +1,19 @@
+"""Shared test setup: an isolated file cache and a throwaway SQLite backend."""
+
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("COUNCIL_CACHE_DIR", tempfile.mkdtemp(prefix="council-test-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import council
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    backend = council.SQLiteStorage(str(tmp_path / "council.db"))
+    monkeypatch.setattr(council, "_storage", backend)
+    return backend
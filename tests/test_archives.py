@@ -0,0 +1,49 @@
+"""Archive members are extracted on demand, within size, ratio and per-session limits."""
+
+import io
+import re
+import zipfile
+
+import pytest
+
+import council
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    monkeypatch.setattr(council, "ARCHIVE_DIR", str(tmp_path / "archives"))
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("src/app.py", "print('hello')\n")
+        zf.writestr("src/util.py", "def helper():\n    return 42\n" * 40)
+        zf.writestr("data/bomb.txt", "0" * (4 * 1024 * 1024))
+        zf.writestr("data/big.log", "".join(f"event {i} {i * 7919 % 104729}\n" for i in range(40000)))
+    text = council.ingest_archive_upload("project.zip", buf.getvalue())["text"]
+    return re.search(r"id=([0-9a-f]{16})", text).group(1)
+
+
+def test_listing_without_extraction(archive, storage):
+    index = council._archive_index(archive)
+    assert set(index["members"]) == {"src/app.py", "src/util.py", "data/bomb.txt", "data/big.log"}
+    assert council._match_members(index["members"], "src/*.py") == ["src/app.py", "src/util.py"]
+    assert council._match_members(index["members"], "app.py") == ["src/app.py"]
+
+
+def test_zip_bomb_ratio_is_refused(archive, storage):
+    done, errors = council.extract_archive_members("archive-ratio", archive, ["data/bomb.txt"])
+    assert done == [] and "zip bomb" in errors[0]
+
+
+def test_member_size_limit(archive, storage, monkeypatch):
+    monkeypatch.setattr(council, "ARCHIVE_MEMBER_MAX_BYTES", 100_000)
+    done, errors = council.extract_archive_members("archive-size", archive, ["data/big.log", "src/app.py"])
+    assert done == ["src/app.py"]
+    assert "member limit" in errors[0]
+
+
+def test_session_extraction_budget(archive, storage, monkeypatch):
+    monkeypatch.setattr(council, "ARCHIVE_SESSION_MAX_BYTES", 1000)
+    done, errors = council.extract_archive_members("archive-budget", archive, ["src/app.py", "src/util.py"])
+    assert done == ["src/app.py"]
+    assert "budget" in errors[0]
+    assert [f["name"] for f in council._session_files("archive-budget")] == ["src/app.py"]
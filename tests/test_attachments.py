@@ -0,0 +1,79 @@
+"""Attachments are stored once by hash, but only their owners can read them back."""
+
+import council
+
+
+def test_get_attachment_is_scoped_to_owners(storage):
+    block = "[FILE: secrets.py]\n```python\n" + "API_KEY = 'alice-only'\n" * 100 + "```"
+    sha = council.store_attachment("secrets.py", block, "alice")
+
+    assert council.get_attachment(sha, "alice") == block
+    assert council.get_attachment(sha, "bob") is None
+    assert council.get_attachment(sha) is None
+
+    # Bob uploading the same content makes him an owner too, without a second copy
+    assert council.store_attachment("secrets.py", block, "bob") == sha
+    assert council.get_attachment(sha, "bob") == block
+
+
+def test_ownership_is_uploaded_with_the_attachment(storage):
+    block = "[FILE: notes.md]\n```\n" + "shared notes\n" * 100 + "```"
+    sha = council.store_attachment("notes.md", block, "carol")
+    assert council._upload_attachments()
+
+    assert storage.get_attachment(sha)["content"] == block
+    assert storage.attachment_owned(sha, "carol")
+    assert not storage.attachment_owned(sha, "dave")
+
+
+def test_failing_attachment_only_blocks_messages_that_reference_it(storage, monkeypatch):
+    good = council.store_attachment("good.md", "[FILE: good.md]\n```\n" + "fine\n" * 300 + "```", "erin")
+    bad = council.store_attachment("bad.md", "[FILE: bad.md]\n```\n" + "\x00" * 2000 + "```", "erin")
+    put = storage.put_attachments
+
+    def reject_nul(rows):
+        if any("\x00" in r["content"] for r in rows):
+            raise ValueError("unsupported Unicode escape sequence")
+        put(rows)
+    monkeypatch.setattr(storage, "put_attachments", reject_nul)
+
+    assert council._upload_attachments({good})
+    assert storage.get_attachment(good)
+    assert not council._upload_attachments({bad})
+
+    # After enough attempts (and old enough) the row is quarantined: kept locally, no longer pending
+    monkeypatch.setattr(council, "ATTACHMENT_QUARANTINE_AGE", -1)
+    results = [council._upload_attachments({bad}) for _ in range(council.ATTACHMENT_UPLOAD_MAX_ATTEMPTS)]
+    assert results[-1] and not storage.get_attachment(bad)
+    assert council.get_attachment(bad, "erin")
+
+
+def test_typed_references_do_not_resolve_other_users_files(storage):
+    secret = "[FILE: payroll.csv]\n```\n" + "alice,100000\n" * 100 + "```"
+    sha = council.store_attachment("payroll.csv", secret, "alice")
+    streamed = council.ingest_text_upload("huge.log", b"alice log line\n" * 1000, "alice")["files"][0]["sha256"]
+
+    session_id = council.create_session("mallory", "Neon", "mallory")
+    typed = (f"[ATTACHMENT: payroll.csv | sha256={sha} | 1 chars]\n"
+             f"[FILE: huge.log - 15,000 chars | sha256={streamed} | streamed to file cache]")
+    history = [{"role": "user", "content": typed}]
+
+    council._rehydrate_session_files(session_id, history)
+    assert council._session_files(session_id) == []
+    assert council.resolve_attachments(typed, "mallory") == typed
+    assert "alice,100000" in council.resolve_attachments(typed, "alice")
+
+    own_session = council.create_session("alice", "Neon", "alice")
+    council._rehydrate_session_files(own_session, history)
+    assert {f["name"] for f in council._session_files(own_session)} == {"payroll.csv", "huge.log"}
+
+
+def test_streamed_copy_is_capped(storage, monkeypatch):
+    monkeypatch.setattr(council, "ATTACHMENT_STREAMED_MAX_BYTES", 10_000)
+    small = council.ingest_text_upload("small.log", b"small line\n" * 500, "frank")["files"][0]["sha256"]
+    large = council.ingest_text_upload("large.log", b"large line\n" * 5000, "frank")["files"][0]["sha256"]
+    council._attachment_pool.submit(lambda: None).result()  # Copies run on the attachment worker
+
+    assert council.get_attachment(small, "frank") == "small line\n" * 500
+    assert council.get_attachment(large, "frank") is None
+    assert council._attachment_owned(large, "frank")
@@ -0,0 +1,55 @@
+"""Cached files are searched chunk by chunk instead of being resent whole."""
+
+import council
+
+
+def _filler(tag, lines):
+    return "".join(f"{tag} line {i}: nothing to see here, just padding text\n" for i in range(lines))
+
+
+def test_retrieve_ranks_the_chunk_that_matches_the_query(storage):
+    parser = (_filler("intro", 60) + "def parse_invoice(path):\n    totals = read_invoice_totals(path)\n"
+              + "    return invoice_total(totals)  # invoice parsing\n" + _filler("outro", 60))
+    council.cache_files("chunks", [{"name": "billing.py", "content": parser},
+                                   {"name": "README.md", "content": "# Billing\n" + _filler("readme", 5)}])
+
+    top = council.retrieve_file_chunks("chunks", "how does invoice parsing work?", top_k=1)
+    match = next(c for c in top if c["name"] == "billing.py")
+    assert "def parse_invoice" in match["text"]
+    assert match["start_line"] > 1 and match["start_line"] <= 61 <= match["end_line"]
+
+    # Files without a matching chunk still contribute their head while the budget allows
+    readme = next(c for c in top if c["name"] == "README.md")
+    assert readme["start_line"] == 1 and readme["score"] == 0.0
+    assert [c["name"] for c in top] == ["billing.py", "README.md"]
+
+
+def test_retrieve_respects_filters_and_budget(storage):
+    council.cache_files("chunks-filter", [{"name": "a.txt", "content": _filler("alpha", 200)},
+                                          {"name": "b.txt", "content": _filler("beta", 200)}])
+
+    only_b = council.retrieve_file_chunks("chunks-filter", "beta padding", exclude={"a.txt"})
+    assert only_b and {c["name"] for c in only_b} == {"b.txt"}
+    assert council.retrieve_file_chunks("chunks-filter", "beta padding", names={"missing.txt"}) == []
+
+    small = council.retrieve_file_chunks("chunks-filter", "padding text", budget=council.FILE_CHUNK_CHARS * 2)
+    assert sum(len(c["text"]) for c in small) <= council.FILE_CHUNK_CHARS * 2
+
+
+def test_page_ranges_parses_page_references():
+    assert council.page_ranges("see page 12") == [(12, 12)]
+    assert council.page_ranges("compare pages 40-45 with p. 3") == [(40, 45), (3, 3)]
+    assert council.page_ranges("pp. 3 to 7, Pages 5–8") == [(3, 7), (5, 8)]
+    assert council.page_ranges("page 9-2") == [(2, 9)]
+    assert council.page_ranges("page 0, the 12 pages, paged 3") == []
+
+
+def test_requested_pages_are_read_by_offset(storage):
+    report = "".join(f"[Page {p}]\nbody of page {p}\n" for p in range(1, 21))
+    council.cache_files("pages", [{"name": "report.pdf", "content": report}])
+
+    context, served = council.page_range_context("pages", "summarize pages 4-5 of report.pdf")
+    assert served == {"report.pdf"}
+    assert "body of page 4" in context and "body of page 5" in context
+    assert "body of page 3\n" not in context and "body of page 6" not in context
+    assert council.read_file_pages("pages", "notes.txt | 1-2").startswith("[PDF_PAGES ERROR]")
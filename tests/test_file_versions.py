@@ -0,0 +1,45 @@
+"""Re-uploaded files are sent as a reference or a diff against the cached previous version."""
+
+import council
+
+
+def _source(changed_line=None):
+    lines = [f"def handler_{i}(event):\n    return process(event, {i})\n" for i in range(120)]
+    if changed_line is not None:
+        lines[changed_line] = f"def handler_{changed_line}(event):\n    return process(event, -1)\n"
+    return "".join(lines)
+
+
+def _message(name, body):
+    return f"please review\n[FILE: {name}]\n```python\n{body}```"
+
+
+def test_new_version_is_sent_as_a_diff(storage):
+    council.cache_files("versions-diff", [{"name": "handlers.py", "content": _source()}])
+    council.cache_files("versions-diff", [{"name": "handlers.py", "content": _source(changed_line=50)}])
+
+    text, names = council.delta_inline_files("versions-diff", _message("handlers.py", _source(changed_line=50)))
+    assert names == ["handlers.py"]
+    assert "diff vs v1" in text and "+1 -1 lines" in text
+    assert "-    return process(event, 50)" in text and "+    return process(event, -1)" in text
+    assert "handler_0(" not in text
+
+
+def test_unchanged_reupload_becomes_a_reference(storage):
+    council.cache_files("versions-same", [{"name": "handlers.py", "content": _source()}])
+    council.cache_files("versions-same", [{"name": "handlers.py", "content": _source()}])
+
+    text, names = council.delta_inline_files("versions-same", _message("handlers.py", _source()))
+    assert names == ["handlers.py"]
+    assert "unchanged since last upload" in text and "```" not in text
+
+
+def test_small_edited_or_first_uploads_stay_inline(storage):
+    council.cache_files("versions-inline", [{"name": "handlers.py", "content": _source()},
+                                            {"name": "tiny.py", "content": "x = 1\n"}])
+    council.cache_files("versions-inline", [{"name": "handlers.py", "content": _source(changed_line=3)},
+                                            {"name": "tiny.py", "content": "x = 2\n"}])
+
+    edited = _message("handlers.py", _source(changed_line=4))  # Not the cached version
+    for message in (edited, _message("tiny.py", "x = 2\n"), _message("other.py", _source())):
+        assert council.delta_inline_files("versions-inline", message) == (message, [])
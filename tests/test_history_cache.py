@@ -0,0 +1,35 @@
+"""The session history cache merges local appends and server rows without duplicates."""
+
+import council
+
+
+def test_merge_dedupes_rows_seen_locally_and_from_the_server():
+    entry = council._history_entry("merge-test")
+    local = {"session_id": "merge-test", "role": "user", "content": "hi", "created_at": "2026-01-01T10:00:00.120000+00:00"}
+    council._merge_history(entry, [local], from_server=False)
+    assert entry["watermark"] is None
+
+    # The server echoes the same row with trimmed microseconds, plus an older and a newer one
+    server = [{**local, "created_at": "2026-01-01T10:00:00.12+00:00"},
+              {"role": "assistant", "content": "hello", "created_at": "2026-01-01T10:00:01+00:00"},
+              {"role": "user", "content": "earlier", "created_at": "2026-01-01T09:00:00+00:00"}]
+    council._merge_history(entry, server)
+    council._merge_history(entry, server)
+
+    assert [m["content"] for m in entry["messages"]] == ["earlier", "hi", "hello"]
+    assert entry["watermark"] == "2026-01-01T10:00:01+00:00"
+    assert entry["oldest"] == "2026-01-01T09:00:00+00:00"
+
+
+def test_saved_messages_appear_once_after_a_delta_sync(storage, monkeypatch):
+    monkeypatch.setattr(council, "HISTORY_SYNC_INTERVAL", 0)
+    session_id = council.create_session("alice", "Neon", "alice")
+    assert council.get_history(session_id) == []
+
+    council.save_message(session_id, "user", "first")
+    council.save_message(session_id, "assistant", "second")
+    council.flush_messages()
+    history = council.get_history(session_id)
+
+    assert [m["content"] for m in history] == ["first", "second"]
+    assert [m["content"] for m in council.get_history_tail(session_id, 1)] == ["second"]
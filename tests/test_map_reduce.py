@@ -0,0 +1,36 @@
+"""Oversized messages are split into line-aligned chunks that keep their file headers."""
+
+import re
+
+import council
+
+CONTINUED = re.compile(r"\[FILE: [^\]]+ \(continued\)\]\n")
+
+
+def test_chunks_are_bounded_and_lossless():
+    text = ("Please compare these two files.\n"
+            "[FILE: a.py]\n```python\n" + "".join(f"value_{i} = {i}\n" for i in range(400)) + "```\n"
+            "[FILE: b.py - 3,000 chars]\n```python\n" + "".join(f"other_{i} = {i}\n" for i in range(200)) + "```\n")
+    limit = 100 * council.MAP_CHARS_PER_TOKEN
+    chunks = council.split_token_chunks(text, max_tokens=100)
+
+    assert len(chunks) > 2
+    assert all(len(chunk) <= limit + len("[FILE: a.py (continued)]\n") for chunk, _ in chunks)
+    assert "".join(CONTINUED.sub("", chunk) for chunk, _ in chunks) == text
+    assert all(chunk.endswith("\n") for chunk, _ in chunks)
+
+    # Every part of a file knows which file it is reading
+    for chunk, names in chunks:
+        if chunk.startswith("[FILE: a.py (continued)]"):
+            assert names[0] == "a.py"
+    assert chunks[0][1] == ["a.py"]
+    assert chunks[-1][1] == ["b.py"]
+
+
+def test_single_huge_line_is_hard_split():
+    limit = 50 * council.MAP_CHARS_PER_TOKEN
+    text = "intro\n" + "A" * (limit * 3 + 10) + "\nend\n"
+    chunks = council.split_token_chunks(text, max_tokens=50)
+
+    assert "".join(chunk for chunk, _ in chunks) == text
+    assert all(len(chunk) <= limit for chunk, _ in chunks)
@@ -0,0 +1,41 @@
+"""Memory consolidation must stay inside one user's memories."""
+
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import council
+
+
+def _insert(storage, user_id, content, vector, days_old=0):
+    created = datetime.now(timezone.utc) - timedelta(days=days_old)
+    row = {"content": content, "embedding": vector.tolist(), "created_at": created.isoformat()}
+    if user_id:
+        row["user_id"] = user_id
+    storage.insert_memory(row)
+
+
+def test_consolidation_never_deletes_other_users_rows(storage):
+    vector = council._normalize(np.random.default_rng(0).standard_normal(council.EMBEDDING_DIMENSIONS).astype(np.float32))
+    # Same vector for both users: duplicates within each user, and expired rows on both sides
+    for user_id in ["alice", "bob", None]:
+        _insert(storage, user_id, f"{user_id} memory", vector)
+        _insert(storage, user_id, f"{user_id} duplicate", vector)
+        _insert(storage, user_id, f"{user_id} ancient", vector, days_old=council.MEMORY_MAX_AGE_DAYS + 30)
+
+    stats = council.consolidate_memories("alice")
+
+    assert stats["merged"] == 1 and stats["expired"] == 1
+    assert len(storage.get_memories("alice")) == 1
+    assert sorted(r["content"] for r in storage.get_memories("bob")) == ["bob ancient", "bob duplicate", "bob memory"]
+    assert len(storage.get_memories(None)) == 7
+
+
+def test_anonymous_consolidation_is_a_no_op(storage):
+    vector = np.ones(council.EMBEDDING_DIMENSIONS, dtype=np.float32)
+    _insert(storage, "alice", "alice memory", vector)
+    _insert(storage, "alice", "alice duplicate", vector)
+    _insert(storage, None, "anonymous memory", vector)
+
+    assert council.consolidate_memories(None) == {}
+    assert len(storage.get_memories(None)) == 3
@@ -0,0 +1,44 @@
+"""Semantic cache verdicts are keyed on the conversation state the question was asked in."""
+
+import numpy as np
+import pytest
+
+import council
+
+
+@pytest.fixture(autouse=True)
+def embeddings(monkeypatch):
+    vectors = {}
+
+    def embed(text):
+        if text not in vectors:
+            rng = np.random.default_rng(len(vectors))
+            vectors[text] = council._normalize(rng.normal(size=council.EMBEDDING_DIMENSIONS))
+        return vectors[text]
+    monkeypatch.setattr(council, "get_query_embedding", embed)
+    monkeypatch.setattr(council, "_semantic_cache", {})
+
+
+def test_repeated_opening_question_hits_in_a_new_session(storage):
+    question = "What is the difference between a process and a thread?"
+    first = council.create_session("alice", "Neon", "alice")
+    council.store_cached_answer(question, "Threads share memory.", "Emperor", "alice",
+                                council.session_context_fingerprint(first))
+
+    second = council.create_session("alice", "Neon", "alice")
+    hit = council.lookup_cached_answer(question, "alice", council.session_context_fingerprint(second))
+    assert hit and hit["verdict"] == "Threads share memory."
+    assert council.lookup_cached_answer(question, "bob", council.session_context_fingerprint(second)) is None
+
+
+def test_follow_up_in_another_conversation_misses(storage):
+    question = "Now rewrite it in Rust"
+    first = council.create_session("alice", "Neon", "alice")
+    council.save_message(first, "user", "Write a CSV parser in Python")
+    council.store_cached_answer(question, "fn parse() {}", "Emperor", "alice",
+                                council.session_context_fingerprint(first))
+
+    other = council.create_session("alice", "Neon", "alice")
+    council.save_message(other, "user", "Write a JSON pretty-printer in Go")
+    assert council.lookup_cached_answer(question, "alice", council.session_context_fingerprint(other)) is None
+    assert council.lookup_cached_answer(question, "alice", council.session_context_fingerprint(first))
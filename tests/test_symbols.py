@@ -0,0 +1,76 @@
+"""Source uploads are indexed into symbols with line spans, calls and imports."""
+
+import council
+
+PYTHON_SOURCE = '''import os
+from .models import Invoice
+
+
+def load(path):
+    return parse(open(path).read())
+
+
+class Parser:
+    @staticmethod
+    def parse(text):
+        return Invoice(text.strip())
+
+    async def refresh(self):
+        await self.client.fetch()
+'''
+
+JS_SOURCE = '''import { api } from "./api";
+const lodash = require("lodash");
+
+export async function loadUser(id) {
+  const user = await api.get(id);
+  return normalize(user);
+}
+
+const normalize = (user) => ({ ...user, name: formatName(user.name) });
+
+export class UserStore {
+  constructor(cache) {
+    this.cache = cache;
+  }
+
+  async refresh(id) {
+    if (this.cache.has(id)) {
+      return this.cache.get(id);
+    }
+    return loadUser(id);
+  }
+}
+'''
+
+
+def _by_qualname(symbols):
+    return {s["qualname"]: s for s in symbols}
+
+
+def test_python_symbols():
+    symbols, imports = council._python_symbols(PYTHON_SOURCE)
+    found = _by_qualname(symbols)
+
+    assert imports == ["os", ".models"]
+    assert set(found) == {"load", "Parser", "Parser.parse", "Parser.refresh"}
+    assert (found["load"]["kind"], found["load"]["start"], found["load"]["end"]) == ("function", 5, 6)
+    assert found["Parser.parse"]["kind"] == "method"
+    assert found["Parser.parse"]["start"] == 10  # Decorators belong to the symbol
+    assert found["load"]["calls"] == ["open", "parse", "read"]
+    assert found["Parser.refresh"]["calls"] == ["fetch"]
+
+
+def test_js_symbols():
+    symbols, imports = council._js_symbols(JS_SOURCE)
+    found = _by_qualname(symbols)
+
+    assert imports == ["./api", "lodash"]
+    assert set(found) == {"loadUser", "normalize", "UserStore", "UserStore.refresh"}
+    assert (found["loadUser"]["start"], found["loadUser"]["end"]) == (4, 7)
+    assert (found["normalize"]["start"], found["normalize"]["end"]) == (9, 9)
+    assert (found["UserStore"]["kind"], found["UserStore"]["start"], found["UserStore"]["end"]) == ("class", 11, 22)
+    assert (found["UserStore.refresh"]["start"], found["UserStore.refresh"]["end"]) == (16, 21)
+    assert found["loadUser"]["calls"] == ["get", "normalize"]
+    assert found["normalize"]["calls"] == ["formatName"]
+    assert found["UserStore.refresh"]["calls"] == ["get", "has", "loadUser"]
@@ -0,0 +1,67 @@
+"""Cached tables answer [TABLE_QUERY:] clauses without ever inlining the full frame."""
+
+import os
+import time
+
+import pytest
+
+import council
+
+pd = pytest.importorskip("pandas")
+
+
+@pytest.fixture
+def table(tmp_path, monkeypatch):
+    monkeypatch.setattr(council, "TABLE_DIR", str(tmp_path / "tables"))
+    monkeypatch.setattr(council, "_table_frames", council.OrderedDict())
+    df = pd.DataFrame({"region": ["north", "south", "north", "east", "south", "north"],
+                       "amount": [120, 700, 950, 40, 510, 300],
+                       "Customer Name": ["Ann", "Bob", "Cy", "Di", "Ed", "Flo"]})
+    council._table_save(df, "ab12cd34")
+    return "ab12cd34"
+
+
+def _rows(result):
+    return result.splitlines()[2:]
+
+
+def test_where_sort_and_limit(table):
+    result = council.query_table(table, "where amount > 200; sort amount desc; limit 2")
+    assert "2 of 4 result rows (4 rows matched filters)" in result
+    assert [line.split()[1] for line in _rows(result)] == ["north", "south"]
+    assert "950" in _rows(result)[0]
+
+
+def test_contains_columns_and_quoted_names(table):
+    result = council.query_table(table, "where `Customer Name` contains o; columns region, amount")
+    assert result.splitlines()[1].split() == ["region", "amount"]
+    assert [line.split()[1:] for line in _rows(result)] == [["south", "700"], ["north", "300"]]
+
+
+def test_aggregate_by_group(table):
+    result = council.query_table(table, "agg sum(amount), count(*) by region; sort sum(amount) desc")
+    rows = [line.split() for line in _rows(result)]
+    assert [r[1:] for r in rows] == [["north", "1370", "3"], ["south", "1210", "2"], ["east", "40", "1"]]
+
+
+def test_row_range_is_end_exclusive(table):
+    result = council.query_table(table, "rows 1-3")
+    assert [line.split()[0] for line in _rows(result)] == ["1", "2"]
+
+
+def test_bad_clauses_are_reported(table):
+    assert council.query_table(table, "where missing > 1").startswith("[TABLE_QUERY ERROR] unknown column")
+    assert council.query_table(table, "agg explode(amount)").startswith("[TABLE_QUERY ERROR] unsupported aggregate")
+    assert council.query_table(table, "drop table").startswith("[TABLE_QUERY ERROR] unknown clause")
+    assert "not cached" in council.query_table("ffffffff", "limit 1")
+
+
+def test_unused_tables_are_swept(table, monkeypatch):
+    council._table_save(pd.DataFrame({"x": [1, 2]}), "ffff0000")
+    old = time.time() - council.TABLE_MAX_AGE - 60
+    for entry in os.listdir(council.TABLE_DIR):
+        os.utime(os.path.join(council.TABLE_DIR, entry), (old, old))
+
+    monkeypatch.setattr(council, "_table_last_sweep", 0.0)
+    assert "result rows" in council.query_table(table, "limit 1")  # Used - touched before the sweep
+    assert "not cached" in council.query_table("ffff0000", "limit 1")